@@ -0,0 +1,281 @@
+"""Performance benchmark of the counter and trigger gate controllers.
+
+It drives the controller API, as the Pool does in the step and in the
+continuous acquisitions, against the simulated Ni660XCounter channels with
+a configurable call latency. For each combination of the number of
+channels, repetitions, integration time and synchronization it reports:
+
+- the latency percentiles of each controller call,
+- the Tango calls and bytes transferred per point,
+- the maximum sustainable point rate, i.e. the points acquired per second
+  spent in the controller calls.
+
+The results can be saved as a baseline and compared with a later run, the
+script exits with 1 if any case regressed more than the tolerance.
+
+Usage: python benchmarks/bench_controllers.py [--channels 1 4 8]
+           [--repetitions 10 100] [--integ-time 0.001] [--synch software]
+           [--latency 0.0005] [--save FILE] [--compare FILE]
+"""
+import argparse
+import collections
+import json
+import sys
+import time
+
+import numpy
+from sardana import State
+from sardana.pool import AcqSynch, SynchDomain, SynchParam
+
+from sardana_ni660x.simulator import Simulation, add_axis, make_controller
+from sardana_ni660x.ctrl.Ni660XCounterCTCtrl import Ni660XCounterCTCtrl
+from sardana_ni660x.ctrl.Ni660XTriggerGateController import \
+    Ni660XTriggerGateController
+
+SYNCHRONIZATIONS = {
+    'software': AcqSynch.SoftwareTrigger,
+    # the step acquisition with the armedStepMode controller property
+    'armed': AcqSynch.SoftwareTrigger,
+    'hardware': AcqSynch.HardwareTrigger,
+}
+
+COUNTERS_PER_CARD = 8
+SAMPLE_CLK_SRC = '/Dev1/PFI36'
+TG_DEV_NAME = 'bench/ni660x/tg-ctr0'
+
+# relative changes of the metrics considered as regressions
+METRICS = (('calls_per_point', 1), ('bytes_per_point', 1), ('max_rate', -1))
+
+
+class Driver:
+    """Call the controller methods measuring their latency."""
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.latencies = collections.defaultdict(list)
+        self.busy = 0
+
+    def __call__(self, name, *args):
+        start = time.perf_counter()
+        result = getattr(self.ctrl, name)(*args)
+        elapsed = time.perf_counter() - start
+        self.latencies[name].append(elapsed)
+        self.busy += elapsed
+        return result
+
+
+def create_simulation(channels, latency, bandwidth):
+    sim = Simulation(latency=latency, bandwidth=bandwidth)
+    names = []
+    for index in range(channels + 1):
+        card, ctr = divmod(index, COUNTERS_PER_CARD)
+        name = 'bench/ni660x/dev%d-ctr%d' % (card + 1, ctr)
+        app_type = 'CICountEdgesChan' if index else 'COPulseChanTime'
+        sim.add_channel(name, app_type, 'ctr%d' % ctr, 'Dev%d' % (card + 1))
+        names.append(name)
+    sim.add_channel(TG_DEV_NAME, 'COPulseChanTime', 'ctr0', 'TG')
+    return sim, names
+
+
+def poll_state(driver, axes):
+    driver('PreStateAll')
+    for axis in axes:
+        driver('PreStateOne', axis)
+    driver('StateAll')
+    states = [driver('StateOne', axis)[0] for axis in axes]
+    return all(state != State.Moving for state in states)
+
+
+def read(driver, axes):
+    driver('PreReadAll')
+    for axis in axes:
+        driver('PreReadOne', axis)
+    driver('ReadAll')
+    return {axis: driver('ReadOne', axis) for axis in axes}
+
+
+def start(driver, axes, integ_time, repetitions):
+    # as the Pool does, channel by channel with the timer the last
+    driver('LoadOne', 1, integ_time, repetitions, 0)
+    driver('PreStartAll')
+    for axis in axes[1:] + axes[:1]:
+        driver('PreStartOne', axis, integ_time)
+        driver('StartOne', axis, integ_time)
+    driver('StartAll')
+
+
+def run_step(driver, axes, integ_time, repetitions, poll_period):
+    for _ in range(repetitions):
+        start(driver, axes, integ_time, 1)
+        while not poll_state(driver, axes):
+            time.sleep(poll_period)
+        read(driver, axes)
+
+
+def run_continuous(driver, tg_driver, axes, integ_time, repetitions,
+                   poll_period):
+    counters = axes[1:]
+    start(driver, axes, integ_time, repetitions)
+    tg_driver('SynchOne', 1, [{
+        SynchParam.Delay: {SynchDomain.Time: 0},
+        SynchParam.Active: {SynchDomain.Time: integ_time / 2},
+        SynchParam.Total: {SynchDomain.Time: integ_time},
+        SynchParam.Repeats: repetitions}])
+    tg_driver('PreStartAll')
+    tg_driver('PreStartOne', 1)
+    tg_driver('StartOne', 1)
+    tg_driver('StartAll')
+    acquired = dict.fromkeys(counters, 0)
+    while True:
+        time.sleep(poll_period)
+        finished = poll_state(driver, counters)
+        values = read(driver, counters)
+        for axis, chunk in values.items():
+            acquired[axis] += len(chunk)
+        if finished and min(acquired.values()) >= repetitions:
+            break
+        tg_driver('StateOne', 1)
+
+
+def percentiles(values):
+    p50, p95, p99 = numpy.percentile(values, (50, 95, 99))
+    return {'p50': p50, 'p95': p95, 'p99': p99}
+
+
+def run_case(channels, repetitions, integ_time, synch, latency, bandwidth,
+             poll_period):
+    sim, names = create_simulation(channels, latency, bandwidth)
+    with sim.patch():
+        ctrl = make_controller(Ni660XCounterCTCtrl,
+                               channelDevNames=','.join(names),
+                               armedStepMode=synch == 'armed')
+        axes = list(range(1, channels + 2))
+        for axis in axes:
+            add_axis(ctrl, axis)
+            if axis != 1:
+                ctrl.SetAxisExtraPar(axis, 'sampleClockSource',
+                                     SAMPLE_CLK_SRC)
+        ctrl._synchronization = SYNCHRONIZATIONS[synch]
+        driver = Driver(ctrl)
+        tg_driver = None
+        if synch == 'hardware':
+            tg_ctrl = make_controller(Ni660XTriggerGateController,
+                                      channelDevNames=TG_DEV_NAME)
+            add_axis(tg_ctrl, 1)
+            tg_driver = Driver(tg_ctrl)
+        sim.reset_stats()
+        wall = time.perf_counter()
+        if synch != 'hardware':
+            run_step(driver, axes, integ_time, repetitions, poll_period)
+        else:
+            run_continuous(driver, tg_driver, axes, integ_time, repetitions,
+                           poll_period)
+        wall = time.perf_counter() - wall
+        calls, nbytes = sim.stats()
+    latencies = dict(driver.latencies)
+    busy = driver.busy
+    if tg_driver is not None:
+        busy += tg_driver.busy
+        for name, values in tg_driver.latencies.items():
+            latencies['TG.' + name] = values
+    return {
+        'wall': wall,
+        'calls_per_point': calls / repetitions,
+        'bytes_per_point': nbytes / repetitions,
+        'max_rate': repetitions / busy if busy else float('inf'),
+        'latency': {name: percentiles(values)
+                    for name, values in sorted(latencies.items())},
+    }
+
+
+def case_key(synch, channels, repetitions, integ_time):
+    return '%s-ch%d-rep%d-it%g' % (synch, channels, repetitions, integ_time)
+
+
+def report(key, result, verbose):
+    print('%-32s %8.3f %10.1f %12.1f %12.1f' % (
+        key, result['wall'], result['calls_per_point'],
+        result['bytes_per_point'], result['max_rate']))
+    if verbose:
+        for name, p in result['latency'].items():
+            print('    %-24s p50 %8.3f  p95 %8.3f  p99 %8.3f ms' % (
+                name, p['p50'] * 1e3, p['p95'] * 1e3, p['p99'] * 1e3))
+
+
+def compare(results, baseline, tolerance):
+    """Print the metrics which changed more than tolerance with respect to
+    the baseline and return the number of regressions.
+    """
+    regressions = 0
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        for metric, direction in METRICS:
+            old, new = reference[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if change * direction > tolerance:
+                regressions += 1
+                print('REGRESSION %s %s: %.4g -> %.4g (%+.0f%%)' % (
+                    key, metric, old, new, change * 100))
+            elif -change * direction > tolerance:
+                print('improvement %s %s: %.4g -> %.4g (%+.0f%%)' % (
+                    key, metric, old, new, change * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, nargs='+', default=[1, 4, 8],
+                        help='number of counter channels')
+    parser.add_argument('--repetitions', type=int, nargs='+',
+                        default=[10, 100], help='number of points')
+    parser.add_argument('--integ-time', type=float, nargs='+',
+                        default=[0.001], help='integration time [s]')
+    parser.add_argument('--synch', nargs='+', choices=SYNCHRONIZATIONS,
+                        default=list(SYNCHRONIZATIONS),
+                        help='synchronization mode')
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='latency of every Tango call [s]')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='bandwidth of the Tango calls [bytes/s]')
+    parser.add_argument('--poll-period', type=float, default=0.01,
+                        help='period of the Pool state and value polling [s]')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative change considered as a regression')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the latency percentiles of each call')
+    args = parser.parse_args()
+
+    print('%-32s %8s %10s %12s %12s' % ('case', 'wall [s]', 'calls/pt',
+                                        'bytes/pt', 'max pt/s'))
+    results = {}
+    for synch in args.synch:
+        for channels in args.channels:
+            for repetitions in args.repetitions:
+                for integ_time in args.integ_time:
+                    key = case_key(synch, channels, repetitions, integ_time)
+                    results[key] = run_case(channels, repetitions, integ_time,
+                                            synch, args.latency,
+                                            args.bandwidth, args.poll_period)
+                    report(key, results[key], args.verbose)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'latency': args.latency, 'bandwidth': args.bandwidth,
+                       'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
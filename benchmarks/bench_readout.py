@@ -0,0 +1,81 @@
+"""Memory and time benchmark of the multi-point readout conversion.
+
+It compares the former path of Ni660XPositionCTCtrl, which applied the sign
+and the offset on temporary arrays, with the in place conversion of a
+single float64 copy of each chunk. Both chunks are returned as lists and go
+through the Pool value handling, which translates each value of a chunk
+into a SardanaValue, as the Pool does with the ReadOne results.
+
+Usage: python benchmarks/bench_readout.py [--points N] [--chunk N]
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy
+from sardana.pool.poolextension import translate_ctrl_value
+
+
+def pool_values(chunk):
+    # as PoolController.read_axis_values does with a chunk of values
+    return [translate_ctrl_value(value) for value in chunk]
+
+
+def temporary_path(chunks, sign, offset):
+    values = []
+    for data in chunks:
+        if sign == -1:
+            data = data * -1
+        data = data + offset
+        values.append(pool_values(data.tolist()))
+    return values
+
+
+def in_place_path(chunks, sign, offset):
+    values = []
+    for data in chunks:
+        data = numpy.array(data, dtype=numpy.float64)
+        if sign == -1:
+            numpy.negative(data, out=data)
+        data += offset
+        values.append(pool_values(data.tolist()))
+    return values
+
+
+def measure(func, chunks):
+    # the time is measured without tracing, it slows down the allocations
+    start = time.perf_counter()
+    values = func(chunks, -1, 12.5)
+    elapsed = time.perf_counter() - start
+    del values
+    tracemalloc.start()
+    values = func(chunks, -1, 12.5)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del values
+    return elapsed, retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=1000000,
+                        help='number of points of the scan')
+    parser.add_argument('--chunk', type=int, default=1000,
+                        help='number of points returned by each ReadOne')
+    args = parser.parse_args()
+
+    raw = numpy.arange(args.points, dtype=numpy.float64)
+    chunks = [raw[i:i + args.chunk] for i in range(0, args.points, args.chunk)]
+    print('%d points in chunks of %d' % (args.points, args.chunk))
+    print('%-10s %10s %14s %14s' % ('path', 'time [s]', 'retained [MB]',
+                                    'peak [MB]'))
+    for name, func in (('temporary', temporary_path),
+                       ('in place', in_place_path)):
+        elapsed, retained, peak = measure(func, chunks)
+        print('%-10s %10.4f %14.2f %14.2f' % (name, elapsed,
+                                              retained / 2**20,
+                                              peak / 2**20))
+
+
+if __name__ == '__main__':
+    main()
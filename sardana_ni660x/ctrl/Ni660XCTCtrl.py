@@ -1,4 +1,8 @@
 #!/usr/bin/env python
+import json
+import threading
+import time
+
 import numpy
 
 import tango
@@ -10,7 +14,16 @@ from sardana.pool.controller import (Memorize,
                                      DataAccess, Description, DefaultValue)
 from sardana.sardanavalue import SardanaValue
 
+from sardana_ni660x.instrumentation import (INSTRUMENTATION_DOC,
+                                            INSTRUMENTATIONDATA_DOC,
+                                            TRACEDIRECTORY_DOC,
+                                            Instrumentation, instrumented)
+from sardana_ni660x.proxies import get_proxy, release_proxy
 from sardana_ni660x.utils import CONNECTTERMS_DOC, ConnectTerms
+from sardana_ni660x.utils import AttributeShadow, parallel_map
+from sardana_ni660x.utils import DMACHANNELS_DOC, allocate_dma_channels
+from sardana_ni660x.utils import release_dma_channels
+from sardana_ni660x.utils import ReadScheduler, get_device_properties
 
 ReadWrite = DataAccess.ReadWrite
 ReadOnly = DataAccess.ReadOnly
@@ -22,6 +35,30 @@ CHANNELDEVNAMES_DOC = ('Comma separated Ni660XCounter Tango device names.',
                        ' application type e.g. CICountEdgesChan) are used'
                        ' as counters.')
 
+DELTAREADOUT_DOC = ('Read only the samples acquired since the previous'
+                    ' readout instead of the whole buffer. It requires the'
+                    ' Ni660XCounter devices to expose the BufferOffset'
+                    ' attribute.')
+
+USEEVENTS_DOC = ('Subscribe to the change events of the buffer attribute'
+                 ' and the state of the counter channels and serve ReadOne'
+                 ' and StateOne from the received values instead of'
+                 ' polling the devices. It requires the Ni660XCounter'
+                 ' devices to push change events.')
+
+ARMEDSTEPMODE_DOC = ('In the step acquisition keep the counter channels'
+                     ' running, gated by the timer output through their'
+                     ' pause trigger, so each point only starts the timer'
+                     ' and reads its samples. It requires the Ni660XCounter'
+                     ' devices to support the pause trigger, the'
+                     ' continuous sample mode and the BufferOffset'
+                     ' attribute. Only for CICountEdgesChan channels.')
+
+MAXSTALENESS_DOC = ('Maximum time in seconds between two reads of the buffer'
+                    ' of a counter channel in the continuous acquisition.'
+                    ' Below it the buffer is read only when enough new'
+                    ' samples are expected to be worth the read.')
+
 class Ni660XCTCtrl(object):
     """This class is the Ni600X counter Sardana CounterTimerController.
     It can work in step and continuous scan mode. 
@@ -44,9 +81,48 @@ class Ni660XCTCtrl(object):
                                         DefaultValue: '{}'},
                        'latencyTime': {Description: 'Controller latency time',
                                        Type: float,
-                                       DefaultValue: 25e-7}
+                                       DefaultValue: 25e-7},
+                       'deltaReadout': {Description: DELTAREADOUT_DOC,
+                                        Type: bool,
+                                        DefaultValue: False},
+                       'maxStaleness': {Description: MAXSTALENESS_DOC,
+                                        Type: float,
+                                        DefaultValue: 1.0},
+                       'useEvents': {Description: USEEVENTS_DOC,
+                                     Type: bool,
+                                     DefaultValue: False},
+                       'armedStepMode': {Description: ARMEDSTEPMODE_DOC,
+                                         Type: bool,
+                                         DefaultValue: False},
+                       'dmaChannels': {Description: DMACHANNELS_DOC,
+                                       Type: str,
+                                       DefaultValue: '{}'}
                       }
 
+    ctrl_attributes = {
+        "dmaAllocation": {
+            Type: str,
+            Description: 'Transfer mechanism of each counter channel in the'
+                         ' last acquisition, in JSON format',
+            Access: ReadOnly
+        },
+        "instrumentation": {
+            Type: bool,
+            Description: INSTRUMENTATION_DOC,
+            Access: ReadWrite
+        },
+        "instrumentationData": {
+            Type: str,
+            Description: INSTRUMENTATIONDATA_DOC,
+            Access: ReadOnly
+        },
+        "traceDirectory": {
+            Type: str,
+            Description: TRACEDIRECTORY_DOC,
+            Access: ReadWrite
+        },
+    }
+
     axis_attributes = {
         "channelDevName": {
             Type: str,
@@ -69,12 +145,21 @@ class Ni660XCTCtrl(object):
     # buffer attribute name to be read in ReadOne
     # e.g. 'CountBuffer' or 'PositionBuffer'
     BUFFER_ATTR = None
+    # attribute used in the delta readout to ask the device to return the
+    # buffer starting from the given sample
+    BUFFER_OFFSET_ATTR = 'BufferOffset'
     APP_TYPE = None
     SAMPLE_TIMING_TYPE = None
+    # timeout in ms of the calls to the counter channels, None for the
+    # default one. The channels with a timeout get their own proxies.
+    CHANNEL_TIMEOUT = None
     CLK_SOURCE = None
-    # every QUERY_FILTER calls to ReadOne, the real read to the device will
-    # be executed
-    QUERY_FILTER = 1
+    # size of the buffer of the counter channels in the armed step mode
+    ARMED_BUFFER_SIZE = 2**16
+    # time in seconds for the started channels to be armed
+    START_TIMEOUT = 1.0
+    # properties of the channels used by the controller
+    CHANNEL_PROPERTIES = ['applicationType', 'counterName', 'DeviceName']
  
     direct_attributes = tuple()
     cached_attributes = ('sampleclocksource')
@@ -84,61 +169,134 @@ class Ni660XCTCtrl(object):
             msg = '%s does not define BUFFER_ATTR' % self.__class__.__name__
             raise Exception(msg)
         self.channelDevNamesList = self.channelDevNames.split(",")
-        self.dataBuff = {}
+        # the properties of all the channels are read at once, the channels
+        # are connected only when they are used
+        self._properties = get_device_properties(self.channelDevNamesList,
+                                                 self.CHANNEL_PROPERTIES)
+        for axis, name in enumerate(self.channelDevNamesList[1:], 2):
+            if name in self._properties:
+                self._check_app_type(axis, self._properties[name])
         self.channels = {}
         self.counterName = {}
         self.index = {}
-        self.delay_counter = {}
         self.aborted = {}
         self.attributes = {}
         self._repetitions = 0
+        self._integration_time = 0
         self.state = State.Unknown
         self.status = ""
-        self.ch_configured = {}
+        # last values written to the attributes of each channel
+        self._shadows = {}
+        # when to read the buffer of each counter channel
+        self._schedulers = {}
+        # attribute values to be written to each channel before the start
+        self._arm_plan = {}
         self._latency_time = self.latencyTime
-        self.current_ch_configured = 0
+        self._load_latency = 0
+        self._dma_channels = eval(self.dmaChannels)
+        # transfer mechanism of each counter axis
+        self._transfers = {}
+        # counter axes of the last acquisition, configured by PrepareOne
+        self._acq_axes = set()
         self.connect_terms_util = ConnectTerms(self.connectTerms)
+        # event subscriptions and last values pushed by the counter channels
+        self._event_ids = {}
+        self._event_data = {}
+        self._event_states = {}
+        # axes whose RUNNING state event of the current start arrived
+        self._event_started = set()
+        self._event_lock = threading.Lock()
+        # axes to be read in ReadAll and the buffers read by it
+        self._read_axes = []
+        self._prefetched = {}
+        # number of values returned so far by the most advanced counter and
+        # the values of the timer, preallocated for the whole acquisition
+        self._high_water = 0
+        self._timer_values = numpy.empty(0)
+        # axes to be queried in StateAll and the states read by it
+        self._state_axes = []
+        self._states = {}
+        # counter axes armed in the step acquisition, the samples of each
+        # one consumed so far and the samples of the current point
+        self._armed = set()
+        self._armed_offset = {}
+        self._armed_values = {}
+        self._armed_polled = False
+        self._timer_pending = False
+        self._start_pending = []
+        # axes started whose values were not all read yet, the acquisition
+        # is over when none is left
+        self._unread = set()
+        self._instrumentation = Instrumentation(inst)
+
+    def _channel_timeout(self, axis):
+        # the buffer of the timer is not read
+        return None if axis == 1 else self.CHANNEL_TIMEOUT
 
     def AddDevice(self, axis):
         channel_name = self.channelDevNamesList[axis-1]
         try:
-            self.channels[axis] = tango.DeviceProxy(channel_name)
+            self.channels[axis] = get_proxy(channel_name,
+                                            self._channel_timeout(axis))
         except Exception as e:
             msg = 'Exception when it created the tango devices: %s' % e
             self._log.error(msg)
 
-        # check the current application type
-        properties_names = ['applicationType','counterName', 'DeviceName']
-        properties = self.channels[axis].get_property(properties_names)
-        app_type = properties['applicationType'][0]
-
-
+        properties = self._properties.get(channel_name)
+        if properties is None:
+            # not found in the database, ask the device
+            properties = self.channels[axis].get_property(
+                self.CHANNEL_PROPERTIES)
+            if axis != 1:
+                self._check_app_type(axis, properties)
+        missing = [name for name in ('counterName', 'DeviceName')
+                   if not properties.get(name)]
+        if missing:
+            raise Exception('The channel %s does not define the %s '
+                            'properties' % (channel_name, ', '.join(missing)))
         counterName = properties['counterName'][0]
         deviceName = properties['DeviceName'][0]
         self.counterName[axis] = '/%s/%s' % (deviceName, counterName)
         self.index[axis] = 0
         self.aborted[axis] = False
-        self.delay_counter[axis] = 0
+        self._shadows[axis] = AttributeShadow(self.channels[axis],
+                                              channel_name,
+                                              self._instrumentation)
         # For input channels, initialize cache.
         if axis != 1:
-            if app_type != self.APP_TYPE:
-                msg = 'ERROR, The channel %r has wrong application type, ' \
-                      '%r != ' \
-                      '%r' % (axis, app_type, self.APP_TYPE)
-                self._log.error(msg)
-            self.ch_configured[axis] = False
+            self._schedulers[axis] = ReadScheduler(self.maxStaleness)
             self.attributes[axis] = {}
             for name in self.cached_attributes:
                 self.attributes[axis][name] = None
 
+    def _check_app_type(self, axis, properties):
+        app_type = properties.get('applicationType')
+        # an empty list if the property is not defined
+        app_type = app_type[0] if app_type else None
+        if app_type != self.APP_TYPE:
+            msg = 'ERROR, The channel %r has wrong application type, ' \
+                  '%r != ' \
+                  '%r' % (axis, app_type, self.APP_TYPE)
+            self._log.error(msg)
+
     def DeleteDevice(self, axis):
+        try:
+            self._disarm(axis)
+        except Exception as e:
+            self._log.debug('Could not stop the armed axis %d: %s', axis, e)
+        self._unsubscribe_events(axis)
+        self._shadows.pop(axis).close()
         # For input channels, remove cache.
         if axis != 1:
             self.attributes.pop(axis)
-            self.ch_configured.pop(axis)
+            self._schedulers.pop(axis)
         self.channels.pop(axis)
+        release_proxy(self.channelDevNamesList[axis-1],
+                      self._channel_timeout(axis))
+        self._transfers.pop(axis, None)
         if len(self.channels) == 0:
             self.connect_terms_util.delete_cards()
+            release_dma_channels(self)
 
     def GetAxisExtraPar(self, axis, name):
         self._log.debug("GetAxisExtraPar(%d, %s) entering..." % (axis, name))
@@ -164,24 +322,216 @@ class Ni660XCTCtrl(object):
         if axis == 1:
             raise Exception('Attribute %s is not foreseen for timer')
         if name in self.direct_attributes:
-            channel = self.channels[axis]
-            if channel.State() != tango.DevState.STANDBY:
-                channel.Stop()
-            self.channels[axis].write_attribute(name, value)
+            self._shadows[axis].configure([(name, value)])
         else:
+            if name == self.CLK_SOURCE and \
+                    value != self.attributes[axis].get(name):
+                # the counter is armed again with the new clock
+                self._disarm(axis)
             self.attributes[axis][name] = value
-            if name in self.cached_attributes:
-                self.ch_configured[axis] = False
 
-    def StateOneSingle(self, axis):
-        state = self.channels[axis].State()
+    def _subscribe_events(self, axis):
+        """Subscribe to the buffer and state change events of the axis
+        channel. In case of failure the axis keeps polling the device.
+
+        The events are delivered asynchronously, e.g. the STANDBY of the
+        Stop before a start may arrive after the start. The events of a
+        device arrive in order, so the ones before the RUNNING state of
+        the current start are stale and ignored, the device is polled
+        meanwhile.
+        """
+        channel = self.channels[axis]
+        event_ids = []
+
+        def push_buffer(event):
+            if event.err:
+                self._log.debug('Buffer event error on axis %d: %s',
+                                axis, event.errors)
+                return
+            with self._event_lock:
+                if axis in self._event_started:
+                    self._event_data[axis] = event.attr_value.value
+
+        def push_state(event):
+            if event.err:
+                self._log.debug('State event error on axis %d: %s',
+                                axis, event.errors)
+                return
+            state = event.attr_value.value
+            with self._event_lock:
+                if state == tango.DevState.RUNNING:
+                    self._event_started.add(axis)
+                if axis in self._event_started:
+                    self._event_states[axis] = state
+
+        try:
+            for attr_name, callback in ((self.BUFFER_ATTR, push_buffer),
+                                        ('State', push_state)):
+                event_id = channel.subscribe_event(
+                    attr_name, tango.EventType.CHANGE_EVENT, callback)
+                event_ids.append(event_id)
+        except Exception as e:
+            msg = ('Could not subscribe to events of axis %d, it will be '
+                   'polled: %s' % (axis, e))
+            self._log.warning(msg)
+            for event_id in event_ids:
+                channel.unsubscribe_event(event_id)
+            return
+        self._event_ids[axis] = event_ids
+
+    def _unsubscribe_events(self, axis):
+        event_ids = self._event_ids.pop(axis, [])
+        for event_id in event_ids:
+            try:
+                self.channels[axis].unsubscribe_event(event_id)
+            except Exception as e:
+                self._log.debug('Could not unsubscribe events of axis %d: %s',
+                                axis, e)
+        self._clear_events(axis)
+
+    def _clear_events(self, axis):
+        with self._event_lock:
+            self._event_data.pop(axis, None)
+            self._event_states.pop(axis, None)
+            self._event_started.discard(axis)
+
+    def _get_channel_state(self, axis):
+        """Get the Tango state of the axis channel, from the last state
+        event or the StateAll cycle if available, otherwise from the device.
+        """
+        state = self._event_states.get(axis)
+        if state is None:
+            state = self._states.pop(axis, None)
+            if isinstance(state, Exception):
+                raise state
+        if state is None:
+            start = self._instrumentation.begin()
+            state = self.channels[axis].State()
+            self._instrumentation.tango(self.channelDevNamesList[axis - 1],
+                                        'State', start)
+        return state
+
+    def PreStateAll(self):
+        self._state_axes = []
+        self._states = {}
+        self._armed_polled = False
+
+    def PreStateOne(self, axis):
+        # the timer state is simulated, there is no need to query it
+        if axis != 1:
+            self._state_axes.append(axis)
+
+    @instrumented
+    def StateAll(self):
+        """Query the state of all the counter axes concurrently. The states
+        are kept for this poll cycle, so StateOne is just a lookup.
+        """
+        armed = [axis for axis in self._state_axes if axis in self._armed]
+        if armed:
+            self._poll_armed(armed)
+        axes = [axis for axis in self._state_axes
+                if axis not in self._event_states and axis not in armed]
+        self._states = dict(zip(axes, parallel_map(self._read_state, axes)))
+
+    def _read_state(self, axis):
+        start = self._instrumentation.begin()
+        try:
+            return self.channels[axis].State()
+        except Exception as e:
+            return e
+        finally:
+            self._instrumentation.tango(
+                self.channelDevNamesList[axis - 1], 'State', start)
+
+    def _is_armed_mode(self):
+        return (self.armedStepMode and
+                self._synchronization == AcqSynch.SoftwareTrigger and
+                self.APP_TYPE == 'CICountEdgesChan')
+
+    def _disarm(self, axis):
+        """Stop the armed counter axis, it is armed again by its next step
+        acquisition.
+        """
+        if axis not in self._armed:
+            return
+        self._armed.discard(axis)
+        self._armed_offset.pop(axis, None)
+        self._armed_values.pop(axis, None)
+        start = self._instrumentation.begin()
+        self.channels[axis].Stop()
+        self._instrumentation.tango(self.channelDevNamesList[axis - 1], 'Stop',
+                                    start)
+
+    def _release_armed(self, axes):
+        """Stop the armed counter axes and release their DMA channels, the
+        ones of the other armed axes stay reserved.
+        """
+        for axis in axes:
+            self._disarm(axis)
+            self._transfers.pop(axis, None)
+        self._allocate_dma([])
+
+    def _read_armed(self, axis):
+        """Read the samples of the current point of the armed axis, the
+        counts of the gap since the previous point and of the integration,
+        if they already arrived.
+        """
+        offset = self._armed_offset[axis]
+        # the buffer keeps growing, only the new samples are read
+        data, index = self._read_buffer(axis, offset, delta=True)
+        if data is None or len(data) - index < 2:
+            return
+        self._armed_offset[axis] = offset + 2
+        self._armed_values[axis] = data[index:index + 2]
+
+    def _poll_armed(self, axes):
+        """Read the samples of the current point of the armed axes once
+        the timer finished the integration. Only the timer state is queried
+        while it integrates.
+        """
+        self._armed_polled = True
+        axes = [axis for axis in axes if axis not in self._armed_values]
+        if not axes:
+            return
+        start = self._instrumentation.begin()
+        timer_state = self.channels[1].State()
+        self._instrumentation.tango(self.channelDevNamesList[0], 'State',
+                                    start)
+        if timer_state == tango.DevState.RUNNING:
+            return
+
+        def read(axis):
+            try:
+                self._read_armed(axis)
+            except Exception as e:
+                self._armed_values[axis] = e
+
+        parallel_map(read, axes)
 
+    def _get_armed_state(self, axis):
+        if not self._armed_polled:
+            self._poll_armed([axis])
+        values = self._armed_values.get(axis)
+        if isinstance(values, Exception):
+            del self._armed_values[axis]
+            raise values
+        if values is None:
+            return State.Moving
+        return State.On
+
+    def StateOneSingle(self, axis):
         # Force State ON for Timer
         if axis == 1:
             state = State.On
             status = self.state_to_status[state]
             return state, status
 
+        if axis in self._armed:
+            state = self._get_armed_state(axis)
+            return state, self.state_to_status[state]
+
+        state = self._get_channel_state(axis)
+
         # RUNNING state translates directly to MOVING
         if state == tango.DevState.RUNNING:
             state = State.Moving
@@ -199,7 +549,7 @@ class Ni660XCTCtrl(object):
 
     def StateOneMultiple(self, axis):
         if axis != 1:
-            state = self.channels[axis].State()
+            state = self._get_channel_state(axis)
             # RUNNING state translates directly to MOVING
             if state == tango.DevState.RUNNING:
                 state = State.Moving
@@ -233,6 +583,7 @@ class Ni660XCTCtrl(object):
         status = self.state_to_status[state]
         return state, status
 
+    @instrumented
     def StateOne(self, axis):
         #self._log.debug('StateOne(%d): Entering...' % axis)
         if self._synchronization == AcqSynch.SoftwareTrigger:
@@ -241,66 +592,249 @@ class Ni660XCTCtrl(object):
             state, status = self.StateOneMultiple(axis)
         #self._log.debug('StateOne(%d): Returning (%s, %s)' %
         #                (axis, state, status))
+        self._instrumentation.state(axis, state)
         return state, status
 
+    @instrumented
     def PreStartAll(self):
         self._log.debug("PreStartAll(): Entering...")
         # Reset all the channel's Indexe
         self.index = {}
+        self._prefetched = {}
+        self._arm_plan = {}
+        self._high_water = 0
+        self._timer_pending = False
+        self._start_pending = []
+        self._acq_axes = set()
+        self._unread = set()
         # Apply connect terms
-        self.connect_terms_util.apply_connect_terms()
+        self._instrumentation.call('apply_connect_terms',
+                                   self.connect_terms_util.apply_connect_terms)
+        if self.useEvents:
+            for axis in self.channels:
+                if axis != 1 and axis not in self._event_ids:
+                    self._subscribe_events(axis)
         self._log.debug("PreStartAll(): Leaving...")
         return True
 
+    @instrumented
     def StartAll(self):
-        pass
+        """Write the configuration of all the channels and start the
+        counters concurrently and, once all of them are armed, the timer.
+        The trigger controller can be started right after, no pulse is
+        missed by the last counter started.
+        """
+        # the Pool calls PreStartOne and StartOne channel by channel, only
+        # here the configuration of all of them is known
+        # the armed counters left out of this acquisition, e.g. removed
+        # from the measurement group, must not keep counting
+        unused = self._armed - self._acq_axes
+        if unused:
+            self._release_armed(sorted(unused))
+        if self._arm_plan:
+            self._arm_channels()
+        counters, self._start_pending = self._start_pending, []
+        if counters:
+            parallel_map(self._start_channel, counters)
+            self._wait_armed(counters)
+            for axis in counters:
+                if self._is_armed_mode():
+                    self._armed.add(axis)
+                    self._armed_offset[axis] = 0
+                elif self._synchronization != AcqSynch.SoftwareTrigger:
+                    self._schedulers[axis].start(self._sample_period(),
+                                                 self._repetitions)
+        if self._timer_pending:
+            self._timer_pending = False
+            self._start_channel(1)
+
+    def _wait_armed(self, axes):
+        """Wait until the started channels are armed, i.e. RUNNING, or
+        already finished. The Start is synchronous, so ON comes from this
+        start.
+        """
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while True:
+            states = parallel_map(self._read_state, axes)
+            pending = []
+            for axis, state in zip(axes, states):
+                if isinstance(state, Exception):
+                    raise state
+                if state == tango.DevState.FAULT:
+                    raise Exception('Channel %s failed to start' %
+                                    self.channelDevNamesList[axis - 1])
+                if state not in (tango.DevState.RUNNING, tango.DevState.ON):
+                    pending.append(axis)
+            if not pending:
+                return
+            if time.monotonic() > deadline:
+                names = [self.channelDevNamesList[axis - 1]
+                         for axis in pending]
+                raise Exception('Channels %s not armed after %g s' %
+                                (', '.join(names), self.START_TIMEOUT))
+            axes = pending
+            time.sleep(0.001)
 
+    @instrumented
     def PreStartOne(self, axis, value):
         self._log.debug("PreStartOne(%d, %f): Entering..." % (axis, value))
         self.index[axis] = 0
         self.aborted[axis] = False
-        self.delay_counter[axis] = 0
+        self._unread.add(axis)
         if axis != 1:
-            channel = self.channels[axis]
-            if channel.State() != tango.DevState.STANDBY:
-                channel.Stop()
-            if self.ch_configured[axis] == False:
-                attributes = self.attributes[axis]
-                clk_src = attributes[self.CLK_SOURCE]
-                if clk_src != None:
-                    channel.write_attribute(self.CLK_SOURCE, clk_src)
-                else:
-                    raise Exception('Undefined %r attribute' %self.CLK_SOURCE)
+            self._schedulers[axis].reset()
+            self._armed_values.pop(axis, None)
+            # after PrepareOne or the previous start there is nothing to
+            # write, unless the configuration changed
+            self._configure_counter(axis)
+            self._acq_axes.add(axis)
+        else:
+            self._timer_values = numpy.full(self._repetitions,
+                                            self._integration_time)
+            # the returned views must not be modified
+            self._timer_values.setflags(write=False)
+        return True
 
-                channel.write_attribute("SampleTimingType",
-                                        self.SAMPLE_TIMING_TYPE)
-                repetitions = self._repetitions
+    def _configure_counter(self, axis):
+        """Add the configuration of the counter axis to the values to be
+        written before the start.
+        """
+        clk_src = self.attributes[axis][self.CLK_SOURCE]
+        if clk_src is None:
+            raise Exception('Undefined %r attribute' % self.CLK_SOURCE)
 
-                # To configure the buffer with 2 points in a single
-                # acquisition with hardware trigger in CICountEdgesChan case
-                if self.APP_TYPE == 'CICountEdgesChan' and self._repetitions == 1:
-                    repetitions = int(2)
+        if self._is_armed_mode():
+            if axis in self._armed and \
+                    self._armed_offset[axis] + 2 > self.ARMED_BUFFER_SIZE:
+                # no room for the samples of another point, the counter is
+                # armed again with an empty buffer
+                self._disarm(axis)
+            if axis not in self._armed:
+                # two samples per point, when the timer output rises
+                # and falls, counting only while it is high
+                self._arm(axis, [
+                    (self.CLK_SOURCE, clk_src),
+                    ('SampleTimingType', self.SAMPLE_TIMING_TYPE),
+                    ('SampleMode', 'ContSamps'),
+                    ('SampPerChan', self.ARMED_BUFFER_SIZE),
+                    ('PauseTriggerType', 'DigLvl'),
+                    ('PauseTriggerSource', clk_src),
+                    ('PauseTriggerWhen', 'Low')])
+            return
+        elif axis in self._armed:
+            self._disarm(axis)
+            self._arm(axis, [('SampleMode', 'Finite'),
+                             ('PauseTriggerType', 'None')])
 
-                channel.write_attribute('SampPerChan', int(repetitions))
+        repetitions = self._repetitions
 
-                #TODO: Improve, set DMA to firsts 4 devices
-                #if self.current_ch_configured > 4:
-                #    transfer = 'Interrupts'
-                #    channel.write_attribute('DataTransferMechanism', transfer)
+        # To configure the buffer with 2 points in a single
+        # acquisition with hardware trigger in CICountEdgesChan case
+        if self.APP_TYPE == 'CICountEdgesChan' and self._repetitions == 1:
+            repetitions = int(2)
 
-                transfer = 'Interrupts'
-                channel.write_attribute('DataTransferMechanism', transfer)
+        # DataTransferMechanism is added when arming the channels,
+        # once the DMA channels are allocated
+        self._arm(axis, [(self.CLK_SOURCE, clk_src),
+                         ('SampleTimingType', self.SAMPLE_TIMING_TYPE),
+                         ('SampPerChan', int(repetitions))])
 
-                self.current_ch_configured += 1
-        return True
+    def _arm(self, axis, attr_values):
+        """Add attribute values to be written to the axis channel before it
+        is started. The values of all the channels are written together by
+        _arm_channels, in StartAll.
+        """
+        self._arm_plan.setdefault(axis, []).extend(attr_values)
+
+    def _sample_period(self):
+        """Expected time between two samples of the counter channels."""
+        return self._integration_time + max(self._load_latency,
+                                            self._latency_time)
 
+    def _card(self, axis):
+        return self.counterName[axis].strip('/').split('/')[0]
+
+    def _allocate_dma(self, axes):
+        """Allocate the free DMA channels of each card to the counter
+        channels in the axis order, the rest use interrupts. The DMA
+        channels are reserved for the whole process, so the controllers
+        sharing a card do not over-subscribe it. The armed channels not
+        configured again keep their transfer mechanism.
+        """
+        kept = [(axis, self._card(axis), self._transfers[axis])
+                for axis in sorted(self._armed)
+                if axis not in axes and axis in self._transfers]
+        channels = [(axis, self._card(axis)) for axis in sorted(axes)]
+        allocation = allocate_dma_channels(self, channels, self._dma_channels,
+                                           kept)
+        self._transfers = {axis: transfer for axis, _, transfer in kept}
+        self._transfers.update(allocation)
+        return allocation
+
+    def GetCtrlPar(self, parameter):
+        parameter = parameter.lower()
+        if parameter == 'dmaallocation':
+            return json.dumps({self.channelDevNamesList[axis - 1]: transfer
+                               for axis, transfer
+                               in sorted(self._transfers.items())})
+        elif parameter == 'instrumentation':
+            return self._instrumentation.enabled
+        elif parameter == 'instrumentationdata':
+            return json.dumps(self._instrumentation.dump())
+        elif parameter == 'tracedirectory':
+            return self._instrumentation.trace_directory
+        return super().GetCtrlPar(parameter)
+
+    def SetCtrlPar(self, parameter, value):
+        parameter = parameter.lower()
+        if parameter == 'instrumentation':
+            self._instrumentation.enable(value)
+        elif parameter == 'tracedirectory':
+            self._instrumentation.set_trace_directory(value)
+        else:
+            super().SetCtrlPar(parameter, value)
+
+    def _arm_channels(self):
+        """Write the attribute values added in PreStartOne to all the
+        channels concurrently. Only the values which changed since the last
+        acquisition are written, in a single call per channel, and the
+        channel is stopped only if needed.
+        """
+        plan, self._arm_plan = self._arm_plan, {}
+        counters = [axis for axis in plan if axis != 1]
+        if counters:
+            allocation = self._allocate_dma(counters)
+            for axis, transfer in allocation.items():
+                plan[axis].append(('DataTransferMechanism', transfer))
+
+        def configure(item):
+            axis, attr_values = item
+            self._shadows[axis].configure(attr_values)
+
+        parallel_map(configure, plan.items())
+
+    @instrumented
     def StartOne(self, axis, value):
         #self._log.debug("StartOne(%d, %f): Entering..." % (axis, value))
-        if (axis != 1 or self._synchronization == AcqSynch.SoftwareTrigger):
-            channel = self.channels[axis]
-            channel.start()
+        if axis in self._armed:
+            # already counting, gated by the timer
+            return
+        # all the channels are started in StartAll, the timer the last
+        if axis != 1:
+            self._start_pending.append(axis)
+        elif self._synchronization == AcqSynch.SoftwareTrigger:
+            self._timer_pending = True
         #self._log.debug("StartOne(%d, %f): Leaving..." % (axis, value))
 
+    def _start_channel(self, axis):
+        channel = self.channels[axis]
+        # forget the values pushed by the previous acquisition
+        self._clear_events(axis)
+        start = self._instrumentation.begin()
+        channel.start()
+        self._instrumentation.tango(self.channelDevNamesList[axis - 1],
+                                    'Start', start)
+
     def PreLoadOne(self, axis, value, repetitions, latency):
         #self._log.debug("PreLoadOne(%d, %f, %d, %f): Entering...",
         #                axis, value, repetitions, latency)
@@ -308,12 +842,15 @@ class Ni660XCTCtrl(object):
         #                axis, value, repetitions, latency)
         return True
 
+    @instrumented
     def LoadOne(self, axis, value, repetitions, latency):
         self._log.debug("LoadOne(%d, %f, %r, %f): Entering...", axis, value,
                         repetitions, latency)
+        # an acquisition starts with its load
+        self._instrumentation.start_acquisition(value * repetitions)
         self._repetitions = repetitions
         self._integration_time = value
-        self.current_ch_configured = 0
+        self._load_latency = latency
         if axis != 1:
             if self._synchronization in [AcqSynch.HardwareTrigger,
                                          AcqSynch.HardwareGate]:
@@ -323,57 +860,210 @@ class Ni660XCTCtrl(object):
       
         elif self._synchronization in [AcqSynch.SoftwareTrigger,
                                        AcqSynch.SoftwareGate]:
-            high_time = value
-            low_time = self._latency_time
-            if high_time > self.max_time:
-                max_integ_time = self.min_time + self.max_time
-                msg = ("Integration time not supported. Max = %f" %
-                       max_integ_time)
-                raise Exception(msg)
-            channel = self.channels[axis]
-            if channel.State() != tango.DevState.STANDBY:
-                channel.Stop()
-            channel.write_attribute('SampleTimingType', 'Implicit')
-            channel.write_attribute('SampPerChan', int(self._repetitions))
-            channel.write_attribute('HighTime', high_time)
-            channel.write_attribute('LowTime', low_time)
+            self._shadows[axis].configure(self._timer_config(value))
 
         #self._log.debug("LoadOne(%d, %f, %d, %f): Leaving...",
         #                axis, value, repetitions, latency)
 
+    def _timer_config(self, value):
+        high_time = value
+        low_time = self._latency_time
+        if high_time > self.max_time:
+            max_integ_time = self.min_time + self.max_time
+            msg = ("Integration time not supported. Max = %f" %
+                   max_integ_time)
+            raise Exception(msg)
+        return [('SampleTimingType', 'Implicit'),
+                ('SampPerChan', int(self._repetitions)),
+                ('HighTime', high_time),
+                ('LowTime', low_time)]
+
+    @instrumented
+    def PrepareOne(self, axis, value, repetitions, latency, nb_starts):
+        """Configure, once for the nb_starts acquisitions, everything that
+        does not change between them: the terminal routes, the timer and
+        the clock source, timing type, buffer size and transfer mechanism
+        of the counters of the previous acquisition. Each start then only
+        writes what changed since, usually nothing.
+
+        The channels may have been initialized or written by others since
+        the previous measurement, so their shadows are forgotten and the
+        configuration is written again.
+        """
+        self._log.debug("PrepareOne(%d, %f, %r, %f, %r): Entering...", axis,
+                        value, repetitions, latency, nb_starts)
+        self._repetitions = repetitions
+        self._integration_time = value
+        self._load_latency = latency
+        # the routes may have been reset, e.g. by an Init of the card
+        self._instrumentation.call('apply_connect_terms',
+                                   self.connect_terms_util.apply_connect_terms,
+                                   True)
+        for shadow in self._shadows.values():
+            shadow.invalidate()
+        self._arm_plan = {}
+        if axis == 1 and self._synchronization in [AcqSynch.SoftwareTrigger,
+                                                   AcqSynch.SoftwareGate]:
+            self._arm(axis, self._timer_config(value))
+        for counter in sorted(self._acq_axes):
+            if counter in self.channels:
+                self._configure_counter(counter)
+        if self._arm_plan:
+            self._arm_channels()
+
     def AbortOne(self, axis):
         # In case of Software _synchronization Stop the timer as well
-        if axis != 1 or self._synchronization == AcqSynch.SoftwareTrigger:
+        if axis in self._armed:
+            self._release_armed([axis])
+        elif axis != 1 or self._synchronization == AcqSynch.SoftwareTrigger:
             channel = self.channels[axis]
-            if channel.State() != tango.DevState.STANDBY:
+            name = self.channelDevNamesList[axis - 1]
+            start = self._instrumentation.begin()
+            state = channel.State()
+            self._instrumentation.tango(name, 'State', start)
+            if state != tango.DevState.STANDBY:
+                start = self._instrumentation.begin()
                 channel.Stop()
+                self._instrumentation.tango(name, 'Stop', start)
         self.aborted[axis] = True
+        self._instrumentation.end_acquisition()
 
     def _calculate(self, axis, data, index):
         return data[index:]
+
+    def _read_buffer(self, axis, index, delta=None):
+        """Read the buffer attribute of the axis channel.
+
+        When the axis is subscribed to events the last pushed buffer, if
+        any, is returned without accessing the device. In the delta readout the
+        offset is written and the buffer read in a single network call, so
+        the device returns only the samples acquired from index on.
+        Otherwise the whole buffer is read. The delta readout is used if
+        configured, unless delta is given.
+
+        Returns the data and the index of the first new sample in it.
+        """
+        if axis in self._event_ids:
+            with self._event_lock:
+                data = self._event_data.get(axis)
+            if data is not None:
+                return data, index
+        channel = self.channels[axis]
+        trace_start = self._instrumentation.begin()
+        start = time.monotonic()
+        if delta is None:
+            delta = self.deltaReadout
+        if delta:
+            offset = [(self.BUFFER_OFFSET_ATTR, index)]
+            attr_values = channel.write_read_attributes(offset,
+                                                        [self.BUFFER_ATTR])
+            data, index, acquired = attr_values[0].value, 0, index
+            operation = 'write_read_attributes'
+        else:
+            data, acquired = channel.read_attribute(self.BUFFER_ATTR).value, 0
+            operation = 'read_attribute'
+        self._instrumentation.tango(self.channelDevNamesList[axis - 1],
+                                    operation, trace_start,
+                                    0 if data is None else data.nbytes)
+        if data is not None:
+            acquired += len(data)
+            self._schedulers[axis].record(time.monotonic() - start,
+                                          len(data), acquired)
+        return data, index
+
+    def _is_read_due(self, axis):
+        """Tell if the buffer of the axis channel is worth reading now,
+        the pushed buffers are always used.
+        """
+        if axis in self._event_ids:
+            return True
+        return self._schedulers[axis].due(self.index[axis], self.deltaReadout)
+
+    def _get_buffer(self, axis, index):
+        """Get the buffer of the axis channel as returned by _read_buffer.
+
+        The buffer already read by ReadAll is used if available, otherwise
+        it is read now. Returns None if the read is not due yet.
+        """
+        if axis in self._prefetched:
+            result = self._prefetched.pop(axis)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        if not self._is_read_due(axis):
+            return None
+        return self._read_buffer(axis, index)
+
+    def PreReadAll(self):
+        self._read_axes = []
+        self._prefetched = {}
+
+    def PreReadOne(self, axis):
+        if axis != 1:
+            self._read_axes.append(axis)
+
+    @instrumented
+    def ReadAll(self):
+        """Read the buffers of all the counter axes concurrently, so the
+        readout takes as long as the slowest channel. ReadOne then only
+        processes the already read data.
+        """
+        software = self._synchronization == AcqSynch.SoftwareTrigger
+        axes = []
+        for axis in self._read_axes:
+            if axis not in self.index or axis in self._armed:
+                continue
+            if not software and self.index[axis] == self._repetitions:
+                continue
+            if self._is_read_due(axis):
+                axes.append(axis)
+            else:
+                self._prefetched[axis] = None
+
+        def read(axis):
+            index = 0 if software else self.index[axis]
+            try:
+                return self._read_buffer(axis, index)
+            except Exception as e:
+                return e
+
+        for axis, result in zip(axes, parallel_map(read, axes)):
+            self._prefetched[axis] = result
         
     def ReadOneSingle(self, axis):
         index = self.index[axis]
         #self._log.debug('ReadOne(%d) index = %d' % (axis, index))
         if axis == 1:
             data = [self._integration_time]
+        elif axis in self._armed:
+            data = numpy.array([0])
+            try:
+                if axis not in self._armed_values:
+                    self._poll_armed([axis])
+                values = self._armed_values.get(axis)
+                if isinstance(values, Exception):
+                    raise values
+                if values is not None:
+                    data = self._calculate(axis, values, 1)
+            except Exception as e:
+                msg = ('ReadOne(%d): Exception while reading buffer: %s'
+                       % (axis, e))
+                self._log.error(msg)
         else:
             data = numpy.array([0])
-            self.delay_counter[axis] += 1
-            self.delay_counter[axis] %= self.QUERY_FILTER
-            if self.delay_counter[axis] == 0:
-                try:
-                    channel = self.channels[axis]
-                    data = channel.read_attribute(self.BUFFER_ATTR).value
-                    if data is None:
-                        data = numpy.array([0])
-                except Exception as e:
-                    msg = ('ReadOne(%d): Exception while reading' +
-                           ' buffer: %s' % (axis, e))
-                    self._log.error(msg)
-                if len(data) == 2:
-                    index = 1
-                    data = self._calculate(axis, data, index)
+            try:
+                buff = self._get_buffer(axis, 0)
+                if buff is not None:
+                    data = buff[0]
+                if data is None:
+                    data = numpy.array([0])
+            except Exception as e:
+                msg = ('ReadOne(%d): Exception while reading buffer: %s'
+                       % (axis, e))
+                self._log.error(msg)
+            if len(data) == 2:
+                index = 1
+                data = self._calculate(axis, data, index)
         # values coming from CountBuffer are of type DevULong cast it to float
         data = float(data[0])
         sardana_value = SardanaValue(data)
@@ -388,37 +1078,44 @@ class Ni660XCTCtrl(object):
             return []
 
         if axis == 1:
-            max_index = max(self.index.values())
-            rep = max_index - index
-            data = numpy.tile(self._integration_time, rep)
+            data = self._timer_values[index:self._high_water]
         else:
             data = numpy.array([])
-            self.delay_counter[axis] += 1
-            self.delay_counter[axis] %= self.QUERY_FILTER
-            if self.delay_counter[axis] == 0:
-                try:
-                    channel = self.channels[axis]
-                    data = channel.read_attribute(self.BUFFER_ATTR).value
-                    if data is None:
-                        data = numpy.array([])
-                except Exception as e:
-                    msg = ('ReadOne(%d): Exception while reading buffer: %s'
-                           % (axis, e))
-                    self._log.error(msg)
-                if len(data) > 0:
-                    data = self._calculate(axis, data, index)
+            offset = index
+            try:
+                buff = self._get_buffer(axis, index)
+                if buff is not None:
+                    data, offset = buff
+                if data is None:
+                    data = numpy.array([])
+            except Exception as e:
+                msg = ('ReadOne(%d): Exception while reading buffer: %s'
+                       % (axis, e))
+                self._log.error(msg)
+            if len(data) > 0:
+                data = self._calculate(axis, data, offset)
+            self._high_water = max(self._high_water, index + len(data))
         self.index[axis] = index + len(data)
         # Unused variable
         # idx = range(index, self.index[axis])
-        data = data.tolist()
-        return data
+        # the Pool translates each value on its own, so plain floats
+        return data.tolist()
 
+    @instrumented
     def ReadOne(self, axis):
         #self._log.debug("ReadOne(%d): Entering...", axis)
-        if self._synchronization == AcqSynch.SoftwareTrigger:
+        software = self._synchronization == AcqSynch.SoftwareTrigger
+        if software:
             ret = self.ReadOneSingle(axis)
         else:
             ret = self.ReadOneMultiple(axis)
+        self._instrumentation.mark_acquisition()
+        if axis in self._unread and \
+                (software or self.index[axis] >= self._repetitions):
+            self._unread.discard(axis)
+            if not self._unread:
+                # the last readout of the acquisition
+                self._instrumentation.end_acquisition()
         #self._log.debug('ReadOne(%d): Leaving....', axis)
         return ret
 
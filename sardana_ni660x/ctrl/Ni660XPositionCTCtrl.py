@@ -1,10 +1,11 @@
-import tango
+import numpy
 
 from sardana import DataAccess
 from sardana.pool.controller import (CounterTimerController,
                                      Memorize, NotMemorized, Memorized)
 from sardana.pool.controller import Type, Access
 from sardana_ni660x.ctrl.Ni660XCTCtrl import Ni660XCTCtrl
+from sardana_ni660x.proxies import SharedAttribute
 
 
 ReadWrite = DataAccess.ReadWrite
@@ -18,10 +19,11 @@ class Ni660XPositionCTCtrl(Ni660XCTCtrl, CounterTimerController):
     "This class is the Ni600X position capture Sardana CounterTimerController"
 
     BUFFER_ATTR = 'PositionBuffer'
-    QUERY_FILTER = 1
     SAMPLE_TIMING_TYPE = 'SampClk'
     APP_TYPE = 'CIAngEncoderChan'
     CLK_SOURCE = 'sampleclocksource'
+    # readout of a 60000 samples buffer takes approx. 10 seconds
+    CHANNEL_TIMEOUT = 120000
 
     axis_attributes = dict(Ni660XCTCtrl.axis_attributes)
     axis_attributes.update({
@@ -65,14 +67,33 @@ class Ni660XPositionCTCtrl(Ni660XCTCtrl, CounterTimerController):
     def AddDevice(self, axis):
         Ni660XCTCtrl.AddDevice(self, axis)
         if axis != 1:
-            #readount ot 60000 buffer takes aprox 10 seconds
-            self.channels[axis].set_timeout_millis(120000)
             self.attributes[axis]['sign'] = 1
             self.attributes[axis]['initialpos'] = None
             self.attributes[axis]['initialposattr'] = ""
             self.attributes[axis]['initialposattrproxy'] = None
             self.attributes[axis]['initialposvalue'] = 0
 
+    def DeleteDevice(self, axis):
+        if axis != 1:
+            self._release_initial_pos_attr(axis)
+        Ni660XCTCtrl.DeleteDevice(self, axis)
+
+    def _release_initial_pos_attr(self, axis):
+        proxy = self.attributes[axis]['initialposattrproxy']
+        if proxy is not None:
+            proxy.release()
+        self.attributes[axis]['initialposattrproxy'] = None
+
+    def PrepareOne(self, axis, value, repetitions, latency, nb_starts):
+        Ni660XCTCtrl.PrepareOne(self, axis, value, repetitions, latency,
+                                nb_starts)
+        # the initial position is read on each start, the motor moves in
+        # between, but the device is connected beforehand
+        for counter in self._acq_axes:
+            proxy = self._get_initial_pos_attr(counter)
+            if proxy is not None:
+                proxy.connect()
+
     def PreStartOne(self, axis, value):
         if Ni660XCTCtrl.PreStartOne(self, axis, value) and axis != 1:
             initial_pos_value = self._get_initial_pos_value(axis)
@@ -84,28 +105,35 @@ class Ni660XPositionCTCtrl(Ni660XCTCtrl, CounterTimerController):
         initial_pos_value = axis_attr.get('initialpos')
         if initial_pos_value is None:
             initial_pos_value = 0
-            proxy = axis_attr['initialposattrproxy']
-            attr_name = axis_attr['initialposattr']
-            if proxy is None and attr_name:
-                proxy = tango.AttributeProxy(attr_name)
-                # save in cache to avoid recreating AttributeProxy
-                axis_attr['initialposattrproxy'] = proxy
+            proxy = self._get_initial_pos_attr(axis)
             if proxy is not None:
                 try:
                     initial_pos_value = float(proxy.read().value)
                 except ValueError:
-                    msg = "initialPosAttr (%s) is not float" % attr_name
+                    msg = "initialPosAttr (%s) is not float" % proxy.name
                     raise Exception(msg)
         return initial_pos_value
 
+    def _get_initial_pos_attr(self, axis):
+        axis_attr = self.attributes[axis]
+        proxy = axis_attr['initialposattrproxy']
+        attr_name = axis_attr['initialposattr']
+        if proxy is None and attr_name:
+            proxy = SharedAttribute(attr_name)
+            # save in cache to avoid recreating the attribute
+            axis_attr['initialposattrproxy'] = proxy
+        return proxy
+
     def _calculate(self, axis, data, index):
-        data = data[index:]
-        if self.attributes[axis]["sign"] == -1:
-            data = data * -1
-        data = data + self.attributes[axis]["initialposvalue"]
+        attributes = self.attributes[axis]
+        # a single float64 copy, the sign and the offset are applied in place
+        data = numpy.array(data[index:], dtype=numpy.float64)
+        if attributes["sign"] == -1:
+            numpy.negative(data, out=data)
+        data += attributes["initialposvalue"]
         return data
 
     def SetAxisExtraPar(self, axis, name, value):
         super().SetAxisExtraPar(axis, name, value)
         if name.lower() == 'initialposattr':
-            self.attributes[axis]['initialposattrproxy'] = None
+            self._release_initial_pos_attr(axis)
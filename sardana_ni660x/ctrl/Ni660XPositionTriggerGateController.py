@@ -1,9 +1,21 @@
+import json
+
+import numpy
 import PyTango
-import taurus
 from sardana import State
-from sardana.pool.controller import (TriggerGateController, Type, Description)
+from sardana.pool.pooldefs import SynchDomain, SynchParam
+from sardana.pool.controller import (TriggerGateController, Type, Description,
+                                     Access, DataAccess)
 from sardana.tango.core.util import from_tango_state_to_state
 
+from sardana_ni660x.instrumentation import (INSTRUMENTATION_DOC,
+                                            INSTRUMENTATIONDATA_DOC,
+                                            TRACEDIRECTORY_DOC,
+                                            Instrumentation, instrumented)
+from sardana_ni660x.proxies import get_proxy, release_proxy
+from sardana_ni660x.utils import compile_pulse_train, is_uniform
+from sardana_ni660x.utils import AttributeShadow, parallel_map
+
 POSITIONDEVNAMES_DOC = ('Comma separated Ni660XCounter Tango device names ',
                        ' configured with CIAngEncoderChan as applicationType.',
                        ' They are used to generate (while changing position)',
@@ -35,9 +47,27 @@ ni6602 = {"ctr0": {"src": "PFI39", "gate": "PFI38", "out": "PFI36", "aux": "PFI3
           "ctr6": {"src": "PFI15", "gate": "PFI14", "out": "PFI12", "aux": "PFI13"},
           "ctr7": {"src": "PFI11", "gate": "PFI10", "out": "PFI8",  "aux": "PFI9"}}
 
+ReadWrite = DataAccess.ReadWrite
+ReadOnly = DataAccess.ReadOnly
+
+# encoder edges counted per cycle in each decoding
+DECODING_FACTORS = {'X1': 1, 'X2': 2, 'X4': 4}
+
 class Ni660XPositionTriggerGateController(TriggerGateController):
 
     MaxDevice = 32
+    # minimum high and low ticks of a pulse
+    min_ticks = 2
+    # attributes with the high and low ticks of each pulse, used when the
+    # pulses of a non-uniform synchronization differ. They require the
+    # Ni660XCounter devices to support buffered implicit pulse generation.
+    HIGH_TICKS_ATTR = 'HighTicksBuffer'
+    LOW_TICKS_ATTR = 'LowTicksBuffer'
+    # user units per encoder edge, set with the resolution axis parameter.
+    # It cannot be read from the encoder channel: PreStartOne configures it
+    # in Ticks with one pulse per revolution, and the user units per tick
+    # depend on the mechanics of the motor and encoder, not on the channel.
+    default_resolution = .25
 
     ctrl_properties = {
         'positionDevNames': {
@@ -49,6 +79,23 @@ class Ni660XPositionTriggerGateController(TriggerGateController):
             Description: GENERATORDEVNAMES_DOC
         }
     }
+    ctrl_attributes = {
+        "instrumentation": {
+            Type: bool,
+            Description: INSTRUMENTATION_DOC,
+            Access: ReadWrite
+        },
+        "instrumentationData": {
+            Type: str,
+            Description: INSTRUMENTATIONDATA_DOC,
+            Access: ReadOnly
+        },
+        "traceDirectory": {
+            Type: str,
+            Description: TRACEDIRECTORY_DOC,
+            Access: ReadWrite
+        },
+    }
     # relation one to one between the Ni660XCounter Tango device attributes
     # and the Sardana TriggerGate element attributes
     attribute_relations = {
@@ -77,94 +124,112 @@ class Ni660XPositionTriggerGateController(TriggerGateController):
             raise Exception(msg)
         self.attributes = {}
         self._ch_pos_attr = ['outputevenbehaviour', 'outputeventterminal',
-                             'initialpos', 'zindexval', 'units', 'decoding',
+                             'initialpos', 'zindexval', 'units',
                              'pulsesperrevolution']
         self._ch_gen_attr = ['repetitions', 'offset', 'active_period',
                              'passive_period']
+        # axes started whose generation did not finish yet, the
+        # acquisition is over when none is left
+        self._generating = set()
+        self._instrumentation = Instrumentation(inst)
 
     def AddDevice(self, axis):
-        """Add axis to the controller, basically creates a taurus device of
-        the corresponding channel.
+        """Add axis to the controller, basically creates the tango devices
+        of the corresponding channels. The last values written to their
+        attributes are kept in a shadow, so only the changes are written.
         """
         position_name = self.position_names[axis - 1]
         self.attributes[axis] = tg = {}
+        chn_str = None
         try:
-            ch_position = tg['ch_position'] = taurus.Device(position_name)
+            ch_position = tg['ch_position'] = get_proxy(position_name)
+            tg['position_shadow'] = AttributeShadow(ch_position,
+                                                    position_name,
+                                                    self._instrumentation)
             prop_dict = ch_position.get_property(['deviceName', 'counterName'])
-            attr = ch_position.getAttribute('OutputEventTerminal')
             counter_name = ni6602.get(prop_dict.get('counterName')[0])
             device_name = prop_dict.get('deviceName')[0]
             chn_str = "/%s/%s" % (device_name, counter_name.get("out"))
-            attr.write(chn_str)
+            tg['position_shadow'].configure([('OutputEventTerminal',
+                                              chn_str)])
         except Exception as e:
-            msg = 'Could not create taurus device: %s, details: %s' %\
+            msg = 'Could not create tango device: %s, details: %s' %\
                   (position_name, e)
             self._log.debug(msg)
         generator_name = self.generator_names[axis - 1]
         try:
-            ch_generator =tg['ch_generator'] = taurus.Device(generator_name)
-            prop_dict = ch_generator.get_property('counterName')
-            attr = ch_generator.getAttribute('SourceTerminal')
-            attr.write(chn_str)
-
+            ch_generator = tg['ch_generator'] = get_proxy(generator_name)
+            tg['generator_shadow'] = AttributeShadow(ch_generator,
+                                                     generator_name,
+                                                     self._instrumentation)
+            tg['generator_shadow'].configure([('SourceTerminal', chn_str)])
         except Exception as e:
-            msg = 'Could not create taurus device: %s, details: %s' %\
+            msg = 'Could not create tango device: %s, details: %s' %\
                   (generator_name, e)
             self._log.debug(msg)
-        tg['resolution'] = .25
+        tg['resolution'] = self.default_resolution
+        # X1 unless set with the decoding axis parameter
+        tg['decoding'] = 'X1'
+        tg['buffered'] = False
 
     def DeleteDevice(self, axis):
-        """Remove axis from the controller, basically forgets about the taurus
-        device of the corresponding channel."""
-        self.attributes.pop(axis)
+        """Remove axis from the controller, basically forgets about the tango
+        devices of the corresponding channels."""
+        tg = self.attributes.pop(axis)
+        for name in ('position_shadow', 'generator_shadow'):
+            if name in tg:
+                tg[name].close()
+        if 'ch_position' in tg:
+            release_proxy(self.position_names[axis - 1])
+        if 'ch_generator' in tg:
+            release_proxy(self.generator_names[axis - 1])
 
-    def PreStartOne(self, axis, value):
-        """Prepare axis for generation.
+    @instrumented
+    def PreStartOne(self, axis):
+        """Prepare axis for generation. Each channel is configured in a
+        single call, and stopped only if anything has to be written.
         """
         tg = self.attributes[axis]
-        self._log.debug('PreStartOne(%d, %f): entering...' % (axis, value))
-        ch_generator = tg['ch_generator']
-        state = ch_generator.getAttribute('State')
-        sta = from_tango_state_to_state(state.read().value)
-        if sta is State.On:
-            ch_generator.stop()
-        ch_position =tg['ch_position']
-        state = ch_position.getAttribute('State')
-        sta = from_tango_state_to_state(state.read().value)
-        if sta is State.On:
-            ch_position.stop()
+        self._log.debug('PreStartOne(%d): entering...' % axis)
         #configure the position source counter channel
-        output_behaviour = ch_position.getAttribute('OutputEventBehaviour')
-        output_behaviour.write('Pulse')
-        zindex = ch_position.getAttribute('ZindexVal')
-        zindex.write(4294967294)
-        initialpos = ch_position.getAttribute('InitialPos')
-        initialpos.write(4294967294)
-        units = ch_position.getAttribute('Units')
-        units.write('Ticks')
-        decoding = ch_position.getAttribute('Decoding')
-        decoding.write('X1')
-        pulsesperrevolution = ch_position.getAttribute('PulsesPerRevolution')
-        pulsesperrevolution.write(1)
+        position_config = [('OutputEventBehaviour', 'Pulse'),
+                           ('ZindexVal', 4294967294),
+                           ('InitialPos', 4294967294),
+                           ('Units', 'Ticks'),
+                           ('Decoding', tg['decoding']),
+                           ('PulsesPerRevolution', 1)]
         # configure the trigger counter channel
-        sample_mode = ch_generator.getAttribute('SampleMode')
-        sample_mode.write('Finite')
-        sample_timing_type = ch_generator.getAttribute('SampleTimingType')
-        sample_timing_type.write('Implicit')
-        self._log.debug('PreStartOne(%d, %f): entering...' % (axis, value))
+        generator_config = [('SampleMode', 'Finite'),
+                            ('SampleTimingType', 'Implicit')]
+        def configure(item):
+            shadow, config = item
+            shadow.configure(config)
+
+        parallel_map(configure,
+                     [(tg['position_shadow'], position_config),
+                      (tg['generator_shadow'], generator_config)])
+        self._log.debug('PreStartOne(%d): leaving...' % axis)
         return True
 
-    def StartOne(self, axis, value):
+    @instrumented
+    def StartOne(self, axis):
         """Start generation - start the specified channel.
         """
-        self._log.debug('StartOne(%d, %f): entering...' % (axis, value))
+        self._log.debug('StartOne(%d): entering...' % axis)
         tg = self.attributes[axis]
         ch_generator = tg['ch_generator']
         ch_position = tg['ch_position']
         self._Started = True
+        self._generating.add(axis)
+        start = self._instrumentation.begin()
         ch_position.Start()
+        self._instrumentation.tango(self.position_names[axis - 1], 'Start',
+                                    start)
+        start = self._instrumentation.begin()
         ch_generator.Start()
-        self._log.debug('StartOne(%d, %f): leaving...' % (axis, value))
+        self._instrumentation.tango(self.generator_names[axis - 1], 'Start',
+                                    start)
+        self._log.debug('StartOne(%d): leaving...' % axis)
 
     def AbortOne(self, axis):
         """Stop generation - stop the specified channel
@@ -173,10 +238,15 @@ class Ni660XPositionTriggerGateController(TriggerGateController):
         tg = self.attributes[axis]
         ch_generator = tg['ch_generator']
         ch_position = tg['ch_position']
-        ch_generator.Stop()
-        ch_position.Stop()
+        for name, channel in ((self.generator_names[axis - 1], ch_generator),
+                              (self.position_names[axis - 1], ch_position)):
+            start = self._instrumentation.begin()
+            channel.Stop()
+            self._instrumentation.tango(name, 'Stop', start)
+        self._generation_finished(axis)
         self._log.debug('StopOne(%d): leaving...' % axis)
 
+    @instrumented
     def StateOne(self, axis):
         """Get state from the channel and translate it to the Sardana state
         """
@@ -184,41 +254,151 @@ class Ni660XPositionTriggerGateController(TriggerGateController):
         tg = self.attributes[axis]
         ch_generator = tg['ch_generator']
         ch_position = tg['ch_position']
-        state = ch_generator.getAttribute('State')
-        sta = eval_state(state.read().value)
+        # both states are read concurrently
+        def read_state(item):
+            name, channel = item
+            start = self._instrumentation.begin()
+            state = channel.State()
+            self._instrumentation.tango(name, 'State', start)
+            return state
+
+        state, state_pos = parallel_map(
+            read_state, [(self.generator_names[axis - 1], ch_generator),
+                         (self.position_names[axis - 1], ch_position)])
+        sta = eval_state(state)
         status = self.state_to_status[sta]
 
-        sta_pos = ch_position.getAttribute('State')
-        if sta != State.Running and sta_pos == State.Running:
+        # the encoder is not needed once the generation finished
+        if sta != State.Moving and state_pos == PyTango.DevState.RUNNING:
+            start = self._instrumentation.begin()
             ch_position.stop()
+            self._instrumentation.tango(self.position_names[axis - 1], 'Stop',
+                                        start)
         self._log.debug('StateOne(%d): returning (%s, %s)'\
                              % (axis, sta, status))
+        self._instrumentation.state(axis, sta)
+        if sta != State.Moving:
+            self._generation_finished(axis)
         return sta, status
 
+    def _generation_finished(self, axis):
+        if axis in self._generating:
+            self._generating.discard(axis)
+            if not self._generating:
+                self._instrumentation.end_acquisition()
+
+    def _has_pulse_buffers(self, axis):
+        """Whether the generator device of the axis has the buffer
+        attributes, it is checked once.
+        """
+        tg = self.attributes[axis]
+        if 'pulsebuffers' not in tg:
+            names = [name.lower()
+                     for name in tg['ch_generator'].get_attribute_list()]
+            tg['pulsebuffers'] = \
+                self.HIGH_TICKS_ATTR.lower() in names and \
+                self.LOW_TICKS_ATTR.lower() in names
+        return tg['pulsebuffers']
+
+    @instrumented
+    def SynchOne(self, axis, configuration):
+        """Configure the generation of all the groups of a position domain
+        synchronization description. The positions of all the groups are
+        converted to encoder ticks at once and written in a single call.
+        If the pulses of the groups differ, the high and low ticks of each
+        pulse are written to the buffer attributes.
+        """
+        # an acquisition starts with its synchronization
+        self._instrumentation.start_acquisition()
+        tg = self.attributes[axis]
+        params = (SynchParam.Initial, SynchParam.Delay, SynchParam.Active,
+                  SynchParam.Total)
+        try:
+            positions = numpy.array([[group[param][SynchDomain.Position]
+                                      for param in params]
+                                     for group in configuration],
+                                    dtype=numpy.float64)
+        except KeyError:
+            raise Exception('The synchronization must be described in the '
+                            'position domain')
+        repeats = [group[SynchParam.Repeats] for group in configuration]
+        initial, delay, active, total = \
+            self._fromUserToHardware(axis, numpy.abs(positions)).T
+        # the initial positions are only used for the gaps between groups
+        starts = self._fromUserToHardware(
+            axis, numpy.abs(positions[:, 0] - positions[0, 0]))
+        high_ticks, low_ticks = compile_pulse_train(active, total, repeats,
+                                                    starts)
+        # decided before rounding: the rounded pulses of a uniform train
+        # differ when its period is not a whole number of ticks
+        buffered = not (is_uniform(high_ticks) and is_uniform(low_ticks))
+        if buffered and not self._has_pulse_buffers(axis):
+            # as before the buffered generation, only the first group
+            self._log.warning('%s does not support buffered pulse '
+                              'generation, only the first group is '
+                              'generated', self.generator_names[axis - 1])
+            high_ticks = high_ticks[:repeats[0]]
+            low_ticks = low_ticks[:repeats[0]]
+            buffered = False
+        if buffered:
+            # round the edges, not the pulses, so the errors do not
+            # accumulate
+            edges = numpy.rint(numpy.cumsum(numpy.column_stack(
+                (high_ticks, low_ticks)).ravel()))
+            ticks = numpy.diff(edges, prepend=0).astype(numpy.int64)
+            high_ticks = numpy.maximum(ticks[0::2], self.min_ticks)
+            low_ticks = numpy.maximum(ticks[1::2], self.min_ticks)
+        offset = max(int(round(delay[0])), 4)
+
+        config = [('InitialDelayTicks', offset),
+                  ('HighTicks', max(int(round(high_ticks[0])),
+                                    self.min_ticks)),
+                  ('LowTicks', max(int(round(low_ticks[0])),
+                                   self.min_ticks)),
+                  ('SampPerChan', len(high_ticks))]
+        if buffered:
+            config += [(self.HIGH_TICKS_ATTR, high_ticks),
+                       (self.LOW_TICKS_ATTR, low_ticks)]
+        elif tg['buffered']:
+            # back to a uniform train, forget the previous pulses
+            config += [(self.HIGH_TICKS_ATTR, numpy.empty(0, numpy.int64)),
+                       (self.LOW_TICKS_ATTR, numpy.empty(0, numpy.int64))]
+        tg['generator_shadow'].configure(config)
+        # the device has the pulses only once written
+        tg['buffered'] = buffered
+
+    def GetCtrlPar(self, parameter):
+        parameter = parameter.lower()
+        if parameter == 'instrumentation':
+            return self._instrumentation.enabled
+        elif parameter == 'instrumentationdata':
+            return json.dumps(self._instrumentation.dump())
+        elif parameter == 'tracedirectory':
+            return self._instrumentation.trace_directory
+        return super().GetCtrlPar(parameter)
+
+    def SetCtrlPar(self, parameter, value):
+        parameter = parameter.lower()
+        if parameter == 'instrumentation':
+            self._instrumentation.enable(value)
+        elif parameter == 'tracedirectory':
+            self._instrumentation.set_trace_directory(value)
+        else:
+            super().SetCtrlPar(parameter, value)
+
     def SetAxisPar(self, axis, name, value):
         """Set axis parameter.
         """
         tg = self.attributes[axis]
-        ch_generator = tg['ch_generator']
-        ch_position = tg['ch_position']
         name = name.lower()
         # TODO: write of some attrs require that the device is STANDBY
         # For the moment Sardana leaves the TriggerGate elements in the 
         # state that they finished the last generation. In case of 
         # Ni660XCounter, write of some attributes require the channel 
-        # to be in STANDBY state. Due to that we stop the channel.
-        state = ch_position.getAttribute('State')
-        sta = from_tango_state_to_state(state.read().value)
-        if sta is not State.Standby:
-            ch_position.stop()
-        state = ch_generator.getAttribute('State')
-        sta = from_tango_state_to_state(state.read().value)
-        if sta is not State.Standby:
-            ch_generator.stop()
-
+        # to be in STANDBY state. Due to that the shadow stops the channel
+        # before writing.
         if name in self._ch_gen_attr:
-            attr_name = self.attribute_relations[name]
-            attr = ch_generator.getAttribute(attr_name)
+            attr_name = self.attribute_relations.get(name, name)
             if name == 'offset':
                 offset = self._fromUserToHardware(axis, value)
                 if offset < 4:
@@ -226,13 +406,15 @@ class Ni660XPositionTriggerGateController(TriggerGateController):
                 value = offset
             elif name == 'repetitions':
                 value = int(value)
-            attr.write(value)
+            tg['generator_shadow'].configure([(attr_name, value)])
         elif name in self._ch_pos_attr:
             if name == 'initialpos':
-                attr = int(value)
-            attr = ch_position.getAttribute(name)
-            attr.write(value)
+                value = int(value)
+            tg['position_shadow'].configure([(name, value)])
         else:
+            if name == 'decoding' and value not in DECODING_FACTORS:
+                raise Exception('Decoding %r is not supported, use one of '
+                                '%s' % (value, ', '.join(DECODING_FACTORS)))
             tg[name] = value
 
     def GetAxisPar(self, axis, name):
@@ -245,30 +427,25 @@ class Ni660XPositionTriggerGateController(TriggerGateController):
             attr_name = name
             if name in self.attribute_relations:
                 attr_name = self.attribute_relations.get(name)
-            attr = ch_generator.getAttribute(attr_name)
-            value = attr.read().value
+            value = ch_generator.read_attribute(attr_name).value
             if name == 'offset':
                 value = self._fromHardwareToUser(axis, value)
         elif name in self._ch_pos_attr:
-            attr = ch_position.getAttribute(name)
-            value = attr.read().value
+            value = ch_position.read_attribute(name).value
         else:
             value = self.attributes[axis][name]
 
         return value
 
+    def _resolution(self, axis):
+        """User units per tick. The resolution is given per encoder edge,
+        i.e. in X4 decoding, the X1 and X2 decodings lose a factor 4 and 2.
+        """
+        tg = self.attributes[axis]
+        return tg['resolution'] * 4 / DECODING_FACTORS[tg['decoding']]
+
     def _fromUserToHardware(self, axis, user):
-        resolution = self.attributes[axis]['resolution']
-        # this application can work only with X1 decoding, it means that 
-        # we are loosing resolution by factor of 4
-        resolution = resolution * 4
-        hardware = user / resolution
-        return hardware
+        return user / self._resolution(axis)
 
     def _fromHardwareToUser(self, axis, hardware):
-        resolution = self.attributes[axis]['resolution']
-        # this application can work only with X1 decoding, it means that 
-        # we are loosing resolution by factor of 4 
-        resolution = resolution * 4
-        user = hardware * resolution
-        return user
\ No newline at end of file
+        return hardware * self._resolution(axis)
\ No newline at end of file
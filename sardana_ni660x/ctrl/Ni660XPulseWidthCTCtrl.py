@@ -32,10 +32,8 @@ class Ni660XPulseWidthCTCtrl(Ni660XCTCtrl, CounterTimerController):
         CounterTimerController.__init__(self, inst, props, *args, **kwargs)
         Ni660XCTCtrl.__init__(self, inst, props, *args, **kwargs)
 
-    def PreStartOne(self, axis, value):
-        if (Ni660XCTCtrl.PreStartOne(self, axis, value) and axis != 1):
-            channel = self.channels[axis]
-            self._log.debug(self.counterName[axis])
-            source_terminal = getPFIName(self.counterName[axis],'src')
-            channel.write_attribute('SourceTerminal',source_terminal)
-        return True
+    def _configure_counter(self, axis):
+        Ni660XCTCtrl._configure_counter(self, axis)
+        self._log.debug(self.counterName[axis])
+        source_terminal = getPFIName(self.counterName[axis],'src')
+        self._arm(axis, [('SourceTerminal', source_terminal)])
@@ -1,3 +1,7 @@
+import json
+import time
+
+import numpy
 import PyTango
 from sardana import State
 from sardana.pool.pooldefs import SynchDomain, SynchParam
@@ -7,8 +11,15 @@ from sardana.pool.controller import (TriggerGateController, Type, Description,
 
 from sardana.tango.core.util import from_tango_state_to_state
 
+from sardana_ni660x.instrumentation import (INSTRUMENTATION_DOC,
+                                            INSTRUMENTATIONDATA_DOC,
+                                            TRACEDIRECTORY_DOC,
+                                            Instrumentation, instrumented)
+from sardana_ni660x.proxies import get_proxy, release_proxy
 from sardana_ni660x.utils import IdleState
 from sardana_ni660x.utils import CONNECTTERMS_DOC, ConnectTerms
+from sardana_ni660x.utils import AttributeShadow, parallel_map
+from sardana_ni660x.utils import compile_pulse_train, is_uniform
 
 ReadWrite = DataAccess.ReadWrite
 ReadOnly = DataAccess.ReadOnly
@@ -35,6 +46,13 @@ class Ni660XTriggerGateController(TriggerGateController):
 
     MaxDevice = 32
     min_time = 25e-6
+    # time in seconds for the started slave channels to be armed
+    START_TIMEOUT = 1.0
+    # attributes with the high and low time of each pulse, used when the
+    # pulses of a non-uniform synchronization differ. They require the
+    # Ni660XCounter devices to support buffered implicit pulse generation.
+    HIGH_TIMES_ATTR = 'HighTimeBuffer'
+    LOW_TIMES_ATTR = 'LowTimeBuffer'
 
     ctrl_properties = {
         'channelDevNames': {
@@ -56,6 +74,23 @@ class Ni660XTriggerGateController(TriggerGateController):
             DefaultValue: '{}'
         }
     }
+    ctrl_attributes = {
+        "instrumentation": {
+            Type: bool,
+            Description: INSTRUMENTATION_DOC,
+            Access: ReadWrite
+        },
+        "instrumentationData": {
+            Type: str,
+            Description: INSTRUMENTATIONDATA_DOC,
+            Access: ReadOnly
+        },
+        "traceDirectory": {
+            Type: str,
+            Description: TRACEDIRECTORY_DOC,
+            Access: ReadWrite
+        },
+    }
     axis_attributes = {
         "slave": {
             Type: bool,
@@ -121,9 +156,19 @@ class Ni660XTriggerGateController(TriggerGateController):
         self.channels = {}
         self.channel_names = self.channelDevNames.split(",")
         self.connect_terms_util = ConnectTerms(self.connectTerms)
+        # axes to be queried in StateAll and the states read by it
+        self._state_axes = []
+        self._states = {}
+        # axes started by StartAll
+        self._start_pending = []
+        # axes started whose generation did not finish yet, the
+        # acquisition is over when none is left
+        self._generating = set()
+        self._instrumentation = Instrumentation(inst)
 
         # Apply connect terms
-        self.connect_terms_util.apply_connect_terms()
+        self._instrumentation.call('apply_connect_terms',
+                                   self.connect_terms_util.apply_connect_terms)
 
     def AddDevice(self, axis):
         """
@@ -133,7 +178,11 @@ class Ni660XTriggerGateController(TriggerGateController):
         channel_name = self.channel_names[axis - 1]
         channel = self.channels[axis] = {}
         try:
-            channel['device'] = PyTango.DeviceProxy(channel_name)
+            channel['device'] = get_proxy(channel_name)
+            # last values written to the attributes of the channel
+            channel['shadow'] = AttributeShadow(channel['device'],
+                                                channel_name,
+                                                self._instrumentation)
         except Exception as e:
             msg = 'Could not create tango device: %s, details: %s' %\
                   (channel_name, e)
@@ -147,54 +196,88 @@ class Ni660XTriggerGateController(TriggerGateController):
         Remove axis from the controller, basically forgets about the tango
         device of the corresponding channel.
         """
-        self.channels.pop(axis)
+        channel = self.channels.pop(axis)
+        if 'shadow' in channel:
+            channel['shadow'].close()
+        if 'device' in channel:
+            release_proxy(self.channel_names[axis - 1])
 
-    def _getState(self, axis):
-        channel = self.channels[axis]['device']    
+    def _getDevState(self, axis):
+        channel = self.channels[axis]['device']
+        start = self._instrumentation.begin()
         state = channel.read_attribute('State').value
+        self._instrumentation.tango(self.channel_names[axis - 1],
+                                    'read_attribute', start)
+        return state
+
+    def _getState(self, axis):
+        state = self._getDevState(axis)
         if state == PyTango.DevState.RUNNING:
            return State.Moving
         elif state == PyTango.DevState.STANDBY:
            return State.On
         else:
            return from_tango_state_to_state(state)
+
+    def _has_pulse_buffers(self, axis):
+        """Whether the device of the axis has the buffer attributes, it is
+        checked once.
+        """
+        channel_cfg = self.channels[axis]
+        if 'pulsebuffers' not in channel_cfg:
+            names = [name.lower()
+                     for name in channel_cfg['device'].get_attribute_list()]
+            channel_cfg['pulsebuffers'] = \
+                self.HIGH_TIMES_ATTR.lower() in names and \
+                self.LOW_TIMES_ATTR.lower() in names
+        return channel_cfg['pulsebuffers']
  
+    @instrumented
     def SynchOne(self, axis, configuration):
         """
-        Set axis configuration.
+        Set axis configuration. All the groups are generated in a single
+        train of pulses, if their pulses differ the high and low time of
+        each pulse are written to the buffer attributes.
         """
 
+        # an acquisition starts with its synchronization
+        self._instrumentation.start_acquisition()
         channel_cfg = self.channels[axis]
-        group = configuration[0]
-        delay = group[SynchParam.Delay][SynchDomain.Time]
-        active = group[SynchParam.Active][SynchDomain.Time] * (channel_cfg['dutycycle']/100)
-        total = group[SynchParam.Total][SynchDomain.Time]
-        passive = total - active
-        repeats = group[SynchParam.Repeats]
+        delay = configuration[0][SynchParam.Delay][SynchDomain.Time]
+        duty_cycle = channel_cfg['dutycycle'] / 100
+        actives = [group[SynchParam.Active][SynchDomain.Time] * duty_cycle
+                   for group in configuration]
+        totals = [group[SynchParam.Total][SynchDomain.Time]
+                  for group in configuration]
+        repeats = [group[SynchParam.Repeats] for group in configuration]
+        # all the groups are generated in a single pulse train, the gaps
+        # between them are taken from their initial times, if given
+        starts = None
+        if all(SynchDomain.Time in group.get(SynchParam.Initial, {})
+               for group in configuration):
+            starts = [group[SynchParam.Initial][SynchDomain.Time]
+                      for group in configuration]
+        high_times, low_times = compile_pulse_train(actives, totals, repeats,
+                                                    starts)
 
         # TODO: write of some attrs require that the device is STANDBY
         # For the moment Sardana leaves the TriggerGate elements in the 
         # state that they finished the last generation. In case of 
         # Ni660XCounter, write of some attributes require the channel 
-        # to be in STANDBY state. Due to that we stop the channel.
+        # to be in STANDBY state. Due to that the channel is stopped
+        # when any of the attributes has to be written.
 
-        channel = channel_cfg['device']          
-        if self._getState(axis) is State.On:
-            channel.stop()
-
-        channel.write_attribute("HighTime", active)
-
-        if passive < self.min_time:
-            channel.write_attribute("LowTime", self.min_time)
+        if low_times.min() < self.min_time:
+            low_times = numpy.maximum(low_times, self.min_time)
             self._log.warning("Changing passive time to the ni660x minimum")
-        else:
-            channel.write_attribute("LowTime", passive)
 
-        channel.write_attribute("SampPerChan", int(repeats))
+        config = [("HighTime", high_times[0]),
+                  ("LowTime", low_times[0]),
+                  ("SampPerChan", len(high_times))]
 
         idle_state = channel_cfg['idlestate']
         if idle_state != IdleState.NOT_SET:
-            channel.write_attribute("IdleState", idle_state.value)
+            config.append(("IdleState", idle_state.value))
                      
         timing_type = 'Implicit'
         
@@ -216,19 +299,39 @@ class Ni660XTriggerGateController(TriggerGateController):
                 # care the latency time of the trigger, and when we use the
                 # NI as slave of the icepapa or pmac it needs time to
                 # prepare the next trigger.
-                channel.write_attribute("LowTime", 0.000003)
+                config[1] = ("LowTime", 0.000003)
+                low_times = numpy.full(len(low_times), 0.000003)
             
         else:
             start_trigger_source = 'None'
             start_trigger_type = 'None'            
                                 
-        channel.write_attribute("StartTriggerSource", start_trigger_source)
-        channel.write_attribute("StartTriggerType", start_trigger_type)
         delay = delay + channel_cfg['extrainitialdelaytime']
         channel_cfg['extrainitialdelaytime'] = 0
-        channel.write_attribute("InitialDelayTime", delay)
-        channel.write_attribute('SampleTimingType', timing_type)
+        config += [("StartTriggerSource", start_trigger_source),
+                   ("StartTriggerType", start_trigger_type),
+                   ("InitialDelayTime", delay),
+                   ('SampleTimingType', timing_type)]
+        buffered = not (is_uniform(high_times) and is_uniform(low_times))
+        if buffered and not self._has_pulse_buffers(axis):
+            # as before the buffered generation, only the first group
+            self._log.warning('%s does not support buffered pulse '
+                              'generation, only the first group is '
+                              'generated', self.channel_names[axis - 1])
+            config[2] = ("SampPerChan", int(repeats[0]))
+            buffered = False
+        if buffered:
+            config += [(self.HIGH_TIMES_ATTR, high_times),
+                       (self.LOW_TIMES_ATTR, low_times)]
+        elif channel_cfg.get('buffered'):
+            # back to a uniform train, forget the previous pulses
+            config += [(self.HIGH_TIMES_ATTR, numpy.empty(0)),
+                       (self.LOW_TIMES_ATTR, numpy.empty(0))]
+        channel_cfg['shadow'].configure(config)
+        # the device has the pulses only once written
+        channel_cfg['buffered'] = buffered
         
+    @instrumented
     def PreStartOne(self, axis, value=None):
         """
         Prepare axis for generation.
@@ -238,50 +341,156 @@ class Ni660XTriggerGateController(TriggerGateController):
         self._log.debug('PreStartOne(%d): leaving...' % axis)
         return True
 
+    @instrumented
     def PreStartAll(self):
         self._log.debug("PreStartAll(): Entering...")
-
+        self._start_pending = []
         self._log.debug("PreStartAll(): Leaving...")
         return True
 
+    @instrumented
     def StartOne(self, axis):
         """
-        Start generation - start the specified channel.
+        Start generation - the channel is started in StartAll.
         """
         self._log.debug('StartOne(%d): entering...' % axis)
+        self._start_pending.append(axis)
+        self._generating.add(axis)
+        self._log.debug('StartOne(%d): leaving...' % axis)
+
+    @instrumented
+    def StartAll(self):
+        """
+        Start generation - arm the slave channels concurrently, wait until
+        all of them wait for their start trigger and then start the master
+        channels, so no slave misses the first pulse of its master.
+        """
+        axes, self._start_pending = self._start_pending, []
+        slaves = [axis for axis in axes if self.channels[axis]['slave']]
+        masters = [axis for axis in axes if axis not in slaves]
+        if slaves:
+            parallel_map(self._start_channel, slaves)
+            self._wait_armed(slaves)
+        parallel_map(self._start_channel, masters)
+
+    def _start_channel(self, axis):
         channel = self.channels[axis]['device']
+        start = self._instrumentation.begin()
         channel.Start()
-        self._log.debug('StartOne(%d): leaving...' % axis)
+        self._instrumentation.tango(self.channel_names[axis - 1], 'Start',
+                                    start)
+
+    def _wait_armed(self, axes):
+        """
+        Wait until the started channels are armed, i.e. RUNNING, or
+        already finished.
+        """
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while True:
+            states = parallel_map(self._getDevState, axes)
+            pending = []
+            for axis, state in zip(axes, states):
+                if state == PyTango.DevState.FAULT:
+                    raise Exception('Channel %s failed to start' %
+                                    self.channel_names[axis - 1])
+                if state not in (PyTango.DevState.RUNNING,
+                                 PyTango.DevState.ON):
+                    pending.append(axis)
+            if not pending:
+                return
+            if time.monotonic() > deadline:
+                names = [self.channel_names[axis - 1] for axis in pending]
+                raise Exception('Channels %s not armed after %g s' %
+                                (', '.join(names), self.START_TIMEOUT))
+            axes = pending
+            time.sleep(0.001)
+
+    def PreStateAll(self):
+        self._state_axes = []
+        self._states = {}
 
+    def PreStateOne(self, axis):
+        self._state_axes.append(axis)
+
+    @instrumented
+    def StateAll(self):
+        """
+        Read the state of all the axes concurrently. The states are kept
+        for this poll cycle, so StateOne is just a lookup.
+        """
+        def read_state(axis):
+            try:
+                return self._getState(axis)
+            except Exception as e:
+                return e
+
+        states = parallel_map(read_state, self._state_axes)
+        self._states = dict(zip(self._state_axes, states))
+
+    @instrumented
     def StateOne(self, axis):
         """
         Get state from the channel and translate it to the Sardana state
         """
         self._log.debug('StateOne(%d): entering...' % axis)
         
-        sta = self._getState(axis)
+        sta = self._states.pop(axis, None)
+        if sta is None:
+            sta = self._getState(axis)
+        elif isinstance(sta, Exception):
+            raise sta
         status = self.state_to_status[sta]
         self._log.debug('StateOne(%d): returning (%s, %s)'\
                              % (axis, sta, status))
+        self._instrumentation.state(axis, sta)
+        if sta != State.Moving:
+            self._generation_finished(axis)
         return sta, status
 
+    def _generation_finished(self, axis):
+        if axis in self._generating:
+            self._generating.discard(axis)
+            if not self._generating:
+                self._instrumentation.end_acquisition()
+
     def AbortOne(self, axis):
         """
         Abort generation - stop the specified channel
         """
         self._log.debug('AbortOne(%d): entering...' % axis)
         channel = self.channels[axis]['device']
+        start = self._instrumentation.begin()
         channel.Stop()
+        self._instrumentation.tango(self.channel_names[axis - 1], 'Stop',
+                                    start)
+        self._generation_finished(axis)
         self._log.debug('AbortOne(%d): leaving...' % axis)
 
+    def GetCtrlPar(self, parameter):
+        parameter = parameter.lower()
+        if parameter == 'instrumentation':
+            return self._instrumentation.enabled
+        elif parameter == 'instrumentationdata':
+            return json.dumps(self._instrumentation.dump())
+        elif parameter == 'tracedirectory':
+            return self._instrumentation.trace_directory
+        return super().GetCtrlPar(parameter)
+
+    def SetCtrlPar(self, parameter, value):
+        parameter = parameter.lower()
+        if parameter == 'instrumentation':
+            self._instrumentation.enable(value)
+        elif parameter == 'tracedirectory':
+            self._instrumentation.set_trace_directory(value)
+        else:
+            super().SetCtrlPar(parameter, value)
+
     def getRetriggerable(self, axis):
         return self.channels[axis]['device'].read_attribute('retriggerable').value
         
     def setRetriggerable(self, axis, value):
-        device = self.channels[axis]['device'] 
-        if self._getState(axis) is State.On:
-            device.stop()
-        device.write_attribute('retriggerable', value)
+        shadow = self.channels[axis]['shadow']
+        shadow.configure([('retriggerable', value)])
     
     def GetAxisExtraPar(self, axis, name):
         self._log.debug("GetAxisExtraPar(%d, %s) entering..." % (axis, name))
@@ -0,0 +1,433 @@
+"""Tests of the counter controllers on the simulated channels, see
+sardana_ni660x.simulator. They do not need the NI cards nor Tango.
+"""
+import json
+import unittest
+
+import tango
+
+from sardana import State
+from sardana.pool import AcqSynch
+
+from sardana_ni660x import utils
+from sardana_ni660x.simulator import (Simulation, add_axis, make_controller,
+                                      wait)
+from sardana_ni660x.ctrl.Ni660XCounterCTCtrl import Ni660XCounterCTCtrl
+
+TIMER = 'sim/ni660x/dev1-ctr0'
+COUNTER = 'sim/ni660x/dev1-ctr1'
+CHANNEL_DEV_NAMES = ','.join([TIMER, COUNTER])
+SAMPLE_CLK_SRC = '/Dev1/PFI36'
+CARD = 'sim/ni660x/dev1'
+CONNECT_TERMS = repr({CARD: [('/Dev1/PFI36', '/Dev1/RTSI0',
+                              'DoNotInvertPolarity')]})
+
+
+class Ni660XCounterCTCtrlSimTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        self.sim.add_channel(COUNTER, 'CICountEdgesChan', 'ctr1')
+        self.card = self.sim.add_card(CARD)
+        self.patch = self.sim.patch()
+        self.patch.__enter__()
+        self.ctrl = make_controller(Ni660XCounterCTCtrl,
+                                    channelDevNames=CHANNEL_DEV_NAMES,
+                                    connectTerms=CONNECT_TERMS)
+        for axis in (1, 2):
+            add_axis(self.ctrl, axis)
+        self.ctrl.SetAxisExtraPar(2, 'sampleClockSource', SAMPLE_CLK_SRC)
+
+    def tearDown(self):
+        for axis in (1, 2):
+            self.ctrl.DeleteDevice(axis)
+        self.patch.__exit__(None, None, None)
+
+    def start(self, integ_time, repetitions):
+        # as the Pool does, channel by channel with the timer the last
+        self.ctrl.LoadOne(1, integ_time, repetitions, 0)
+        self.ctrl.PreStartAll()
+        for axis in (2, 1):
+            self.ctrl.PreStartOne(axis, integ_time)
+            self.ctrl.StartOne(axis, integ_time)
+        self.ctrl.StartAll()
+
+    def state(self, axis):
+        self.ctrl.PreStateAll()
+        self.ctrl.PreStateOne(axis)
+        self.ctrl.StateAll()
+        return self.ctrl.StateOne(axis)[0]
+
+    def test_step_acquisition(self):
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.start(0.002, 1)
+        wait(lambda: self.state(2) == State.On)
+        self.ctrl.PreReadAll()
+        self.ctrl.PreReadOne(2)
+        self.ctrl.ReadAll()
+        self.assertEqual(self.ctrl.ReadOne(2).value, 20)
+
+    def test_prefetched_read(self):
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.start(0.002, 1)
+        wait(lambda: self.state(2) == State.On)
+        self.sim.reset_stats()
+        self.ctrl.PreReadAll()
+        self.ctrl.PreReadOne(1)
+        self.ctrl.PreReadOne(2)
+        self.ctrl.ReadAll()
+        self.assertEqual(list(self.ctrl._prefetched), [2])
+        self.assertEqual(self.sim.calls[(COUNTER, 'read_attribute')], 1)
+        # ReadOne only processes the buffer already read
+        self.assertEqual(self.ctrl.ReadOne(2).value, 20)
+        self.assertEqual(self.ctrl.ReadOne(1).value, 0.002)
+        self.assertEqual(sum(self.sim.calls.values()), 1)
+        self.assertEqual(self.ctrl._prefetched, {})
+
+    def test_prefetched_error(self):
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.start(0.002, 1)
+        wait(lambda: self.state(2) == State.On)
+        self.ctrl.BUFFER_ATTR = 'NoBuffer'
+        self.ctrl.PreReadAll()
+        self.ctrl.PreReadOne(2)
+        self.ctrl.ReadAll()
+        self.assertIsInstance(self.ctrl._prefetched[2], tango.DevFailed)
+        # the error of ReadAll is reported by ReadOne, without reading again
+        self.sim.reset_stats()
+        self.assertEqual(self.ctrl.ReadOne(2).value, 0)
+        self.assertEqual(sum(self.sim.calls.values()), 0)
+
+    def test_group_start(self):
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.ctrl.LoadOne(1, 0.002, 1, 0)
+        self.ctrl.PreStartAll()
+        for axis in (2, 1):
+            self.ctrl.PreStartOne(axis, 0.002)
+            self.ctrl.StartOne(axis, 0.002)
+        # the configuration is written only once all the channels are known
+        self.assertEqual(self.sim.calls[(COUNTER, 'write_attributes')], 0)
+        self.sim.reset_stats()
+        self.ctrl.StartAll()
+        self.assertEqual(self.sim.calls[(COUNTER, 'write_attributes')], 1)
+        # the State is read before writing the configuration and the
+        # counter is confirmed armed before the timer is started
+        self.assertEqual(self.sim.calls[(COUNTER, 'Start')], 1)
+        self.assertEqual(self.sim.calls[(COUNTER, 'State')], 2)
+        self.assertEqual(self.sim.calls[(TIMER, 'Start')], 1)
+        wait(lambda: self.state(2) == State.On)
+
+    def test_state_all(self):
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.start(0.002, 1)
+        wait(lambda: self.state(2) == State.On)
+        self.sim.reset_stats()
+        self.ctrl.PreStateAll()
+        for axis in (1, 2):
+            self.ctrl.PreStateOne(axis)
+        self.ctrl.StateAll()
+        # one State per counter, the timer state is not queried
+        self.assertEqual(self.sim.calls[(COUNTER, 'State')], 1)
+        self.assertEqual(self.sim.calls[(TIMER, 'State')], 0)
+        self.sim.reset_stats()
+        for axis in (1, 2):
+            self.assertEqual(self.ctrl.StateOne(axis)[0], State.On)
+        self.assertEqual(sum(self.sim.calls.values()), 0)
+
+    def test_prepared_step_acquisition(self):
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.start(0.002, 1)
+        wait(lambda: self.state(2) == State.On)
+        self.ctrl.PrepareOne(1, 0.003, 1, 0, 3)
+        self.sim.reset_stats()
+        self.start(0.003, 1)
+        wait(lambda: self.state(2) == State.On)
+        self.ctrl.PreReadAll()
+        self.ctrl.PreReadOne(2)
+        self.ctrl.ReadAll()
+        self.assertEqual(self.ctrl.ReadOne(2).value, 30)
+        # everything was configured by PrepareOne
+        writes = [key for key in self.sim.calls
+                  if key[1] == 'write_attributes']
+        self.assertEqual(writes, [])
+
+    def test_card_init(self):
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.start(0.002, 1)
+        self.assertIn('/Dev1/RTSI0', self.card.routes)
+        wait(lambda: self.state(2) == State.On)
+        # Init does not push the interface change event
+        self.card.Init()
+        self.ctrl.PrepareOne(1, 0.002, 1, 0, 1)
+        self.assertIn('/Dev1/RTSI0', self.card.routes)
+        self.sim.reset_stats()
+        self.start(0.002, 1)
+        # the routes are applied once per measurement
+        self.assertEqual(self.sim.calls[(CARD, 'ConnectTerms')], 0)
+
+    def test_event_acquisition(self):
+        self.sim.change_events = True
+        self.ctrl.useEvents = True
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        self.start(0.002, 1)
+        wait(lambda: self.state(2) == State.On)
+        # the events are queued until delivered by the test
+        self.sim.event_delay = None
+        self.start(0.1, 1)
+        counter = self.sim.devices[COUNTER]
+        # the STANDBY of the Stop before the start arrives late
+        counter.deliver_events(1)
+        self.assertEqual(self.state(2), State.Moving)
+        self.sim.event_delay = 0
+        counter.deliver_events()
+        wait(lambda: self.state(2) == State.On)
+        self.ctrl.PreReadAll()
+        self.ctrl.PreReadOne(2)
+        self.ctrl.ReadAll()
+        self.assertEqual(self.ctrl.ReadOne(2).value, 1000)
+        self.assertIn(2, self.ctrl._event_ids)
+
+    def test_armed_step_acquisition(self):
+        self.ctrl.armedStepMode = True
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        values = []
+        for point in range(3):
+            if point == 1:
+                self.sim.reset_stats()
+            self.start(0.002, 1)
+            wait(lambda: self.state(2) == State.On)
+            self.ctrl.PreReadAll()
+            self.ctrl.PreReadOne(2)
+            self.ctrl.ReadAll()
+            values.append(self.ctrl.ReadOne(2).value)
+        self.assertEqual(values, [20] * 3)
+        # the counter is started once and only read at each point
+        calls = {call: count for (device, call), count
+                 in self.sim.calls.items() if device == COUNTER}
+        self.assertEqual(calls, {'write_read_attributes': 2})
+        self.assertEqual(self.sim.calls[(TIMER, 'Start')], 2)
+        # back to the normal step acquisition
+        self.ctrl.armedStepMode = False
+        self.start(0.002, 1)
+        wait(lambda: self.state(2) == State.On)
+        self.assertEqual(self.counter_attribute('PauseTriggerType'), 'None')
+
+    def test_armed_buffer_full(self):
+        self.ctrl.armedStepMode = True
+        self.ctrl._synchronization = AcqSynch.SoftwareTrigger
+        # room for the samples of two points
+        self.ctrl.ARMED_BUFFER_SIZE = 4
+        values = []
+        for _ in range(5):
+            self.start(0.002, 1)
+            wait(lambda: self.state(2) == State.On)
+            self.ctrl.PreReadAll()
+            self.ctrl.PreReadOne(2)
+            self.ctrl.ReadAll()
+            values.append(self.ctrl.ReadOne(2).value)
+        self.assertEqual(values, [20] * 5)
+        # armed again every two points
+        self.assertEqual(self.sim.calls[(COUNTER, 'Start')], 3)
+        self.assertEqual(self.sim.calls[(COUNTER, 'Stop')], 2)
+
+    def counter_attribute(self, name):
+        return self.sim.devices[COUNTER].read_attribute(name).value
+
+    def test_continuous_acquisition(self):
+        self.ctrl._synchronization = AcqSynch.HardwareTrigger
+        self.start(0.001, 10)
+        # the simulated trigger gate generator
+        generator = self.sim.add_channel('sim/ni660x/dev1-ctr2',
+                                         'COPulseChanTime', 'ctr2')
+        generator.write_attributes([('HighTime', 0.001), ('LowTime', 0.001),
+                                    ('SampPerChan', 10)])
+        generator.Start()
+        values = []
+        timer_values = []
+        while len(timer_values) < 10:
+            self.ctrl.PreReadAll()
+            for axis in (1, 2):
+                self.ctrl.PreReadOne(axis)
+            self.ctrl.ReadAll()
+            timer_values.extend(self.ctrl.ReadOne(1))
+            values.extend(self.ctrl.ReadOne(2))
+        self.assertEqual(values, [20] * 10)
+        self.assertEqual(timer_values, [0.001] * 10)
+        wait(lambda: self.state(2) == State.On)
+        self.assertEqual(self.state(1), State.On)
+
+    def test_delta_readout(self):
+        self.ctrl.deltaReadout = True
+        self.ctrl._synchronization = AcqSynch.HardwareTrigger
+        self.start(0.001, 10)
+        generator = self.sim.add_channel('sim/ni660x/dev1-ctr2',
+                                         'COPulseChanTime', 'ctr2')
+        generator.write_attributes([('HighTime', 0.001), ('LowTime', 0.001),
+                                    ('SampPerChan', 10)])
+        self.sim.reset_stats()
+        generator.Start()
+        values = []
+        while len(values) < 10:
+            self.ctrl.PreReadAll()
+            self.ctrl.PreReadOne(2)
+            self.ctrl.ReadAll()
+            values.extend(self.ctrl.ReadOne(2))
+        self.assertEqual(values, [20] * 10)
+        # the offset is written with each read and every sample is
+        # transferred only once
+        self.assertEqual(self.sim.calls[(COUNTER, 'read_attribute')], 0)
+        self.assertGreater(
+            self.sim.calls[(COUNTER, 'write_read_attributes')], 0)
+        counter = self.sim.devices[COUNTER]
+        buffer = counter.read_attribute(self.ctrl.BUFFER_ATTR).value
+        self.assertEqual(
+            self.sim.nbytes[(COUNTER, 'write_read_attributes')],
+            buffer.nbytes)
+        # only the samples from the offset on are returned
+        data, index = self.ctrl._read_buffer(2, 6)
+        self.assertEqual((data.tolist(), index), (buffer[6:].tolist(), 0))
+
+
+class Ni660XCTCtrlDMATestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.names = ['sim/ni660x/dev1-ctr%d' % ctr for ctr in range(8)]
+        self.sim.add_channel(self.names[0], 'COPulseChanTime', 'ctr0')
+        for ctr in range(1, 8):
+            self.sim.add_channel(self.names[ctr], 'CICountEdgesChan',
+                                 'ctr%d' % ctr)
+        self.patch = self.sim.patch()
+        self.patch.__enter__()
+
+    def tearDown(self):
+        self.patch.__exit__(None, None, None)
+
+    def create(self, names, inst):
+        ctrl = make_controller(Ni660XCounterCTCtrl, inst=inst,
+                               channelDevNames=','.join(names))
+        ctrl._synchronization = AcqSynch.HardwareTrigger
+        for axis in range(1, len(names) + 1):
+            add_axis(ctrl, axis)
+            if axis != 1:
+                ctrl.SetAxisExtraPar(axis, 'sampleClockSource',
+                                     SAMPLE_CLK_SRC)
+        return ctrl
+
+    def start(self, ctrl):
+        axes = sorted(ctrl.channels)
+        ctrl.LoadOne(1, 0.001, 10, 0)
+        ctrl.PreStartAll()
+        for axis in axes[1:] + axes[:1]:
+            ctrl.PreStartOne(axis, 0.001)
+            ctrl.StartOne(axis, 0.001)
+        ctrl.StartAll()
+        for axis in axes:
+            ctrl.AbortOne(axis)
+        return json.loads(ctrl.GetCtrlPar('dmaAllocation'))
+
+    def delete(self, ctrl):
+        for axis in sorted(ctrl.channels):
+            ctrl.DeleteDevice(axis)
+
+    def test_card_limit(self):
+        ctrl = self.create(self.names[:6], 'ct')
+        allocation = self.start(ctrl)
+        self.assertEqual([allocation[name] for name in self.names[1:6]],
+                         ['DMA'] * 3 + ['Interrupts'] * 2)
+        self.delete(ctrl)
+
+    def test_shared_card(self):
+        ct = self.create(self.names[:3], 'ct')
+        other = self.create([self.names[0]] + self.names[5:8], 'other')
+        self.start(ct)
+        # only one DMA channel of the card left for the other controller
+        allocation = self.start(other)
+        self.assertEqual([allocation[name] for name in self.names[5:8]],
+                         ['DMA', 'Interrupts', 'Interrupts'])
+        self.delete(ct)
+        allocation = self.start(other)
+        self.assertEqual([allocation[name] for name in self.names[5:8]],
+                         ['DMA'] * 3)
+        self.delete(other)
+
+
+    def test_armed_release(self):
+        ctrl = self.create(self.names[:4], 'ct')
+        ctrl.armedStepMode = True
+        ctrl._synchronization = AcqSynch.SoftwareTrigger
+
+        def step(axes):
+            ctrl.LoadOne(1, 0.001, 1, 0)
+            ctrl.PreStartAll()
+            for axis in axes[1:] + axes[:1]:
+                ctrl.PreStartOne(axis, 0.001)
+                ctrl.StartOne(axis, 0.001)
+            ctrl.StartAll()
+            timer = self.sim.devices[self.names[0]]
+            wait(lambda: timer.State() != tango.DevState.RUNNING)
+
+        step([1, 2, 3, 4])
+        self.assertEqual(utils._dma_budget.reserved('Dev1'), 3)
+        # the counter removed from the measurement group is stopped
+        step([1, 2, 3])
+        self.assertEqual(ctrl._armed, {2, 3})
+        state = self.sim.devices[self.names[3]].State()
+        self.assertNotEqual(state, tango.DevState.RUNNING)
+        self.assertEqual(utils._dma_budget.reserved('Dev1'), 2)
+        for axis in (2, 3, 1):
+            ctrl.AbortOne(axis)
+        self.assertEqual(ctrl._armed, set())
+        self.assertEqual(utils._dma_budget.reserved('Dev1'), 0)
+        self.delete(ctrl)
+
+
+class Ni660XCTCtrlStartupTestCase(unittest.TestCase):
+
+    def test_lazy_add_device(self):
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        sim.add_channel(COUNTER, 'CICountEdgesChan', 'ctr1')
+        with sim.patch():
+            ctrl = make_controller(Ni660XCounterCTCtrl,
+                                   channelDevNames=CHANNEL_DEV_NAMES)
+            for axis in (1, 2):
+                add_axis(ctrl, axis)
+            # only the database was queried
+            self.assertEqual(set(device for device, _ in sim.calls),
+                             {'database'})
+            self.assertEqual(ctrl.counterName[2], '/Dev1/ctr1')
+            self.assertFalse(ctrl.channels[2].connected)
+
+    def test_not_in_database(self):
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        counter = sim.add_channel(COUNTER, 'CICountEdgesChan', 'ctr1')
+        counter.in_database = False
+        with sim.patch():
+            ctrl = make_controller(Ni660XCounterCTCtrl,
+                                   channelDevNames=CHANNEL_DEV_NAMES)
+            for axis in (1, 2):
+                add_axis(ctrl, axis)
+            # the empty properties are read from the device
+            self.assertEqual(sim.calls[(COUNTER, 'get_property')], 1)
+            self.assertEqual(ctrl.counterName[2], '/Dev1/ctr1')
+            for axis in (1, 2):
+                ctrl.DeleteDevice(axis)
+
+    def test_undefined_device(self):
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        sim.add_channel(COUNTER, 'CICountEdgesChan', 'ctr1')
+        names = CHANNEL_DEV_NAMES + ',sim/ni660x/dev1-ctr5'
+        with sim.patch():
+            # only the axis of the undefined device fails
+            ctrl = make_controller(Ni660XCounterCTCtrl,
+                                   channelDevNames=names)
+            for axis in (1, 2):
+                add_axis(ctrl, axis)
+            with self.assertRaises(tango.DevFailed):
+                ctrl.AddDevice(3)
+            for axis in (1, 2):
+                ctrl.DeleteDevice(axis)
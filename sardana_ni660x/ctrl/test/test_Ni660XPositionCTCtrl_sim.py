@@ -0,0 +1,68 @@
+"""Tests of the position controller on the simulated channels, see
+sardana_ni660x.simulator. They do not need the NI cards nor Tango.
+"""
+import unittest
+
+from sardana.pool import AcqSynch
+
+from sardana_ni660x.simulator import Simulation, add_axis, make_controller
+from sardana_ni660x.ctrl.Ni660XPositionCTCtrl import Ni660XPositionCTCtrl
+
+TIMER = 'sim/ni660x/dev1-ctr0'
+ENCODER = 'sim/ni660x/dev1-ctr1'
+GENERATOR = 'sim/ni660x/dev1-ctr2'
+CHANNEL_DEV_NAMES = ','.join([TIMER, ENCODER])
+SAMPLE_CLK_SRC = '/Dev1/PFI36'
+
+
+class Ni660XPositionCTCtrlSimTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # the simulated encoder advances 0.5 per sample
+        self.sim = Simulation(position_step=0.5)
+        self.sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        self.sim.add_channel(ENCODER, 'CIAngEncoderChan', 'ctr1')
+        self.patch = self.sim.patch()
+        self.patch.__enter__()
+        self.ctrl = make_controller(Ni660XPositionCTCtrl,
+                                    channelDevNames=CHANNEL_DEV_NAMES)
+        for axis in (1, 2):
+            add_axis(self.ctrl, axis)
+        self.ctrl.SetAxisExtraPar(2, 'sampleClockSource', SAMPLE_CLK_SRC)
+        self.ctrl._synchronization = AcqSynch.HardwareTrigger
+
+    def tearDown(self):
+        for axis in (1, 2):
+            self.ctrl.DeleteDevice(axis)
+        self.patch.__exit__(None, None, None)
+
+    def acquire(self, repetitions):
+        self.ctrl.LoadOne(1, 0.001, repetitions, 0)
+        self.ctrl.PreStartAll()
+        for axis in (2, 1):
+            self.ctrl.PreStartOne(axis, 0.001)
+            self.ctrl.StartOne(axis, 0.001)
+        self.ctrl.StartAll()
+        generator = self.sim.add_channel(GENERATOR, 'COPulseChanTime',
+                                         'ctr2')
+        generator.write_attributes([('HighTime', 0.001), ('LowTime', 0.001),
+                                    ('SampPerChan', repetitions)])
+        generator.Start()
+        values = []
+        while len(values) < repetitions:
+            self.ctrl.PreReadAll()
+            self.ctrl.PreReadOne(2)
+            self.ctrl.ReadAll()
+            values.extend(self.ctrl.ReadOne(2))
+        return values
+
+    def test_positions(self):
+        self.assertEqual(self.acquire(4), [0.5, 1, 1.5, 2])
+
+    def test_sign_and_initial_position(self):
+        self.ctrl.SetAxisExtraPar(2, 'sign', -1)
+        self.ctrl.SetAxisExtraPar(2, 'initialPos', 10)
+        values = self.acquire(4)
+        self.assertEqual(values, [9.5, 9, 8.5, 8])
+        # plain floats, as the Pool expects
+        self.assertEqual({type(value) for value in values}, {float})
@@ -0,0 +1,131 @@
+"""Tests of the position trigger gate controller on the simulated
+channels, see sardana_ni660x.simulator. They do not need the NI cards nor
+Tango.
+"""
+import unittest
+
+from sardana.pool import SynchDomain, SynchParam
+
+from sardana_ni660x.simulator import Simulation, add_axis, make_controller
+from sardana_ni660x.ctrl.Ni660XPositionTriggerGateController import \
+    Ni660XPositionTriggerGateController
+
+
+def position_group(initial, active, total, repeats):
+    return {SynchParam.Initial: {SynchDomain.Position: initial},
+            SynchParam.Delay: {SynchDomain.Position: 0.1},
+            SynchParam.Active: {SynchDomain.Position: active},
+            SynchParam.Total: {SynchDomain.Position: total},
+            SynchParam.Repeats: repeats}
+
+
+class Ni660XPositionTriggerGateControllerSimTestCase(unittest.TestCase):
+
+    POSITION = 'sim/ni660x/dev1-ctr1'
+    GENERATOR = 'sim/ni660x/dev1-ctr2'
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.sim.add_channel(self.POSITION, 'CIAngEncoderChan', 'ctr1')
+        self.generator = self.sim.add_channel(self.GENERATOR,
+                                              'COPulseChanTicks', 'ctr2')
+
+    def make_controller(self):
+        ctrl = make_controller(Ni660XPositionTriggerGateController,
+                               positionDevNames=self.POSITION,
+                               generatorDevNames=self.GENERATOR)
+        add_axis(ctrl, 1)
+        ctrl.SetAxisPar(1, 'resolution', 0.001)
+        return ctrl
+
+    def generator_attribute(self, name):
+        return self.generator.read_attribute(name).value
+
+    def test_uniform_fractional_period(self):
+        with self.sim.patch():
+            ctrl = self.make_controller()
+            # 2.5 high and 3.75 low ticks per pulse
+            ctrl.SynchOne(1, [position_group(0, 0.01, 0.025, 6)])
+            ctrl.DeleteDevice(1)
+        self.assertEqual(self.generator_attribute('HighTicks'), 2)
+        self.assertEqual(self.generator_attribute('LowTicks'), 4)
+        self.assertEqual(self.generator_attribute('SampPerChan'), 6)
+        self.assertEqual(len(self.generator_attribute('HighTicksBuffer')), 0)
+
+    def test_buffered(self):
+        with self.sim.patch():
+            ctrl = self.make_controller()
+            ctrl.SynchOne(1, [position_group(0, 0.008, 0.02, 3),
+                              position_group(0.06, 0.016, 0.04, 2)])
+            self.assertEqual(
+                self.generator_attribute('HighTicksBuffer').tolist(),
+                [2, 2, 2, 4, 4])
+            # back to a uniform train, the pulses are forgotten
+            ctrl.SynchOne(1, [position_group(0, 0.008, 0.02, 3)])
+            ctrl.DeleteDevice(1)
+        self.assertEqual(len(self.generator_attribute('HighTicksBuffer')), 0)
+
+    def test_no_pulse_buffers(self):
+        # a device without buffered pulse generation
+        for name in ('highticksbuffer', 'lowticksbuffer'):
+            del self.generator._attributes[name]
+        with self.sim.patch():
+            ctrl = self.make_controller()
+            ctrl.SynchOne(1, [position_group(0, 0.008, 0.02, 3),
+                              position_group(0.06, 0.016, 0.04, 2)])
+            ctrl.DeleteDevice(1)
+        # only the first group is generated
+        self.assertEqual(self.generator_attribute('SampPerChan'), 3)
+        self.assertEqual(self.generator_attribute('HighTicks'), 2)
+        self.assertEqual(self.generator_attribute('LowTicks'), 3)
+        self.assertNotIn('highticksbuffer', self.generator._attributes)
+
+    def test_generation(self):
+        sim = Simulation()
+        sim.add_channel(self.POSITION, 'CIAngEncoderChan', 'ctr1')
+        generator = sim.add_channel(self.GENERATOR, 'COPulseChanTicks',
+                                    'ctr2')
+        with sim.patch():
+            ctrl = make_controller(Ni660XPositionTriggerGateController,
+                                   positionDevNames=self.POSITION,
+                                   generatorDevNames=self.GENERATOR)
+            add_axis(ctrl, 1)
+            self.assertEqual(
+                generator.read_attribute('SourceTerminal').value,
+                '/Dev1/PFI32')
+            ctrl.SetAxisPar(1, 'resolution', 0.001)
+            ctrl.SynchOne(1, [{
+                SynchParam.Initial: {SynchDomain.Position: 0},
+                SynchParam.Delay: {SynchDomain.Position: 0.1},
+                SynchParam.Active: {SynchDomain.Position: 0.008},
+                SynchParam.Total: {SynchDomain.Position: 0.02},
+                SynchParam.Repeats: 3}])
+            # X1 decoding, 4 edges of 0.001 per tick
+            self.assertEqual(generator.read_attribute('HighTicks').value, 2)
+            self.assertEqual(generator.read_attribute('LowTicks').value, 3)
+            self.assertEqual(
+                generator.read_attribute('InitialDelayTicks').value, 25)
+            ctrl.PreStartOne(1)
+            ctrl.StartOne(1)
+            sim.reset_stats()
+            ctrl.PreStartOne(1)
+            # nothing changed, nothing is written
+            writes = [key for key in sim.calls
+                      if key[1] == 'write_attributes']
+            self.assertEqual(writes, [])
+            ctrl.DeleteDevice(1)
+
+    def test_decoding(self):
+        position = self.sim.devices[self.POSITION]
+        position.write_attribute('Decoding', 'X4')
+        with self.sim.patch():
+            ctrl = self.make_controller()
+            # X1 whatever the encoder channel is configured with
+            self.assertEqual(ctrl.GetAxisPar(1, 'decoding'), 'X1')
+            ctrl.PreStartOne(1)
+            self.assertEqual(position.read_attribute('Decoding').value, 'X1')
+            ctrl.SetAxisPar(1, 'decoding', 'X4')
+            ctrl.SynchOne(1, [position_group(0, 0.008, 0.02, 3)])
+            ctrl.DeleteDevice(1)
+        self.assertEqual(self.generator_attribute('HighTicks'), 8)
+        self.assertEqual(self.generator_attribute('LowTicks'), 12)
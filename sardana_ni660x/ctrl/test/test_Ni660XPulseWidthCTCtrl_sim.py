@@ -0,0 +1,56 @@
+"""Tests of the pulse width controller on the simulated channels, see
+sardana_ni660x.simulator. They do not need the NI cards nor Tango.
+"""
+import unittest
+
+from sardana.pool import AcqSynch
+
+from sardana_ni660x.simulator import Simulation, add_axis, make_controller
+from sardana_ni660x.utils import getPFIName
+from sardana_ni660x.ctrl.Ni660XPulseWidthCTCtrl import \
+    Ni660XPulseWidthCTCtrl
+
+TIMER = 'sim/ni660x/dev1-ctr0'
+COUNTER = 'sim/ni660x/dev1-ctr1'
+CHANNEL_DEV_NAMES = ','.join([TIMER, COUNTER])
+INPUT_TERMINAL = '/Dev1/PFI36'
+
+
+class Ni660XPulseWidthCTCtrlSimTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        self.sim.add_channel(COUNTER, 'CIPulseWidthChan', 'ctr1')
+        self.patch = self.sim.patch()
+        self.patch.__enter__()
+        self.ctrl = make_controller(Ni660XPulseWidthCTCtrl,
+                                    channelDevNames=CHANNEL_DEV_NAMES)
+        for axis in (1, 2):
+            add_axis(self.ctrl, axis)
+        self.ctrl.SetAxisExtraPar(2, 'inputTerminal', INPUT_TERMINAL)
+        self.ctrl._synchronization = AcqSynch.HardwareTrigger
+
+    def tearDown(self):
+        for axis in (1, 2):
+            self.ctrl.DeleteDevice(axis)
+        self.patch.__exit__(None, None, None)
+
+    def counter_attribute(self, name):
+        return self.sim.devices[COUNTER].read_attribute(name).value
+
+    def test_source_terminal(self):
+        self.ctrl.LoadOne(1, 0.001, 10, 0)
+        self.ctrl.PreStartAll()
+        for axis in (2, 1):
+            self.ctrl.PreStartOne(axis, 0.001)
+            self.ctrl.StartOne(axis, 0.001)
+        self.ctrl.StartAll()
+        # the source terminal of the counter itself
+        self.assertEqual(self.counter_attribute('SourceTerminal'),
+                         getPFIName('/Dev1/ctr1', 'src'))
+        self.assertEqual(self.counter_attribute('SourceTerminal'),
+                         '/Dev1/PFI35')
+        self.assertEqual(self.counter_attribute('InputTerminal'),
+                         INPUT_TERMINAL)
+        self.assertEqual(self.counter_attribute('SampPerChan'), 10)
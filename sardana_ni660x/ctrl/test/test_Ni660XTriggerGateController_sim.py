@@ -0,0 +1,152 @@
+"""Tests of the trigger gate controller on the simulated channels, see
+sardana_ni660x.simulator. They do not need the NI cards nor Tango.
+"""
+import glob
+import os
+import tempfile
+import unittest
+
+from sardana import State
+from sardana.pool import SynchDomain, SynchParam
+
+from sardana_ni660x.simulator import (Simulation, add_axis, make_controller,
+                                      wait)
+from sardana_ni660x.ctrl.Ni660XTriggerGateController import \
+    Ni660XTriggerGateController
+
+TIMER = 'sim/ni660x/dev1-ctr0'
+
+
+def non_uniform_groups():
+    groups = []
+    for initial, total, repeats in ((0, 0.002, 3), (0.006, 0.004, 2)):
+        groups.append({
+            SynchParam.Initial: {SynchDomain.Time: initial},
+            SynchParam.Delay: {SynchDomain.Time: 0},
+            SynchParam.Active: {SynchDomain.Time: total / 2},
+            SynchParam.Total: {SynchDomain.Time: total},
+            SynchParam.Repeats: repeats})
+    return groups
+
+
+class Ni660XTriggerGateControllerSimTestCase(unittest.TestCase):
+
+    def test_generation(self):
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        with sim.patch():
+            ctrl = make_controller(Ni660XTriggerGateController,
+                                   channelDevNames=TIMER)
+            add_axis(ctrl, 1)
+            ctrl.SynchOne(1, [{
+                SynchParam.Delay: {SynchDomain.Time: 0},
+                SynchParam.Active: {SynchDomain.Time: 0.001},
+                SynchParam.Total: {SynchDomain.Time: 0.002},
+                SynchParam.Repeats: 5}])
+            ctrl.PreStartAll()
+            ctrl.PreStartOne(1)
+            ctrl.StartOne(1)
+            ctrl.StartAll()
+            wait(lambda: ctrl.StateOne(1)[0] == State.On)
+            ctrl.DeleteDevice(1)
+
+    def test_trace(self):
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        with sim.patch(), tempfile.TemporaryDirectory() as directory:
+            ctrl = make_controller(Ni660XTriggerGateController,
+                                   channelDevNames=TIMER)
+            add_axis(ctrl, 1)
+            ctrl.SetCtrlPar('traceDirectory', directory)
+            ctrl.SynchOne(1, non_uniform_groups()[:1])
+            ctrl.PreStartAll()
+            ctrl.PreStartOne(1)
+            ctrl.StartOne(1)
+            ctrl.StartAll()
+            wait(lambda: ctrl.StateOne(1)[0] == State.On)
+            # written once the generation finished
+            ctrl._instrumentation.flush()
+            paths = glob.glob(os.path.join(directory, '*.json'))
+            self.assertEqual(len(paths), 1)
+            ctrl.SetCtrlPar('traceDirectory', '')
+            ctrl.DeleteDevice(1)
+
+    def test_master_slave_generation(self):
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        sim.add_channel('sim/ni660x/dev1-ctr2', 'COPulseChanTime', 'ctr2')
+        with sim.patch():
+            ctrl = make_controller(
+                Ni660XTriggerGateController,
+                channelDevNames=TIMER + ',sim/ni660x/dev1-ctr2',
+                startTriggerSource='/Dev1/PFI12',
+                startTriggerType='DigEdge')
+            for axis in (1, 2):
+                add_axis(ctrl, axis)
+            ctrl.SetAxisExtraPar(2, 'slave', True)
+            for axis in (1, 2):
+                ctrl.SynchOne(axis, [{
+                    SynchParam.Delay: {SynchDomain.Time: 0},
+                    SynchParam.Active: {SynchDomain.Time: 0.001},
+                    SynchParam.Total: {SynchDomain.Time: 0.002},
+                    SynchParam.Repeats: 5}])
+            ctrl.PreStartAll()
+            # the master first, the slave is still armed before it starts
+            for axis in (1, 2):
+                ctrl.PreStartOne(axis)
+                ctrl.StartOne(axis)
+            sim.reset_stats()
+            ctrl.StartAll()
+            # the state of the slave is confirmed once before the master
+            self.assertEqual(sim.calls[('sim/ni660x/dev1-ctr2',
+                                        'read_attribute')], 1)
+            # a slave started after its master would never trigger
+            for axis in (1, 2):
+                wait(lambda: ctrl.StateOne(axis)[0] == State.On)
+            for axis in (1, 2):
+                ctrl.DeleteDevice(axis)
+
+    def test_non_uniform_generation(self):
+        sim = Simulation()
+        channel = sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        with sim.patch():
+            ctrl = make_controller(Ni660XTriggerGateController,
+                                   channelDevNames=TIMER)
+            add_axis(ctrl, 1)
+            groups = non_uniform_groups()
+            ctrl.SynchOne(1, groups)
+            high_times = channel.read_attribute('HighTimeBuffer').value
+            self.assertEqual(high_times.tolist(),
+                             [0.001] * 3 + [0.002] * 2)
+            self.assertEqual(channel.read_attribute('SampPerChan').value, 5)
+            ctrl.PreStartAll()
+            ctrl.PreStartOne(1)
+            ctrl.StartOne(1)
+            ctrl.StartAll()
+            wait(lambda: ctrl.StateOne(1)[0] == State.On)
+            # a uniform synchronization forgets the pulses
+            ctrl.SynchOne(1, groups[:1])
+            self.assertEqual(
+                len(channel.read_attribute('HighTimeBuffer').value), 0)
+            ctrl.DeleteDevice(1)
+
+    def test_no_pulse_buffers(self):
+        sim = Simulation()
+        channel = sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        # a device without buffered pulse generation
+        for name in ('hightimebuffer', 'lowtimebuffer'):
+            del channel._attributes[name]
+        with sim.patch():
+            ctrl = make_controller(Ni660XTriggerGateController,
+                                   channelDevNames=TIMER)
+            add_axis(ctrl, 1)
+            groups = non_uniform_groups()
+            ctrl.SynchOne(1, groups)
+            # only the first group is generated
+            self.assertEqual(channel.read_attribute('SampPerChan').value, 3)
+            self.assertEqual(channel.read_attribute('HighTime').value, 0.001)
+            self.assertNotIn('hightimebuffer', channel._attributes)
+            # there are no pulses to forget
+            ctrl.SynchOne(1, groups[:1])
+            self.assertNotIn('hightimebuffer', channel._attributes)
+            ctrl.DeleteDevice(1)
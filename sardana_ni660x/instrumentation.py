@@ -0,0 +1,326 @@
+"""Low overhead instrumentation of the controllers.
+
+It counts the Tango calls and bytes transferred per channel, keeps the
+latency histograms of the controller methods and the dead time of each
+acquisition. Optionally it records the timeline of the controller and
+Tango calls of each acquisition, see sardana_ni660x.trace. It is switched
+on and off at runtime, when off the instrumented methods pay only the
+check of the active flag::
+
+    class Ctrl:
+
+        def __init__(self):
+            self._instrumentation = Instrumentation()
+
+        @instrumented
+        def ReadOne(self, axis):
+            ...
+
+    ctrl._instrumentation.enable()
+    ...
+    print(json.dumps(ctrl._instrumentation.dump()))
+"""
+import collections
+import functools
+import math
+import os
+import threading
+import time
+
+from sardana import State
+
+from sardana_ni660x.trace import TraceRecorder
+
+INSTRUMENTATION_DOC = ('Collect the Tango calls and bytes per channel, the'
+                       ' latency of the controller methods and the dead time'
+                       ' of the acquisitions. Enabling it clears the'
+                       ' previous data.')
+
+INSTRUMENTATIONDATA_DOC = ('Data collected by the instrumentation, in JSON'
+                           ' format')
+
+TRACEDIRECTORY_DOC = ('Directory where the timeline of the controller and'
+                      ' Tango calls of each acquisition is written, in the'
+                      ' Chrome trace format. Empty to disable the traces.')
+
+# the latencies are binned in powers of 2 from 1 us up to about 67 s
+HISTOGRAM_MIN = 1e-6
+HISTOGRAM_BINS = 27
+
+
+class Histogram:
+    """Latency histogram with logarithmic bins."""
+
+    def __init__(self):
+        self.bins = [0] * HISTOGRAM_BINS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        if value > HISTOGRAM_MIN:
+            index = min(int(math.log2(value / HISTOGRAM_MIN)),
+                        HISTOGRAM_BINS - 1)
+        else:
+            index = 0
+        self.bins[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Upper bound of the bin of the q percentile."""
+        if not self.count:
+            return 0.
+        rank = q / 100 * self.count
+        accumulated = 0
+        for index, count in enumerate(self.bins):
+            accumulated += count
+            if accumulated >= rank:
+                break
+        return min(HISTOGRAM_MIN * 2 ** (index + 1), self.max)
+
+    def dump(self):
+        # bins are keyed by their upper bound
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'bins': {'%g' % (HISTOGRAM_MIN * 2 ** (index + 1)): count
+                     for index, count in enumerate(self.bins) if count},
+        }
+
+
+class Instrumentation:
+    """Statistics of the hot path of a controller."""
+
+    def __init__(self, name='controller'):
+        self.name = name
+        self.enabled = False
+        # the statistics or the trace are being collected
+        self.active = False
+        self.trace = None
+        self.trace_directory = ''
+        self._trace_index = 0
+        self._writer = None
+        self._acquiring = False
+        # the trace of the finished acquisition is exported once the
+        # instrumented methods in progress, if any, are recorded in it
+        self._export_due = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.clear()
+
+    def _update(self):
+        self.active = self.enabled or self.trace is not None
+
+    def enable(self, enabled=True):
+        """Switch the instrumentation, enabling it starts a new
+        collection.
+        """
+        if enabled and not self.enabled:
+            self.clear()
+        self.enabled = bool(enabled)
+        self._update()
+
+    def set_trace_directory(self, directory):
+        """Write the trace of each acquisition to the directory, an empty
+        one disables the traces. The current trace is written first.
+        """
+        if self._acquiring or self._export_due:
+            self._export_due = False
+            self._export_trace()
+        self.flush()
+        self.trace_directory = directory
+        self.trace = TraceRecorder(self.name) if directory else None
+        self._update()
+
+    def _export_trace(self):
+        trace = self.trace
+        if trace is None or not trace.events:
+            return
+        self._trace_index += 1
+        path = os.path.join(self.trace_directory, '%s-%04d.json' % (
+            self.name, self._trace_index))
+        # do not delay the acquisition with the file writing
+        self._writer = threading.Thread(target=trace.export, args=(path,),
+                                        daemon=True)
+        self._writer.start()
+
+    def flush(self):
+        """Wait until the last exported trace is written."""
+        writer = self._writer
+        if writer is not None:
+            writer.join()
+
+    def clear(self):
+        with self._lock:
+            self.calls = collections.Counter()
+            self.nbytes = collections.Counter()
+            self.latencies = collections.defaultdict(Histogram)
+            self.dead_time = Histogram()
+            self.acquisitions = 0
+            self._acquisition = None
+            self._states = {}
+
+    def begin(self):
+        """Start time of a Tango call, None if not active."""
+        if self.active:
+            return time.perf_counter()
+        return None
+
+    def tango(self, channel, operation, start, nbytes=0):
+        """Account a Tango call to the channel, started at the time
+        returned by begin, which transferred nbytes.
+        """
+        if start is None:
+            return
+        end = time.perf_counter()
+        if self.enabled:
+            with self._lock:
+                self.calls[channel] += 1
+                self.nbytes[channel] += nbytes
+        trace = self.trace
+        if trace is not None:
+            trace.span(operation, 'tango', start, end, channel=channel,
+                       bytes=nbytes)
+
+    def record(self, name, start, end, args=()):
+        """Account a call of the controller method name."""
+        if self.enabled:
+            with self._lock:
+                self.latencies[name].add(end - start)
+        trace = self.trace
+        if trace is not None:
+            # only the simple arguments, e.g. the axis, are traced
+            args = [arg for arg in args
+                    if isinstance(arg, (int, float, str))]
+            trace.span(name, 'api', start, end, args=args)
+
+    def call(self, name, function, *args):
+        """Call the function recording its latency under name."""
+        if not self.active:
+            return function(*args)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def state(self, axis, state):
+        """Note the state of the axis in the trace, when it changes."""
+        trace = self.trace
+        if trace is None:
+            return
+        states = self._states
+        if states.get(axis) != state:
+            states[axis] = state
+            trace.instant('axis %d %s' % (axis, State.whatis(state)), 'state')
+
+    def start_acquisition(self, live_time=None):
+        """Start the dead time measurement of an acquisition which will
+        integrate live_time seconds in total, if given, and the trace of
+        it. The previous acquisition is finished, if it was not yet.
+        """
+        if not self.active:
+            return
+        self.end_acquisition()
+        if self._export_due:
+            # the starting method belongs to the new trace
+            self._export_due = False
+            self._export_trace()
+        if self.trace is not None:
+            self.trace = TraceRecorder(self.name)
+            self._states = {}
+        if self.enabled and live_time is not None:
+            self._acquisition = [time.perf_counter(), None, live_time]
+        self._acquiring = True
+
+    def mark_acquisition(self):
+        """Note the last activity, e.g. a readout, of the acquisition."""
+        acquisition = self._acquisition
+        if acquisition is not None:
+            acquisition[1] = time.perf_counter()
+
+    def end_acquisition(self):
+        """Finish the current acquisition, called by the controllers once
+        it is over, e.g. after its last readout. Its dead time, the time
+        from its start to its last activity not spent integrating, is
+        recorded and its trace written. Only the first call after a start
+        has an effect.
+        """
+        if not self._acquiring:
+            return
+        self._acquiring = False
+        acquisition, self._acquisition = self._acquisition, None
+        if acquisition is not None and acquisition[1] is not None:
+            start, end, live_time = acquisition
+            with self._lock:
+                self.dead_time.add(max(end - start - live_time, 0.))
+                self.acquisitions += 1
+        if self.trace is not None:
+            self._export_due = True
+            if not getattr(self._local, 'depth', 0):
+                self._finish_trace()
+
+    def _finish_trace(self):
+        self._export_due = False
+        self._export_trace()
+        # the calls until the next acquisition are not exported
+        self.trace = TraceRecorder(self.name)
+
+    def enter(self):
+        """Note the start of an instrumented method in this thread."""
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+
+    def leave(self):
+        """Note the end of an instrumented method in this thread, after it
+        was recorded.
+        """
+        depth = max(getattr(self._local, 'depth', 0) - 1, 0)
+        self._local.depth = depth
+        if not depth and self._export_due and self.trace is not None:
+            self._finish_trace()
+
+    def dump(self):
+        """Data collected so far as a JSON serializable dict."""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'calls': dict(self.calls),
+                'bytes': dict(self.nbytes),
+                'latency': {name: histogram.dump() for name, histogram
+                            in sorted(self.latencies.items())},
+                'acquisitions': self.acquisitions,
+                'dead_time': self.dead_time.dump(),
+            }
+
+
+def payload_size(attr_values):
+    """Approximate bytes of the (name, value) pairs written to a device."""
+    return sum(getattr(value, 'nbytes', 8) for _, value in attr_values)
+
+
+def instrumented(method):
+    """Record the latency of the controller method in the instrumentation
+    of the controller, if enabled.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        instrumentation = self._instrumentation
+        if not instrumentation.active:
+            return method(self, *args)
+        start = time.perf_counter()
+        instrumentation.enter()
+        try:
+            return method(self, *args)
+        finally:
+            instrumentation.record(name, start, time.perf_counter(), args)
+            instrumentation.leave()
+
+    return wrapper
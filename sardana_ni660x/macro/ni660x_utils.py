@@ -1,6 +1,7 @@
 from sardana.macroserver.macro import Macro, Type, Hookable
-import taurus
-import PyTango
+
+# the proxies are not released, they are kept for the next macro runs
+from sardana_ni660x.proxies import get_proxy
 
 
 NI660X_PFI = {'C0O': 'PFI36', 'C0A': 'PFI37', 'C0G': 'PFI38', 'C0S': 'PFI39',
@@ -25,7 +26,7 @@ class ni_trigger(Macro, Hookable):
 
     def run(self, ntriggers):
         ni_channel_name = self.getEnv('NITriggerChannel')
-        channel = taurus.Device(ni_channel_name)
+        channel = get_proxy(ni_channel_name)
         channel.command_inout('Stop')
         if ntriggers > 0:
             channel.write_attribute("SampPerChan", int(ntriggers))
@@ -47,7 +48,7 @@ class ni_config_trigger(Macro):
 
     def run(self, high_time, low_time, ntriggers, idle_state, delay_time):
         ni_channel_name = self.getEnv('NITriggerChannel')
-        channel = taurus.Device(ni_channel_name)
+        channel = get_proxy(ni_channel_name)
         channel.command_inout('Stop')
         channel.write_attribute("InitialDelayTime", delay_time)
         channel.write_attribute("HighTime", high_time)
@@ -86,7 +87,7 @@ class ni_connect_channels(Macro):
         except Exception as e:
             self.error('You should declare the Ni660XDsName. %s' % e)
 
-        ni_device = taurus.Device(ni_device_name)
+        ni_device = get_proxy(ni_device_name)
 
         for chn in channels:
             chn = chn.upper()
@@ -138,7 +139,7 @@ class ni_config_counter(Macro):
 
         if mode == 'continuous':
             for ni_chn_name in ni_chn_names:
-                chn_proxy = taurus.Device(ni_chn_name)
+                chn_proxy = get_proxy(ni_chn_name)
                 chn_proxy.init()
                 chn_proxy.write_attribute('SampleClockSource',
                                           ni_signal_master)
@@ -148,13 +149,13 @@ class ni_config_counter(Macro):
                                               'Interrupts')
         else:
             for ni_chn_name in ni_chn_names:
-                chn_proxy = taurus.Device(ni_chn_name)
+                chn_proxy = get_proxy(ni_chn_name)
                 chn_proxy.init()
                 chn_proxy.write_attribute('PauseTriggerType', 'DigLvl')
                 chn_proxy.write_attribute('PauseTriggerSource',
                                           ni_signal_master)
                 chn_proxy.write_attribute('PauseTriggerWhen', 'Low')
-            master_proxy = PyTango.DeviceProxy(ni_channel_master)
+            master_proxy = get_proxy(ni_channel_master)
             master_proxy.init()
             master_proxy.write_attribute('InitialDelayTime', 0)
             master_proxy.write_attribute('LowTime', 0.001)
@@ -0,0 +1,160 @@
+"""Process-wide registry of the Tango device proxies.
+
+The controllers and utilities of several elements often talk to the same
+devices, e.g. the Ni660X cards. They get the proxies from this registry so
+each device is connected only once per process::
+
+    proxy = get_proxy('io/ni660x/dev1')
+    ...
+    release_proxy('io/ni660x/dev1')
+
+A proxy is registered on its first get and dropped when the last user
+releases it. The users which need a different timeout of the calls get
+their own proxy, shared only with the users of the same timeout, so it
+does not affect the others. It connects to the device only when it is
+used for the first time, and if the connection fails the next use tries
+to connect again. The connected proxies reconnect transparently when
+their device is restarted.
+"""
+import threading
+
+import tango
+
+
+class LazyDeviceProxy:
+    """DeviceProxy which connects to the device on its first use. The
+    timeout set before is kept and applied when it connects.
+    """
+
+    def __init__(self, name, timeout=None):
+        self._name = name
+        self._proxy = None
+        self._timeout = timeout
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self):
+        return self._proxy is not None
+
+    def _connect(self):
+        with self._lock:
+            if self._proxy is None:
+                proxy = tango.DeviceProxy(self._name)
+                try:
+                    proxy.set_transparency_reconnection(True)
+                except AttributeError:
+                    pass
+                if self._timeout is not None:
+                    proxy.set_timeout_millis(self._timeout)
+                self._proxy = proxy
+            return self._proxy
+
+    def connect(self):
+        """Connect now instead of on the first use."""
+        if self._proxy is None:
+            self._connect()
+
+    def get_timeout_millis(self):
+        with self._lock:
+            if self._proxy is None and self._timeout is not None:
+                return self._timeout
+        return self.__getattr__('get_timeout_millis')()
+
+    def set_timeout_millis(self, timeout):
+        """Set the timeout of the calls, without connecting if not yet."""
+        with self._lock:
+            self._timeout = timeout
+            if self._proxy is None:
+                return
+        self._proxy.set_timeout_millis(timeout)
+
+    def __getattr__(self, name):
+        proxy = self._proxy
+        if proxy is None:
+            proxy = self._connect()
+        return getattr(proxy, name)
+
+    def __repr__(self):
+        return 'LazyDeviceProxy(%r)' % self._name
+
+
+class ProxyRegistry:
+    """Reference counted LazyDeviceProxy instances keyed by device name and
+    timeout, None for the default timeout.
+    """
+
+    def __init__(self):
+        self._proxies = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, timeout):
+        # Tango device names are case insensitive
+        return name.lower(), timeout
+
+    def get(self, name, timeout=None):
+        """Get the proxy of the device, registering it if needed, and count
+        one more user of it.
+        """
+        key = self._key(name, timeout)
+        with self._lock:
+            proxy = self._proxies.get(key)
+            if proxy is None:
+                proxy = self._proxies[key] = LazyDeviceProxy(name, timeout)
+                self._counts[key] = 0
+            self._counts[key] += 1
+            return proxy
+
+    def release(self, name, timeout=None):
+        """Count one user less of the device proxy, the proxy is dropped
+        when it has no users.
+        """
+        key = self._key(name, timeout)
+        with self._lock:
+            if key not in self._counts:
+                return
+            self._counts[key] -= 1
+            if self._counts[key] <= 0:
+                del self._counts[key]
+                del self._proxies[key]
+
+    def count(self, name, timeout=None):
+        """Number of users of the device proxy."""
+        with self._lock:
+            return self._counts.get(self._key(name, timeout), 0)
+
+
+_registry = ProxyRegistry()
+
+
+def get_proxy(name, timeout=None):
+    """Get the shared proxy of the device, see ProxyRegistry.get."""
+    return _registry.get(name, timeout)
+
+
+def release_proxy(name, timeout=None):
+    """Release the shared proxy of the device, see ProxyRegistry.release."""
+    _registry.release(name, timeout)
+
+
+class SharedAttribute:
+    """Attribute of a device accessed through the shared device proxy, it
+    replaces tango.AttributeProxy.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.device_name, self.attr_name = name.rsplit('/', 1)
+        self._proxy = get_proxy(self.device_name)
+
+    def connect(self):
+        self._proxy.connect()
+
+    def read(self):
+        return self._proxy.read_attribute(self.attr_name)
+
+    def release(self):
+        if self._proxy is not None:
+            self._proxy = None
+            release_proxy(self.device_name)
@@ -0,0 +1,751 @@
+"""In-process simulation of Ni660XCounter channels and Ni660X cards.
+
+The simulated devices are drop-in stand-ins of tango.DeviceProxy, so the
+controllers can be exercised and benchmarked without NI cards nor Tango
+servers, e.g.::
+
+    sim = Simulation(latency=0.0005)
+    sim.add_channel('sim/ni660x/ctr0', 'COPulseChanTime', 'ctr0')
+    sim.add_channel('sim/ni660x/ctr1', 'CICountEdgesChan', 'ctr1')
+    with sim.patch():
+        ctrl = make_controller(Ni660XCounterCTCtrl,
+                               channelDevNames='sim/ni660x/ctr0,'
+                                               'sim/ni660x/ctr1')
+
+The channels model the applicationType, counterName and DeviceName
+properties, the buffer attributes, SampPerChan, the timing attributes and
+the STANDBY -> RUNNING -> ON state transitions. If change_events is set
+the channels push the change events of the State and of the buffer
+attribute, delivered event_delay seconds later. Input channels are clocked
+by the last started COPulseChanTime channel, or by sample_period if there
+is none. The input channels gated through the pause trigger take two
+samples per pulse of the COPulseChanTime channels started after them, the
+counts of the gap and of the high time. Every call takes latency seconds
+plus the transferred bytes divided by bandwidth, and is accounted in the
+simulation statistics.
+"""
+import collections
+import contextlib
+import threading
+import time
+import types
+
+import numpy
+import tango
+
+from sardana.pool.controller import DefaultValue
+
+from sardana_ni660x import proxies, utils
+
+# buffer attribute of each input application type
+BUFFER_ATTRS = {
+    'CICountEdgesChan': 'countbuffer',
+    'CIAngEncoderChan': 'positionbuffer',
+    'CIPulseWidthChan': 'pulsewidthbuffer',
+}
+
+GENERATOR_TYPES = ('COPulseChanTime', 'COPulseChanTicks')
+
+DEFAULT_ATTRIBUTES = {
+    'sampperchan': 1,
+    'sampletimingtype': 'Implicit',
+    'samplemode': 'Finite',
+    'sampleclocksource': '',
+    'datatransfermechanism': 'DMA',
+    'hightime': 0.01,
+    'lowtime': 0.01,
+    'initialdelaytime': 0,
+    'highticks': 2,
+    'lowticks': 2,
+    'initialdelayticks': 0,
+    'sourceterminal': '',
+    'inputterminal': '',
+    'outputeventterminal': '',
+    'outputeventbehaviour': 'Pulse',
+    'zindexval': 0,
+    'initialpos': 0,
+    'idlestate': 'Low',
+    'starttriggersource': 'None',
+    'starttriggertype': 'None',
+    'retriggerable': False,
+    'bufferoffset': 0,
+    'units': 'Ticks',
+    'pulsesperrevolution': 1,
+    'zindexenabled': False,
+    'decoding': 'X1',
+    'pausetriggertype': 'None',
+    'pausetriggersource': '',
+    'pausetriggerwhen': 'Low',
+    'hightimebuffer': numpy.empty(0),
+    'lowtimebuffer': numpy.empty(0),
+    'highticksbuffer': numpy.empty(0, numpy.int64),
+    'lowticksbuffer': numpy.empty(0, numpy.int64),
+}
+
+
+def _throw(reason, desc):
+    tango.Except.throw_exception(reason, desc, 'sardana_ni660x.simulator')
+
+
+def _nbytes(value):
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, str):
+        return len(value)
+    return 8
+
+
+class SimulatedDevice:
+    """Base of the simulated devices: properties, calls accounting and
+    commands resolution.
+    """
+
+    def __init__(self, simulation, name, properties=None):
+        self._sim = simulation
+        self._name = name
+        self._properties = dict(properties or {})
+        self._lock = threading.Lock()
+        self._timeout = 3000
+        self._intr_callbacks = {}
+        # False to leave the properties out of the simulated database, e.g.
+        # a device of another Tango host
+        self.in_database = True
+
+    def _call(self, name, nbytes=0):
+        self._sim._account(self._name, name, nbytes)
+
+    def __getattr__(self, name):
+        # Tango commands are case insensitive
+        method = self._commands().get(name.lower())
+        if method is None:
+            raise AttributeError(name)
+        return method
+
+    def _commands(self):
+        return {}
+
+    def dev_name(self):
+        return self._name
+
+    def name(self):
+        return self._name
+
+    def ping(self):
+        self._call('ping')
+        return 0
+
+    def get_timeout_millis(self):
+        return self._timeout
+
+    def set_timeout_millis(self, timeout):
+        self._timeout = timeout
+
+    def get_property(self, names):
+        self._call('get_property')
+        return self._get_property(names)
+
+    def _get_property(self, names):
+        if isinstance(names, str):
+            names = [names]
+        # the property names are case insensitive
+        properties = {key.lower(): value
+                      for key, value in self._properties.items()}
+        return {name: [str(properties[name.lower()])]
+                if name.lower() in properties else [] for name in names}
+
+    def command_inout(self, name, *args):
+        method = self._commands().get(name.lower())
+        if method is None:
+            _throw('API_CommandNotFound', 'Command %s not found' % name)
+        return method(*args)
+
+    def subscribe_event(self, *args, **kwargs):
+        if args and args[0] == tango.EventType.INTERFACE_CHANGE_EVENT:
+            callback = args[1]
+            event_id = self._sim._next_event_id()
+            self._intr_callbacks[event_id] = callback
+            callback(self._intr_event(False))
+            return event_id
+        _throw('API_AttributePollingNotStarted',
+               'The simulated devices do not push events')
+
+    def unsubscribe_event(self, event_id):
+        self._intr_callbacks.pop(event_id, None)
+
+    def _intr_event(self, started):
+        return types.SimpleNamespace(err=False, errors=(), dev_started=started,
+                                     device_name=self._name)
+
+    def _push_interface_change(self, started):
+        for callback in list(self._intr_callbacks.values()):
+            callback(self._intr_event(started))
+
+    def restart(self):
+        """Restart the device, it is initialized and, as Tango does when a
+        device starts, the interface change event is pushed.
+        """
+        self.Init()
+        self._push_interface_change(True)
+
+
+class SimulatedDatabase:
+    """Simulated tango.Database with the properties of the simulated
+    devices.
+    """
+
+    def __init__(self, simulation):
+        self._sim = simulation
+
+    def get_device_property(self, name, properties):
+        self._sim._account('database', 'get_device_property', 0)
+        device = self._sim.devices.get(name.lower())
+        if device is None or not device.in_database:
+            # as Tango, empty values for the undefined devices
+            if isinstance(properties, str):
+                properties = [properties]
+            return {prop: [] for prop in properties}
+        return device._get_property(properties)
+
+
+class SimulatedCard(SimulatedDevice):
+    """Simulated Ni660X card device, it records the routed terminals."""
+
+    def __init__(self, simulation, name):
+        super().__init__(simulation, name)
+        self.routes = {}
+
+    def _commands(self):
+        return {'connectterms': self.ConnectTerms,
+                'disconnectterms': self.DisconnectTerms,
+                'state': self.State,
+                'init': self.Init}
+
+    def ConnectTerms(self, args):
+        self._call('ConnectTerms')
+        src, dest, polarity = args
+        self.routes[dest] = (src, polarity)
+
+    def DisconnectTerms(self, args):
+        self._call('DisconnectTerms')
+        src, dest = args[:2]
+        self.routes.pop(dest, None)
+
+    def State(self):
+        self._call('State')
+        return tango.DevState.ON
+
+    def Init(self):
+        # as the real devices, whose interface does not change, it does not
+        # push the interface change event
+        self._call('Init')
+        self.routes = {}
+
+
+class SimulatedChannel(SimulatedDevice):
+    """Simulated Ni660XCounter channel."""
+
+    def __init__(self, simulation, name, application_type, counter_name,
+                 device_name):
+        properties = {'applicationType': application_type,
+                      'counterName': counter_name,
+                      'DeviceName': device_name}
+        super().__init__(simulation, name, properties)
+        self.application_type = application_type
+        # change event callbacks by event id, the queued events and the
+        # last queued value of each attribute
+        self._change_callbacks = {}
+        self._events = collections.deque()
+        self._published = {}
+        self._publisher = None
+        self._reset()
+
+    def _reset(self):
+        self._attributes = dict(DEFAULT_ATTRIBUTES)
+        self._state = tango.DevState.STANDBY
+        self._start_time = None
+
+    def _commands(self):
+        return {'start': self.Start,
+                'stop': self.Stop,
+                'state': self.State,
+                'init': self.Init}
+
+    # timing model
+
+    def _period(self):
+        return (self._attributes['hightime'] +
+                self._attributes['lowtime'])
+
+    def _is_generator(self):
+        return self.application_type in GENERATOR_TYPES
+
+    def _is_slave(self):
+        return self._attributes['starttriggersource'] not in ('None', '')
+
+    def _is_gated(self):
+        return not self._is_generator() and \
+            self._attributes['pausetriggertype'] == 'DigLvl'
+
+    def _gated_counts(self):
+        """Samples of the gated channel: the counts before and during each
+        pulse completed since the start.
+        """
+        now = time.monotonic()
+        counts = []
+        for start, high, low, pulses in self._sim._trains(self._start_time):
+            if now - start < high:
+                continue
+            done = min(pulses, int((now - start - high) / (high + low)) + 1)
+            counts.extend([0, int(round(high * self._sim.count_rate))] * done)
+        return numpy.array(counts, dtype=numpy.uint32)
+
+    def _origin(self):
+        """Return the time of the first sample and the sample period, the
+        time is None if the channel is waiting for a trigger.
+        """
+        if self._is_generator():
+            start = self._start_time
+            if self._is_slave():
+                start = self._sim._master_start(self._start_time)
+                if start is None:
+                    return None, self._period()
+            return start + self._attributes['initialdelaytime'], \
+                self._period()
+        clock = self._sim._clock(self)
+        if clock is None:
+            return self._start_time, self._sim.sample_period
+        clock_start, period = clock
+        return max(self._start_time, clock_start), period
+
+    def _acquired(self):
+        """Number of samples acquired so far, it updates the state."""
+        if self._start_time is None:
+            return 0
+        samples = int(self._attributes['sampperchan'])
+        if self._state != tango.DevState.RUNNING:
+            return samples if self._state == tango.DevState.ON else 0
+        if self._is_gated():
+            acquired = len(self._gated_counts())
+            if self._attributes['samplemode'] == 'ContSamps':
+                return acquired
+            acquired = min(samples, acquired)
+            if acquired == samples:
+                self._state = tango.DevState.ON
+            return acquired
+        start, period = self._origin()
+        if start is None:
+            return 0
+        elapsed = time.monotonic() - start
+        pulses = self._attributes['hightimebuffer'] + \
+            self._attributes['lowtimebuffer']
+        if self._is_generator() and len(pulses):
+            acquired = int(numpy.searchsorted(numpy.cumsum(pulses), elapsed,
+                                              side='right'))
+        else:
+            acquired = max(0, int(elapsed / period))
+        acquired = min(samples, acquired)
+        if acquired == samples:
+            self._state = tango.DevState.ON
+        return acquired
+
+    def _buffer(self):
+        acquired = self._acquired()
+        if self._is_gated():
+            return self._gated_counts()[:acquired]
+        start, period = self._origin()
+        if self.application_type == 'CICountEdgesChan':
+            counts = int(period * self._sim.count_rate)
+            return numpy.full(acquired, counts, dtype=numpy.uint32)
+        if self.application_type == 'CIAngEncoderChan':
+            return numpy.arange(1, acquired + 1, dtype=numpy.float64) * \
+                self._sim.position_step
+        return numpy.full(acquired, period / 2, dtype=numpy.float64)
+
+    # change events
+
+    def _change_event(self, name, value):
+        return types.SimpleNamespace(
+            err=False, errors=(), attr_name=name,
+            attr_value=types.SimpleNamespace(name=name, value=value))
+
+    def _queue_changes(self):
+        """Queue the events of the State and the buffer if they changed
+        since they were last queued, called with the lock held.
+        """
+        if not self._change_callbacks:
+            return
+        acquired = self._acquired()
+        due = time.monotonic() + (self._sim.event_delay or 0)
+        if self._published.get('state') != self._state:
+            self._published['state'] = self._state
+            self._events.append((due, 'state', self._state))
+        buffer_attr = BUFFER_ATTRS.get(self.application_type)
+        if buffer_attr is not None and \
+                self._published.get(buffer_attr) != acquired:
+            self._published[buffer_attr] = acquired
+            self._events.append((due, buffer_attr, self._buffer()))
+
+    def _deliver(self, count=None, due_only=True):
+        delivered = []
+        with self._lock:
+            now = time.monotonic()
+            while self._events and (count is None or len(delivered) < count):
+                if due_only and self._events[0][0] > now:
+                    break
+                delivered.append(self._events.popleft())
+            callbacks = list(self._change_callbacks.values())
+        for _, name, value in delivered:
+            for attr_name, callback in callbacks:
+                if attr_name == name:
+                    callback(self._change_event(name, value))
+
+    def deliver_events(self, count=None):
+        """Deliver now the count, all if None, first queued events. It is
+        used with event_delay None, which queues the events until then.
+        """
+        self._deliver(count, due_only=False)
+
+    def _publish(self):
+        # the timing model advances only when it is evaluated
+        while True:
+            with self._lock:
+                if not self._change_callbacks:
+                    self._publisher = None
+                    return
+                self._queue_changes()
+            if self._sim.event_delay is not None:
+                self._deliver()
+            time.sleep(0.001)
+
+    def subscribe_event(self, *args, **kwargs):
+        if len(args) < 3 or args[1] != tango.EventType.CHANGE_EVENT or \
+                not self._sim.change_events:
+            return super().subscribe_event(*args, **kwargs)
+        name, callback = args[0].lower(), args[2]
+        event_id = self._sim._next_event_id()
+        with self._lock:
+            value = self._read(name)
+            self._change_callbacks[event_id] = (name, callback)
+            if self._publisher is None:
+                self._publisher = threading.Thread(target=self._publish,
+                                                   daemon=True)
+                self._publisher.start()
+        # as Tango, the current value is pushed on subscription
+        callback(self._change_event(name, value))
+        return event_id
+
+    def unsubscribe_event(self, event_id):
+        super().unsubscribe_event(event_id)
+        with self._lock:
+            self._change_callbacks.pop(event_id, None)
+
+    # Tango interface
+
+    def State(self):
+        self._call('State')
+        with self._lock:
+            self._acquired()
+            return self._state
+
+    def state(self):
+        return self.State()
+
+    def Start(self):
+        self._call('Start')
+        with self._lock:
+            self._acquired()
+            if self._state == tango.DevState.RUNNING:
+                _throw('NI_TaskRunning', 'Channel %s is running' % self._name)
+            self._state = tango.DevState.RUNNING
+            self._start_time = time.monotonic()
+            self._queue_changes()
+        if self._is_generator() and not self._is_slave():
+            self._sim._generator_started(self)
+
+    def Stop(self):
+        self._call('Stop')
+        with self._lock:
+            self._state = tango.DevState.STANDBY
+            self._queue_changes()
+
+    def Init(self):
+        # as the real devices, whose interface does not change, it does not
+        # push the interface change event
+        self._call('Init')
+        with self._lock:
+            self._reset()
+
+    def _read(self, name):
+        key = name.lower()
+        if key == 'state':
+            self._acquired()
+            return self._state
+        if key == BUFFER_ATTRS.get(self.application_type):
+            return self._buffer()
+        if key not in self._attributes:
+            _throw('API_AttrNotFound', 'Attribute %s not found' % name)
+        return self._attributes[key]
+
+    def _write(self, name, value):
+        key = name.lower()
+        if key not in self._attributes:
+            _throw('API_AttrNotFound', 'Attribute %s not found' % name)
+        if key != 'bufferoffset' and self._state != tango.DevState.STANDBY:
+            _throw('NI_NotStandby',
+                   'Attribute %s can be written only in STANDBY' % name)
+        self._attributes[key] = value
+
+    def get_attribute_list(self):
+        self._call('get_attribute_list')
+        names = ['State', 'Status'] + list(self._attributes)
+        buffer_attr = BUFFER_ATTRS.get(self.application_type)
+        if buffer_attr is not None:
+            names.append(buffer_attr)
+        return names
+
+    def read_attribute(self, name, *args, **kwargs):
+        with self._lock:
+            value = self._read(name)
+        self._call('read_attribute', _nbytes(value))
+        return types.SimpleNamespace(name=name, value=value)
+
+    def read_attributes(self, names, *args, **kwargs):
+        with self._lock:
+            values = [self._read(name) for name in names]
+        self._call('read_attributes', sum(_nbytes(v) for v in values))
+        return [types.SimpleNamespace(name=name, value=value)
+                for name, value in zip(names, values)]
+
+    def write_attribute(self, name, value):
+        self._call('write_attribute', _nbytes(value))
+        with self._lock:
+            self._write(name, value)
+
+    def write_attributes(self, attr_values):
+        attr_values = list(attr_values)
+        self._call('write_attributes',
+                   sum(_nbytes(value) for _, value in attr_values))
+        with self._lock:
+            for name, value in attr_values:
+                self._write(name, value)
+
+    def write_read_attributes(self, attr_values, names, *args, **kwargs):
+        attr_values = list(attr_values)
+        with self._lock:
+            for name, value in attr_values:
+                self._write(name, value)
+            values = [self._read(name) for name in names]
+            offset = int(self._attributes['bufferoffset'])
+            buffer_attr = BUFFER_ATTRS.get(self.application_type)
+            values = [value[offset:] if name.lower() == buffer_attr
+                      else value for name, value in zip(names, values)]
+        self._call('write_read_attributes',
+                   sum(_nbytes(v) for v in values))
+        return [types.SimpleNamespace(name=name, value=value)
+                for name, value in zip(names, values)]
+
+
+class SimulatedExternalDevice(SimulatedDevice):
+    """Simulated device other than the Ni660X ones, e.g. the motor whose
+    position is the initial position of an encoder. Its attribute values
+    are taken from Simulation.attribute_values.
+    """
+
+    def read_attribute(self, name, *args, **kwargs):
+        full_name = '%s/%s' % (self._name, name)
+        value = self._sim.attribute_values.get(full_name.lower())
+        if value is None:
+            _throw('API_AttrNotFound', 'Attribute %s not found' % full_name)
+        self._call('read_attribute', _nbytes(value))
+        return types.SimpleNamespace(name=name, value=value)
+
+
+class Simulation:
+    """Set of simulated devices with a common timing and cost model.
+
+    :param latency: time in seconds taken by every call
+    :param bandwidth: bytes per second transferred by the calls, None for
+                      an unlimited bandwidth
+    :param sample_period: sample period of the input channels when there
+                          is no generator channel running
+
+    change_events enables the change events of the channels and
+    event_delay is the time in seconds they take to be delivered, None to
+    queue them until SimulatedChannel.deliver_events.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, sample_period=0.01,
+                 count_rate=1e4, position_step=1.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sample_period = sample_period
+        self.count_rate = count_rate
+        self.position_step = position_step
+        self.change_events = False
+        self.event_delay = 0.0
+        self.devices = {}
+        # values of the attributes of the external devices by full name
+        self.attribute_values = {}
+        self.calls = collections.Counter()
+        self.nbytes = collections.Counter()
+        self._lock = threading.Lock()
+        self._event_id = 0
+        self._generators = []
+        self._pulse_trains = []
+
+    def add_channel(self, name, application_type, counter_name='ctr0',
+                    device_name='Dev1'):
+        channel = SimulatedChannel(self, name, application_type,
+                                   counter_name, device_name)
+        self.devices[name.lower()] = channel
+        return channel
+
+    def add_card(self, name):
+        card = SimulatedCard(self, name)
+        self.devices[name.lower()] = card
+        return card
+
+    def device(self, name, *args, **kwargs):
+        """Get the simulated device, it has the tango.DeviceProxy
+        signature.
+        """
+        key = name.lower()
+        if key not in self.devices:
+            if not any(attr.startswith(key + '/')
+                       for attr in self.attribute_values):
+                _throw('DB_DeviceNotDefined',
+                       'Device %s is not defined' % name)
+            self.devices[key] = SimulatedExternalDevice(self, name)
+        return self.devices[key]
+
+    def database(self, *args, **kwargs):
+        """Get the simulated database, it has the tango.Database
+        signature.
+        """
+        return SimulatedDatabase(self)
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Replace tango.DeviceProxy and tango.Database by the simulated
+        ones while in the context, with a registry of shared proxies and a
+        budget of DMA channels of its own.
+        """
+        modules = [tango]
+        try:
+            import PyTango
+            modules.append(PyTango)
+        except ImportError:
+            pass
+        saved = [(module, module.DeviceProxy, module.Database)
+                 for module in modules]
+        registry = proxies._registry
+        dma_budget = utils._dma_budget
+        try:
+            for module in modules:
+                module.DeviceProxy = self.device
+                module.Database = self.database
+            proxies._registry = proxies.ProxyRegistry()
+            utils._dma_budget = utils.DMABudget()
+            yield self
+        finally:
+            for module, device_proxy, database in saved:
+                module.DeviceProxy = device_proxy
+                module.Database = database
+            proxies._registry = registry
+            utils._dma_budget = dma_budget
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.nbytes.clear()
+
+    def stats(self):
+        """Return the total number of calls and of transferred bytes."""
+        with self._lock:
+            return sum(self.calls.values()), sum(self.nbytes.values())
+
+    def _account(self, device, call, nbytes):
+        with self._lock:
+            self.calls[(device, call)] += 1
+            self.nbytes[(device, call)] += nbytes
+        cost = self.latency
+        if self.bandwidth:
+            cost += nbytes / self.bandwidth
+        if cost > 0:
+            time.sleep(cost)
+
+    def _next_event_id(self):
+        with self._lock:
+            self._event_id += 1
+            return self._event_id
+
+    def _generator_started(self, channel):
+        with self._lock:
+            self._generators.append(channel)
+            if channel.application_type == 'COPulseChanTime':
+                attributes = channel._attributes
+                self._pulse_trains.append((
+                    channel._start_time + attributes['initialdelaytime'],
+                    attributes['hightime'], attributes['lowtime'],
+                    int(attributes['sampperchan'])))
+
+    def _trains(self, since):
+        """Start, high time, low time and number of pulses of the pulse
+        trains generated since the given time.
+        """
+        with self._lock:
+            return [train for train in self._pulse_trains
+                    if train[0] >= since]
+
+    def _master_start(self, since):
+        """Start time of the first master generator started after since."""
+        with self._lock:
+            starts = [g._start_time for g in self._generators
+                      if g._start_time is not None and g._start_time >= since]
+        return min(starts) if starts else None
+
+    def _clock(self, channel):
+        """Start time of the first pulse and period of the last started
+        generator channel, None if there is none.
+        """
+        with self._lock:
+            generators = [g for g in self._generators
+                          if g.application_type == 'COPulseChanTime']
+        if not generators:
+            return None
+        generator = generators[-1]
+        start = generator._start_time + \
+            generator._attributes['initialdelaytime']
+        return start, generator._period()
+
+
+def make_controller(klass, inst='_sim_ctrl', **properties):
+    """Create a controller filling in the default values of the
+    properties not given, as the Pool does.
+    """
+    props = {name: info[DefaultValue]
+             for name, info in klass.ctrl_properties.items()
+             if DefaultValue in info}
+    props.update(properties)
+    return klass(inst, props)
+
+
+def add_axis(ctrl, axis):
+    """Add the axis to the controller and set the default values of its
+    axis attributes, as the Pool does.
+    """
+    ctrl.AddDevice(axis)
+    for name, info in ctrl.axis_attributes.items():
+        if DefaultValue in info:
+            ctrl.SetAxisExtraPar(axis, name, info[DefaultValue])
+
+
+def wait(predicate, timeout=5):
+    """Wait until the predicate is true, e.g. a simulated acquisition
+    finished, raising AssertionError after timeout seconds.
+    """
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            raise AssertionError('Timeout waiting for the simulation')
+        time.sleep(0.001)
@@ -0,0 +1,167 @@
+import glob
+import json
+import os
+import tempfile
+import unittest
+
+import tango
+from sardana import State
+from sardana.pool import AcqSynch
+
+from sardana_ni660x.instrumentation import Histogram, Instrumentation
+from sardana_ni660x.simulator import (Simulation, add_axis, make_controller,
+                                      wait)
+from sardana_ni660x.utils import AttributeShadow
+from sardana_ni660x.ctrl.Ni660XCounterCTCtrl import Ni660XCounterCTCtrl
+from sardana_ni660x.ctrl.test.test_Ni660XCounterCTCtrl_sim import (
+    CHANNEL_DEV_NAMES, COUNTER, SAMPLE_CLK_SRC, TIMER)
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for value in [1e-4] * 99 + [1.]:
+            histogram.add(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertLess(histogram.percentile(50), 2e-4)
+        self.assertEqual(histogram.percentile(100), 1.)
+        self.assertEqual(sum(histogram.dump()['bins'].values()), 100)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def test_disabled(self):
+        instrumentation = Instrumentation()
+        start = instrumentation.begin()
+        self.assertIsNone(start)
+        instrumentation.tango('channel', 'State', start, 8)
+        instrumentation.call('apply_connect_terms', lambda: None)
+        data = instrumentation.dump()
+        self.assertEqual(data['calls'], {})
+        self.assertEqual(data['latency'], {})
+
+    def test_enable_clears(self):
+        instrumentation = Instrumentation()
+        instrumentation.enable()
+        instrumentation.tango('channel', 'State', instrumentation.begin(), 8)
+        instrumentation.enable(False)
+        self.assertEqual(instrumentation.dump()['bytes'], {'channel': 8})
+        instrumentation.enable()
+        self.assertEqual(instrumentation.dump()['bytes'], {})
+
+    def test_shadow_calls(self):
+        sim = Simulation()
+        channel = sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        instrumentation = Instrumentation()
+        instrumentation.enable()
+        shadow = AttributeShadow(channel, TIMER, instrumentation)
+        # finished, it is stopped before writing
+        channel._state = tango.DevState.ON
+        shadow.configure([('HighTime', 0.002)])
+        # the State, the Stop and the write
+        self.assertEqual(instrumentation.dump()['calls'], {TIMER: 3})
+        self.assertEqual(instrumentation.dump()['bytes'], {TIMER: 8})
+
+    def test_abort(self):
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        sim.add_channel(COUNTER, 'CICountEdgesChan', 'ctr1')
+        with sim.patch():
+            ctrl = make_controller(Ni660XCounterCTCtrl,
+                                   channelDevNames=CHANNEL_DEV_NAMES)
+            for axis in (1, 2):
+                add_axis(ctrl, axis)
+            ctrl.channels[2].Start()
+            ctrl.SetCtrlPar('instrumentation', True)
+            ctrl.AbortOne(2)
+            data = json.loads(ctrl.GetCtrlPar('instrumentationData'))
+            for axis in (1, 2):
+                ctrl.DeleteDevice(axis)
+        # the State and the Stop
+        self.assertEqual(data['calls'], {COUNTER: 2})
+
+    def run_controller(self, parameter, value, acquisitions=2):
+        """Run step acquisitions with the controller parameter set and
+        return the controller.
+        """
+        sim = Simulation()
+        sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        sim.add_channel(COUNTER, 'CICountEdgesChan', 'ctr1')
+        with sim.patch():
+            ctrl = make_controller(Ni660XCounterCTCtrl,
+                                   channelDevNames=CHANNEL_DEV_NAMES)
+            for axis in (1, 2):
+                add_axis(ctrl, axis)
+            ctrl.SetAxisExtraPar(2, 'sampleClockSource', SAMPLE_CLK_SRC)
+            ctrl._synchronization = AcqSynch.SoftwareTrigger
+            ctrl.SetCtrlPar(parameter, value)
+            for _ in range(acquisitions):
+                ctrl.LoadOne(1, 0.002, 1, 0)
+                ctrl.PreStartAll()
+                for axis in (2, 1):
+                    ctrl.PreStartOne(axis, 0.002)
+                    ctrl.StartOne(axis, 0.002)
+                ctrl.StartAll()
+                wait(lambda: ctrl.StateOne(2)[0] == State.On)
+                for axis in (1, 2):
+                    ctrl.ReadOne(axis)
+            for axis in (1, 2):
+                ctrl.DeleteDevice(axis)
+        return ctrl
+
+    def test_controller(self):
+        ctrl = self.run_controller('instrumentation', True)
+        data = json.loads(ctrl.GetCtrlPar('instrumentationData'))
+        self.assertTrue(ctrl.GetCtrlPar('instrumentation'))
+        for name in ('LoadOne', 'PreStartOne', 'StateOne', 'ReadOne',
+                     'apply_connect_terms'):
+            self.assertIn(name, data['latency'])
+        self.assertEqual(data['latency']['ReadOne']['count'], 4)
+        self.assertGreater(data['calls'][COUNTER], 0)
+        self.assertGreater(data['bytes'][COUNTER], 0)
+        # each acquisition ended with its last readout
+        self.assertEqual(data['acquisitions'], 2)
+
+    def test_single_acquisition_dead_time(self):
+        ctrl = self.run_controller('instrumentation', True, acquisitions=1)
+        data = json.loads(ctrl.GetCtrlPar('instrumentationData'))
+        # recorded after the last readout, without a next start
+        self.assertEqual(data['acquisitions'], 1)
+        dead_time = data['dead_time']
+        self.assertEqual(dead_time['count'], 1)
+        self.assertGreater(dead_time['total'], 0)
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ctrl = self.run_controller('traceDirectory', directory)
+            self.assertEqual(ctrl.GetCtrlPar('traceDirectory'), directory)
+            ctrl.SetCtrlPar('traceDirectory', '')
+            paths = sorted(glob.glob(os.path.join(directory, '*.json')))
+            self.assertEqual(len(paths), 2)
+            with open(paths[-1]) as f:
+                events = json.load(f)['traceEvents']
+        names = {(event.get('cat'), event['name']) for event in events}
+        for name in ('PreStartAll', 'StartOne', 'StateOne', 'ReadOne'):
+            self.assertIn(('api', name), names)
+        self.assertIn(('tango', 'Start'), names)
+        self.assertIn(('tango', 'read_attribute'), names)
+        self.assertIn(('state', 'axis 2 On'), names)
+        self.assertFalse(ctrl._instrumentation.active)
+
+    def test_single_acquisition_trace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ctrl = self.run_controller('traceDirectory', directory,
+                                       acquisitions=1)
+            # written once the acquisition is over, not on the next start
+            ctrl._instrumentation.flush()
+            paths = glob.glob(os.path.join(directory, '*.json'))
+            self.assertEqual(len(paths), 1)
+            with open(paths[0]) as f:
+                events = json.load(f)['traceEvents']
+            ctrl.SetCtrlPar('traceDirectory', '')
+            # nothing is left to write
+            self.assertEqual(
+                len(glob.glob(os.path.join(directory, '*.json'))), 1)
+        reads = [event for event in events if event['name'] == 'ReadOne']
+        self.assertEqual(len(reads), 2)
@@ -0,0 +1,76 @@
+import unittest
+
+from sardana_ni660x.proxies import (ProxyRegistry, SharedAttribute,
+                                    get_proxy, release_proxy)
+from sardana_ni660x.simulator import Simulation
+from sardana_ni660x.utils import ConnectTerms
+
+CARD = 'sim/ni660x/dev1'
+
+
+class ProxyRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.sim.add_card(CARD)
+        self.patch = self.sim.patch()
+        self.patch.__enter__()
+
+    def tearDown(self):
+        self.patch.__exit__(None, None, None)
+
+    def test_shared(self):
+        registry = ProxyRegistry()
+        proxy = registry.get(CARD)
+        self.assertIs(registry.get(CARD.upper()), proxy)
+        self.assertEqual(registry.count(CARD), 2)
+        registry.release(CARD)
+        registry.release(CARD)
+        self.assertEqual(registry.count(CARD), 0)
+
+    def test_timeout(self):
+        registry = ProxyRegistry()
+        proxy = registry.get(CARD)
+        slow = registry.get(CARD, timeout=120000)
+        # the longer timeout does not affect the other users
+        self.assertIsNot(slow, proxy)
+        self.assertIs(registry.get(CARD, timeout=120000), slow)
+        self.assertEqual(slow.get_timeout_millis(), 120000)
+        self.assertEqual(registry.count(CARD), 1)
+        self.assertEqual(registry.count(CARD, 120000), 2)
+
+    def test_lazy_connection(self):
+        registry = ProxyRegistry()
+        proxy = registry.get('sim/ni660x/dev2')
+        self.assertFalse(proxy.connected)
+        with self.assertRaises(Exception):
+            proxy.State()
+        # the device is available later
+        self.sim.add_card('sim/ni660x/dev2')
+        proxy.State()
+        self.assertTrue(proxy.connected)
+
+    def test_lazy_timeout(self):
+        registry = ProxyRegistry()
+        proxy = registry.get(CARD)
+        proxy.set_timeout_millis(120000)
+        self.assertFalse(proxy.connected)
+        self.assertEqual(proxy.get_timeout_millis(), 120000)
+        proxy.State()
+        self.assertEqual(self.sim.devices[CARD].get_timeout_millis(), 120000)
+
+    def test_cards_shared_by_controllers(self):
+        connect_terms = repr({CARD: [('/Dev1/PFI0', '/Dev1/RTSI0',
+                                      'DoNotInvertPolarity')]})
+        ct = ConnectTerms(connect_terms)
+        tg = ConnectTerms(connect_terms)
+        self.assertIs(ct.cards[CARD], tg.cards[CARD])
+        ct.delete_cards()
+        self.assertIs(get_proxy(CARD), tg.cards[CARD])
+        release_proxy(CARD)
+
+    def test_shared_attribute(self):
+        self.sim.attribute_values['motor/ctrl/1/position'] = 12.5
+        attribute = SharedAttribute('motor/ctrl/1/position')
+        self.assertEqual(attribute.read().value, 12.5)
+        attribute.release()
@@ -0,0 +1,78 @@
+import time
+import unittest
+
+import tango
+
+from sardana_ni660x.simulator import Simulation, wait
+
+TIMER = 'sim/ni660x/dev1-ctr0'
+COUNTER = 'sim/ni660x/dev1-ctr1'
+
+
+class SimulationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.timer = self.sim.add_channel(TIMER, 'COPulseChanTime', 'ctr0')
+        self.counter = self.sim.add_channel(COUNTER, 'CICountEdgesChan',
+                                            'ctr1')
+
+    def test_properties(self):
+        properties = self.counter.get_property(['applicationType',
+                                                'counterName', 'DeviceName'])
+        self.assertEqual(properties['applicationType'], ['CICountEdgesChan'])
+        self.assertEqual(properties['counterName'], ['ctr1'])
+        self.assertEqual(properties['DeviceName'], ['Dev1'])
+
+    def test_acquisition(self):
+        self.timer.write_attributes([('HighTime', 0.001), ('LowTime', 0.001),
+                                     ('SampPerChan', 5)])
+        self.counter.write_attributes([('SampPerChan', 5)])
+        self.counter.start()
+        self.timer.start()
+        self.assertEqual(self.counter.State(), tango.DevState.RUNNING)
+        with self.assertRaises(tango.DevFailed):
+            self.counter.write_attribute('SampPerChan', 10)
+        wait(lambda: self.counter.State() == tango.DevState.ON)
+        values = self.counter.read_attribute('CountBuffer').value
+        self.assertEqual(values.tolist(), [20] * 5)
+        reply = self.counter.write_read_attributes([('BufferOffset', 3)],
+                                                   ['CountBuffer'])
+        self.assertEqual(len(reply[0].value), 2)
+        self.counter.stop()
+        self.assertEqual(self.counter.State(), tango.DevState.STANDBY)
+
+    def test_unknown_attribute(self):
+        # as a real device, e.g. one without the delta readout
+        del self.counter._attributes['bufferoffset']
+        with self.assertRaises(tango.DevFailed):
+            self.counter.write_attributes([('BufferOffset', 3)])
+        with self.assertRaises(tango.DevFailed):
+            self.counter.write_attribute('NoAttribute', 1)
+        with self.assertRaises(tango.DevFailed):
+            self.counter.write_read_attributes([('BufferOffset', 3)],
+                                               ['CountBuffer'])
+
+    def test_slave_waits_for_master(self):
+        slave = self.sim.add_channel('sim/ni660x/dev1-ctr2',
+                                     'COPulseChanTime', 'ctr2')
+        slave.write_attributes([('HighTime', 0.001), ('LowTime', 0.001),
+                                ('StartTriggerSource', '/Dev1/PFI12')])
+        slave.Start()
+        time.sleep(0.01)
+        self.assertEqual(slave.State(), tango.DevState.RUNNING)
+        self.timer.Start()
+        wait(lambda: slave.State() == tango.DevState.ON)
+
+    def test_cost(self):
+        self.sim.latency = 0.01
+        start = time.monotonic()
+        self.counter.State()
+        self.assertGreaterEqual(time.monotonic() - start, 0.01)
+        self.assertEqual(self.sim.calls[(COUNTER, 'State')], 1)
+
+    def test_connect_terms(self):
+        card = self.sim.add_card('sim/ni660x/dev1')
+        card.ConnectTerms(['/Dev1/PFI0', '/Dev1/RTSI0', 'DoNotInvertPolarity'])
+        self.assertEqual(card.routes['/Dev1/RTSI0'],
+                         ('/Dev1/PFI0', 'DoNotInvertPolarity'))
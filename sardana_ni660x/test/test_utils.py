@@ -0,0 +1,219 @@
+import unittest
+
+import numpy
+import tango
+
+from sardana_ni660x.simulator import Simulation
+from sardana_ni660x.utils import AttributeShadow, ConnectTerms, DMABudget
+from sardana_ni660x.utils import ReadScheduler
+from sardana_ni660x.utils import allocate_dma
+from sardana_ni660x.utils import compile_pulse_train, is_uniform
+
+
+class ReadSchedulerTestCase(unittest.TestCase):
+
+    def test_not_started(self):
+        scheduler = ReadScheduler()
+        self.assertTrue(scheduler.due(0))
+
+    def test_new_samples(self):
+        scheduler = ReadScheduler(max_staleness=10)
+        scheduler.start(0.1, 100, now=0)
+        self.assertFalse(scheduler.due(0, now=0.05))
+        self.assertTrue(scheduler.due(0, now=0.15))
+        self.assertFalse(scheduler.due(1, now=0.15))
+        # all the samples are expected
+        self.assertTrue(scheduler.due(99, now=20))
+
+    def test_cost(self):
+        scheduler = ReadScheduler(max_staleness=10)
+        scheduler.start(0.001, 1000, now=0)
+        # each read takes 10 ms, worth it with 10 new samples
+        scheduler.record(0.01, 5, 5, now=0.005)
+        self.assertFalse(scheduler.due(5, delta=True, now=0.010))
+        self.assertTrue(scheduler.due(5, delta=True, now=0.016))
+
+    def test_staleness(self):
+        scheduler = ReadScheduler(max_staleness=0.5)
+        scheduler.start(10, 100, now=0)
+        self.assertFalse(scheduler.due(0, now=0.4))
+        self.assertTrue(scheduler.due(0, now=0.6))
+
+    def test_late_trigger(self):
+        scheduler = ReadScheduler(max_staleness=10)
+        scheduler.start(0.1, 100, now=0)
+        # nothing arrived yet, the start is moved to the read
+        scheduler.record(0.001, 0, 0, now=1)
+        self.assertEqual(scheduler.expected(now=1.05), 0)
+        self.assertEqual(scheduler.expected(now=1.25), 2)
+
+
+class ConnectTermsTestCase(unittest.TestCase):
+
+    CONNECT_TERMS = repr({'sim/ni660x/dev1': [
+        ('/Dev1/ctr1/gate', '/Dev1/RTSI0', 'DoNotInvertPolarity')]})
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.card = self.sim.add_card('sim/ni660x/dev1')
+
+    def test_apply_once(self):
+        with self.sim.patch():
+            connect_terms = ConnectTerms(self.CONNECT_TERMS)
+            connect_terms.apply_connect_terms()
+            connect_terms.apply_connect_terms()
+        self.assertEqual(self.card.routes['/Dev1/RTSI0'],
+                         ('/Dev1/PFI34', 'DoNotInvertPolarity'))
+        self.assertEqual(self.sim.calls[('sim/ni660x/dev1', 'ConnectTerms')],
+                         1)
+
+    def test_card_restart(self):
+        with self.sim.patch():
+            connect_terms = ConnectTerms(self.CONNECT_TERMS)
+            connect_terms.apply_connect_terms()
+            self.card.restart()
+            self.assertEqual(self.card.routes, {})
+            connect_terms.apply_connect_terms()
+        self.assertIn('/Dev1/RTSI0', self.card.routes)
+
+    def test_card_init(self):
+        with self.sim.patch():
+            connect_terms = ConnectTerms(self.CONNECT_TERMS)
+            connect_terms.apply_connect_terms()
+            # Init does not push the interface change event
+            self.card.Init()
+            connect_terms.apply_connect_terms(force=True)
+        self.assertIn('/Dev1/RTSI0', self.card.routes)
+
+    def test_delete_cards(self):
+        with self.sim.patch():
+            connect_terms = ConnectTerms(self.CONNECT_TERMS)
+            connect_terms.apply_connect_terms()
+            connect_terms.delete_cards()
+            self.assertEqual(connect_terms.cards, {})
+            connect_terms.apply_connect_terms()
+        self.assertEqual(self.sim.calls[('sim/ni660x/dev1', 'ConnectTerms')],
+                         2)
+
+
+class AttributeShadowTestCase(unittest.TestCase):
+
+    CHANNEL = 'sim/ni660x/dev1-ctr0'
+    CONFIG = [('HighTime', 0.002), ('LowTime', 0.003),
+              ('HighTimeBuffer', numpy.array([0.002, 0.004])),
+              ('LowTimeBuffer', numpy.array([0.003, 0.003]))]
+
+    def setUp(self):
+        self.sim = Simulation()
+        self.channel = self.sim.add_channel(self.CHANNEL, 'COPulseChanTime')
+        self.shadow = AttributeShadow(self.channel)
+
+    def writes(self):
+        return self.sim.calls[(self.CHANNEL, 'write_attributes')]
+
+    def test_skip_written(self):
+        self.assertEqual(self.shadow.configure(self.CONFIG), self.CONFIG)
+        self.assertEqual(self.shadow.configure(self.CONFIG), [])
+        written = self.shadow.configure([('HighTime', 0.002),
+                                         ('LowTime', 0.005)])
+        self.assertEqual(written, [('LowTime', 0.005)])
+        self.assertEqual(self.writes(), 2)
+
+    def test_restart(self):
+        self.shadow.configure(self.CONFIG)
+        self.channel.restart()
+        self.assertEqual(self.shadow.configure(self.CONFIG), self.CONFIG)
+        self.assertEqual(
+            len(self.channel.read_attribute('HighTimeBuffer').value), 2)
+
+    def test_invalidate(self):
+        self.shadow.configure(self.CONFIG)
+        # Init does not push the interface change event, the owner
+        # invalidates the shadow
+        self.channel.Init()
+        self.shadow.invalidate()
+        self.assertEqual(self.shadow.configure(self.CONFIG), self.CONFIG)
+        self.assertEqual(self.channel.read_attribute('HighTime').value,
+                         0.002)
+
+    def test_nothing_to_write(self):
+        self.shadow.configure(self.CONFIG)
+        self.channel._state = tango.DevState.ON
+        self.sim.reset_stats()
+        self.assertEqual(self.shadow.configure(self.CONFIG), [])
+        # the device is not accessed
+        self.assertEqual(sum(self.sim.calls.values()), 0)
+        self.assertEqual(self.channel.State(), tango.DevState.ON)
+
+    def test_stop_finished(self):
+        self.shadow.configure(self.CONFIG)
+        self.channel._state = tango.DevState.ON
+        self.shadow.configure([('LowTime', 0.005)])
+        self.assertEqual(self.channel.read_attribute('LowTime').value, 0.005)
+        self.assertEqual(self.sim.calls[(self.CHANNEL, 'Stop')], 1)
+
+    def test_running(self):
+        self.shadow.configure(self.CONFIG)
+        self.channel.Start()
+        # a running channel is never stopped
+        with self.assertRaises(tango.DevFailed):
+            self.shadow.configure([('LowTime', 0.1)])
+        self.assertEqual(self.sim.calls[(self.CHANNEL, 'Stop')], 0)
+        self.channel.Stop()
+        # the shadow was forgotten by the failed write
+        self.assertEqual(self.shadow.configure(self.CONFIG[2:]),
+                         self.CONFIG[2:])
+
+
+class DMATestCase(unittest.TestCase):
+
+    def test_allocate(self):
+        channels = [(axis, 'Dev1') for axis in range(2, 7)] + [(7, 'Dev2')]
+        allocation = allocate_dma(channels, {'Dev1': 3})
+        self.assertEqual([allocation[axis] for axis in range(2, 7)],
+                         ['DMA'] * 3 + ['Interrupts'] * 2)
+        # all the DMA channels of the cards not given
+        self.assertEqual(allocation[7], 'DMA')
+        self.assertEqual(allocate_dma(channels[:2], {'Dev1': 0}),
+                         {2: 'Interrupts', 3: 'Interrupts'})
+
+    def test_shared_card(self):
+        budget = DMABudget()
+        counters = [(axis, 'Dev1') for axis in (2, 3)]
+        positions = [(axis, 'Dev1') for axis in (2, 3)]
+        self.assertEqual(budget.allocate('ct', counters),
+                         {2: 'DMA', 3: 'DMA'})
+        self.assertEqual(budget.allocate('pos', positions),
+                         {2: 'DMA', 3: 'Interrupts'})
+        self.assertEqual(budget.reserved('Dev1'), 3)
+        # allocating again replaces the previous reservations
+        self.assertEqual(budget.allocate('ct', counters[:1]), {2: 'DMA'})
+        self.assertEqual(budget.reserved('Dev1'), 2)
+        budget.release('pos')
+        self.assertEqual(budget.reserved('Dev1'), 1)
+
+    def test_limits_and_kept(self):
+        budget = DMABudget()
+        channels = [(axis, 'Dev1') for axis in (2, 3)]
+        self.assertEqual(budget.allocate('ct', channels, {'Dev1': 1}),
+                         {2: 'DMA', 3: 'Interrupts'})
+        # the running channel 2 keeps its DMA channel
+        allocation = budget.allocate('ct', [(3, 'Dev1'), (4, 'Dev1')],
+                                     kept=[(2, 'Dev1', 'DMA')])
+        self.assertEqual(allocation, {3: 'DMA', 4: 'DMA'})
+        self.assertEqual(budget.reserved('Dev1'), 3)
+
+
+class PulseTrainTestCase(unittest.TestCase):
+
+    def test_compile(self):
+        high, low = compile_pulse_train([1, 2], [3, 4], [2, 1])
+        self.assertEqual(high.tolist(), [1, 1, 2])
+        self.assertEqual(low.tolist(), [2, 2, 2])
+        self.assertFalse(is_uniform(high))
+        self.assertTrue(is_uniform(low))
+
+    def test_gap(self):
+        high, low = compile_pulse_train([0.1, 0.1], [0.2, 0.2], [2, 2],
+                                        starts=[0, 1])
+        numpy.testing.assert_allclose(low, [0.1, 0.7, 0.1, 0.1])
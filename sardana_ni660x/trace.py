@@ -0,0 +1,87 @@
+"""Timeline of the controller and Tango calls in the Chrome trace format.
+
+The traces can be opened with chrome://tracing or https://ui.perfetto.dev.
+Each controller writes one file per acquisition, the timestamps are
+microseconds since the epoch so the files of several controllers can be
+merged into a single timeline with merge_traces::
+
+    recorder = TraceRecorder('ctctrl01')
+    start = time.perf_counter()
+    ...
+    recorder.span('ReadOne', 'api', start, time.perf_counter(), axis=2)
+    recorder.export('/tmp/ctctrl01-0001.json')
+"""
+import json
+import os
+import threading
+import time
+
+# offset from time.perf_counter() to the epoch, the spans are measured with
+# the former but exported with the latter
+_EPOCH_OFFSET = time.time() - time.perf_counter()
+
+
+def _timestamp(counter):
+    return (counter + _EPOCH_OFFSET) * 1e6
+
+
+class TraceRecorder:
+    """Record timestamped spans and instants of a controller."""
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = os.getpid()
+        self.events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def _tid(self):
+        ident = threading.get_ident()
+        tid = self._threads.get(ident)
+        if tid is None:
+            tid = self._threads[ident] = len(self._threads) + 1
+            self.events.append({
+                'ph': 'M', 'name': 'thread_name', 'pid': self.pid,
+                'tid': tid,
+                'args': {'name': threading.current_thread().name}})
+        return tid
+
+    def span(self, name, category, start, end, **args):
+        """Record a span measured with time.perf_counter()."""
+        with self._lock:
+            self.events.append({
+                'ph': 'X', 'name': name, 'cat': category,
+                'ts': _timestamp(start), 'dur': (end - start) * 1e6,
+                'pid': self.pid, 'tid': self._tid(), 'args': args})
+
+    def instant(self, name, category, **args):
+        """Record an instant event happening now."""
+        with self._lock:
+            self.events.append({
+                'ph': 'i', 's': 't', 'name': name, 'cat': category,
+                'ts': _timestamp(time.perf_counter()),
+                'pid': self.pid, 'tid': self._tid(), 'args': args})
+
+    def export(self, path):
+        """Write the recorded events to path in the Chrome trace format."""
+        with self._lock:
+            events = list(self.events)
+        events.insert(0, {'ph': 'M', 'name': 'process_name', 'pid': self.pid,
+                          'tid': 0, 'args': {'name': self.name}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms'}, f)
+
+
+def merge_traces(paths, output):
+    """Merge the trace files, e.g. of the counter and the trigger gate
+    controllers, into a single timeline. Each file is shown as a process.
+    """
+    events = []
+    for pid, path in enumerate(paths, 1):
+        with open(path) as f:
+            for event in json.load(f)['traceEvents']:
+                event['pid'] = pid
+                events.append(event)
+    with open(output, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
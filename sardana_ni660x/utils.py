@@ -1,7 +1,15 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+import numpy
 import tango
 
+from sardana_ni660x.instrumentation import payload_size
+from sardana_ni660x.proxies import get_proxy, release_proxy
+
 class IdleState(Enum):
     LOW = "Low"
     HIGH = "High"
@@ -23,6 +31,208 @@ NI6602_PFI = {
     "ctr6": {"src": "PFI15", "gate": "PFI14", "out": "PFI12", "aux": "PFI13"},
     "ctr7": {"src": "PFI11", "gate": "PFI10", "out": "PFI8",  "aux": "PFI9"}}
 
+DMACHANNELS_DOC = ('String with dictionary form. Keys are Ni660X card names'
+                   ' e.g. Dev1, values are the number of DMA channels of the'
+                   ' card which can be used by this controller. Cards not'
+                   ' present use all their DMA channels not reserved by'
+                   ' other controllers.')
+
+# number of DMA channels of a NI6602 card
+DMA_CHANNELS_PER_CARD = 3
+
+# maximum number of Tango calls executed concurrently by the controllers
+MAX_WORKERS = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Get the thread pool shared by all the Ni660X controllers."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                           thread_name_prefix='ni660x')
+    return _executor
+
+
+def parallel_map(func, items):
+    """Call func for every item concurrently and return the results in
+    the items order. The first exception raised by func is propagated.
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+    return list(get_executor().map(func, items))
+
+
+def _split_database(name):
+    """Split the device name into the (host, port) of its database, None
+    for the default one, and the device name in it.
+    """
+    if name.startswith('tango://'):
+        name = name[len('tango://'):]
+    parts = name.split('/')
+    if len(parts) == 4 and ':' in parts[0]:
+        host, port = parts[0].rsplit(':', 1)
+        return (host, int(port)), '/'.join(parts[1:])
+    return None, name
+
+
+def get_device_properties(names, properties):
+    """Get the properties of all the devices from the Tango database, the
+    devices of each database host are queried concurrently.
+
+    Returns a dictionary with the properties, in the form returned by
+    DeviceProxy.get_property, of each device name. The devices whose
+    properties could not be read are missing, as the ones with any of the
+    properties undefined: the database returns an empty list for them, as
+    for all the properties of an undefined device.
+    """
+    by_host = {}
+    for name in names:
+        host, dev_name = _split_database(name)
+        by_host.setdefault(host, []).append((name, dev_name))
+    databases = {host: tango.Database(*host) if host else tango.Database()
+                 for host in by_host}
+
+    def query(item):
+        host, name, dev_name = item
+        try:
+            props = databases[host].get_device_property(dev_name, properties)
+        except Exception:
+            return name, None
+        if not all(props.get(prop) for prop in properties):
+            return name, None
+        return name, props
+
+    items = [(host, name, dev_name)
+             for host, devices in by_host.items()
+             for name, dev_name in devices]
+    return {name: props for name, props in parallel_map(query, items)
+            if props is not None}
+
+
+def allocate_dma(channels, available):
+    """Allocate the DMA channels of the cards to the channels in the given
+    order, the rest of them use interrupts.
+
+    channels is a sequence of (channel, card) pairs. available maps the
+    card name to its number of free DMA channels, DMA_CHANNELS_PER_CARD by
+    default. Returns a dictionary mapping each channel to its transfer
+    mechanism.
+    """
+    used = collections.Counter()
+    allocation = {}
+    for channel, card in channels:
+        if used[card] < available.get(card, DMA_CHANNELS_PER_CARD):
+            used[card] += 1
+            allocation[channel] = 'DMA'
+        else:
+            allocation[channel] = 'Interrupts'
+    return allocation
+
+
+class DMABudget:
+    """Reservations of the DMA channels of the Ni660X cards.
+
+    Each controller reserves here the DMA channels it gives to its
+    channels, so several controllers acquiring from the same card, e.g. a
+    counter and a position controller, never use more DMA channels than
+    the card has. The reservations of a controller are kept until it
+    allocates again or releases them.
+    """
+
+    def __init__(self):
+        # DMA channels reserved of each card by each owner
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, owner, channels, limits=None, kept=()):
+        """Allocate the DMA channels not reserved by the other owners, see
+        allocate_dma, replacing the previous reservations of the owner.
+
+        limits maps the card name to the number of DMA channels the owner
+        can use at most. kept are the (channel, card, transfer) tuples of
+        the channels of the owner which keep their transfer mechanism,
+        e.g. they are running, their DMA channels stay reserved.
+        """
+        limits = limits or {}
+        with self._lock:
+            self._reserved.pop(owner, None)
+            others = collections.Counter()
+            for reserved in self._reserved.values():
+                others.update(reserved)
+            kept_dma = collections.Counter(card for _, card, transfer in kept
+                                           if transfer == 'DMA')
+            available = {}
+            for _, card in channels:
+                free = min(limits.get(card, DMA_CHANNELS_PER_CARD),
+                           DMA_CHANNELS_PER_CARD - others[card])
+                available[card] = max(free - kept_dma[card], 0)
+            allocation = allocate_dma(channels, available)
+            reserved = kept_dma + collections.Counter(
+                card for channel, card in channels
+                if allocation[channel] == 'DMA')
+            if reserved:
+                self._reserved[owner] = reserved
+        return allocation
+
+    def release(self, owner):
+        """Release the DMA channels reserved by the owner."""
+        with self._lock:
+            self._reserved.pop(owner, None)
+
+    def reserved(self, card):
+        """Number of DMA channels of the card reserved by all the owners."""
+        with self._lock:
+            return sum(reserved[card] for reserved in self._reserved.values())
+
+
+_dma_budget = DMABudget()
+
+
+def allocate_dma_channels(owner, channels, limits=None, kept=()):
+    """Allocate the DMA channels in the process-wide budget, see
+    DMABudget.allocate.
+    """
+    return _dma_budget.allocate(owner, channels, limits, kept)
+
+
+def release_dma_channels(owner):
+    """Release the DMA channels of the owner in the process-wide budget."""
+    _dma_budget.release(owner)
+
+
+def compile_pulse_train(actives, totals, repeats, starts=None):
+    """Compile the groups of a synchronization description into one train
+    of pulses, returned as the arrays of the high and low time of each
+    pulse.
+
+    The groups follow each other without a gap unless their start times,
+    relative to any common origin, are given: then the gap is added to the
+    low time of the last pulse of the previous group.
+    """
+    actives = numpy.asarray(actives, dtype=numpy.float64)
+    totals = numpy.asarray(totals, dtype=numpy.float64)
+    repeats = numpy.asarray(repeats, dtype=numpy.int64)
+    high_times = numpy.repeat(actives, repeats)
+    low_times = numpy.repeat(totals - actives, repeats)
+    if starts is not None and len(repeats) > 1:
+        starts = numpy.asarray(starts, dtype=numpy.float64)
+        ends = starts[:-1] + totals[:-1] * repeats[:-1]
+        gaps = numpy.clip(starts[1:] - ends, 0, None)
+        last_pulses = numpy.cumsum(repeats)[:-1] - 1
+        low_times[last_pulses] += gaps
+    return high_times, low_times
+
+
+def is_uniform(values):
+    """Tell if all the values of the array are equal."""
+    return len(values) == 0 or values.min() == values.max()
+
+
 def getPFIName(counterName, signal):
     """ Method to get the PFI signal name for each counter, e.g.:/Dev1/ctr1 """
     counter = counterName[-4:].lower()
@@ -45,35 +255,289 @@ def getPFINameFromFriendlyWords(counter):
     return counter
 
 class ConnectTerms:
+    """Terminal routes of the Ni660X cards.
+
+    The routes are resolved once, at construction, and applied to each card
+    only if they were not applied yet, the card was restarted since
+    (notified by the interface change event) or the application is forced.
+    The routes cannot be read back from the cards and the event is not
+    pushed on a plain Init, nor when other clients change the routes, so
+    the controllers force the application once per measurement, in
+    PrepareOne. If the event cannot be subscribed the routes of the card
+    are applied every time. The cards are routed concurrently.
+    """
+
     def __init__(self, connect_terms):
         self.connectTerms = connect_terms
         self.cards = {}
         self.card_configured = {}
+        self.routes = {}
+        self._event_ids = {}
+        self._lock = threading.Lock()
         cards = eval(self.connectTerms)
         for card_dev_name in cards.keys():
-            value = cards[card_dev_name]
-            card_dev = tango.DeviceProxy(card_dev_name)
-            self.cards[card_dev] = value
-            self.card_configured[card_dev] = False
-
-    def apply_connect_terms(self):
-        for card_dev in self.card_configured.keys():
-            for device_tuple in self.cards[card_dev]:
-                src_terminal = device_tuple[0]
+            routes = []
+            for device_tuple in cards[card_dev_name]:
                 #Check if is defined as a friendly words
-                src_terminal = getPFINameFromFriendlyWords(src_terminal)
-                dest_terminal = device_tuple[1]
-                dest_terminal = getPFINameFromFriendlyWords(dest_terminal)
+                src_terminal = getPFINameFromFriendlyWords(device_tuple[0])
+                dest_terminal = getPFINameFromFriendlyWords(device_tuple[1])
                 polarity = device_tuple[2]
-                card_dev.ConnectTerms([src_terminal,
-                                       dest_terminal,
-                                       polarity])
-            self.card_configured[card_dev] = True
+                routes.append([src_terminal, dest_terminal, polarity])
+            self.routes[card_dev_name] = routes
+            self.cards[card_dev_name] = get_proxy(card_dev_name)
+            self.card_configured[card_dev_name] = False
+
+    def _watch(self, card_dev_name):
+        card_dev = self.cards[card_dev_name]
+
+        def push_event(event):
+            with self._lock:
+                self.card_configured[card_dev_name] = False
+
+        try:
+            self._event_ids[card_dev_name] = card_dev.subscribe_event(
+                tango.EventType.INTERFACE_CHANGE_EVENT, push_event)
+        except Exception:
+            self._event_ids[card_dev_name] = None
+
+    def _apply(self, card_dev_name):
+        if card_dev_name not in self.cards:
+            self.cards[card_dev_name] = get_proxy(card_dev_name)
+        if card_dev_name not in self._event_ids:
+            self._watch(card_dev_name)
+        with self._lock:
+            if self.card_configured[card_dev_name]:
+                return
+        card_dev = self.cards[card_dev_name]
+        for route in self.routes[card_dev_name]:
+            card_dev.ConnectTerms(route)
+        # without the restart notification the routes are always applied
+        with self._lock:
+            self.card_configured[card_dev_name] = \
+                self._event_ids[card_dev_name] is not None
+
+    def apply_connect_terms(self, force=False):
+        if force:
+            with self._lock:
+                self.card_configured = dict.fromkeys(self.routes, False)
+        parallel_map(self._apply, list(self.routes))
 
     def delete_cards(self):
-        cards = eval(self.connectTerms)
-        for card_dev_name in cards.keys():
-            card_dev = tango.DeviceProxy(card_dev_name)
-            del self.cards[card_dev]
-            del self.card_configured[card_dev]
+        """Release the card devices, the routes are applied again, with
+        new devices, on the next apply_connect_terms.
+        """
+        for card_dev_name, event_id in self._event_ids.items():
+            if event_id is not None:
+                try:
+                    self.cards[card_dev_name].unsubscribe_event(event_id)
+                except Exception:
+                    pass
+        self._event_ids = {}
+        for card_dev_name in self.cards:
+            release_proxy(card_dev_name)
+        self.cards = {}
+        self.card_configured = dict.fromkeys(self.routes, False)
+
+
+
+class AttributeShadow:
+    """Shadow copy of the last values written to the attributes of a
+    Ni660XCounter device, used to skip the writes of values the device
+    already has.
+
+    The shadow is forgotten when the device is restarted (notified by the
+    interface change event), when a write fails and when the owner
+    invalidates it. The event is not pushed on a plain Init, nor when other
+    clients write the attributes, so the controllers invalidate the shadow
+    once per measurement, in PrepareOne. If the event cannot be subscribed
+    the shadow is never trusted and every value is written.
+
+    Each call to the device is accounted to name in the instrumentation,
+    if given.
+    """
+
+    def __init__(self, proxy, name=None, instrumentation=None):
+        self._proxy = proxy
+        self._name = name
+        self._instrumentation = instrumentation
+        self._values = {}
+        self._lock = threading.Lock()
+        self._event_id = None
+        self._trusted = None
+
+    def _call(self, operation, *args, nbytes=0):
+        if self._instrumentation is None:
+            return getattr(self._proxy, operation)(*args)
+        start = self._instrumentation.begin()
+        try:
+            return getattr(self._proxy, operation)(*args)
+        finally:
+            self._instrumentation.tango(self._name, operation, start, nbytes)
+
+    def _watch(self):
+        try:
+            self._event_id = self._proxy.subscribe_event(
+                tango.EventType.INTERFACE_CHANGE_EVENT, self._push_event)
+            self._trusted = True
+        except Exception:
+            self._trusted = False
+
+    def _push_event(self, event):
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._values.clear()
+
+    def close(self):
+        if self._event_id is not None:
+            try:
+                self._proxy.unsubscribe_event(self._event_id)
+            except Exception:
+                pass
+            self._event_id = None
+        self._trusted = None
+        self.invalidate()
+
+    def pending(self, attr_values):
+        """Return the (name, value) pairs which differ from the shadow."""
+        if self._trusted is None:
+            self._watch()
+        if not self._trusted:
+            return list(attr_values)
+        pending = []
+        with self._lock:
+            for name, value in attr_values:
+                key = name.lower()
+                if key not in self._values or \
+                        not _equal(self._values[key], value):
+                    pending.append((name, value))
+        return pending
+
+    def write(self, attr_values):
+        """Write the given values, in a single call, and record them in the
+        shadow.
+        """
+        attr_values = list(attr_values)
+        try:
+            self._call('write_attributes', attr_values,
+                       nbytes=payload_size(attr_values))
+        except Exception:
+            self.invalidate()
+            raise
+        with self._lock:
+            for name, value in attr_values:
+                self._values[name.lower()] = value
+
+    def configure(self, attr_values):
+        """Write only the values which differ from the shadow. The device is
+        accessed only when there is something to write: the channel is then
+        stopped if it finished, e.g. the previous acquisition, but never
+        while it is running. Returns the written (name, value) pairs.
+        """
+        pending = self.pending(attr_values)
+        if pending:
+            state = self._call('State')
+            if state not in (tango.DevState.STANDBY, tango.DevState.RUNNING):
+                self._call('Stop')
+            self.write(pending)
+        return pending
+
+
+def _equal(a, b):
+    try:
+        return bool(a == b)
+    except ValueError:
+        return numpy.array_equal(a, b)
+
+
+class ReadScheduler:
+    """Decide when the buffer of a counter channel is worth reading.
+
+    The samples are expected to arrive every period seconds since the
+    start. The cost of a read is estimated, from the measured round trips,
+    as a fixed time plus a time per transferred sample. A read is due when
+    more samples are expected than the ones arriving while the read takes
+    place, when all the samples are expected or when the last read is older
+    than max_staleness. Before start, e.g. in the step mode, every read is
+    due.
+    """
+
+    # weight of the last round trip in the exponential averages
+    ALPHA = 0.2
+
+    def __init__(self, max_staleness=1.0):
+        self.max_staleness = max_staleness
+        self._start = None
+        self._period = None
+        self._repetitions = 0
+        self._last_read = None
+        # exponential averages of the samples (x) and the round trip (y)
+        self._stats = None
+
+    def reset(self):
+        self._start = None
+
+    def start(self, period, repetitions, now=None):
+        now = time.monotonic() if now is None else now
+        self._start = now
+        self._last_read = now
+        self._period = period
+        self._repetitions = repetitions
+
+    def expected(self, now=None):
+        """Number of samples expected to be acquired by now."""
+        if self._start is None:
+            return 0
+        now = time.monotonic() if now is None else now
+        if self._period <= 0:
+            return self._repetitions
+        samples = int((now - self._start) / self._period)
+        return min(self._repetitions, max(samples, 0))
+
+    def cost(self, samples):
+        """Estimated round trip of a read transferring samples."""
+        if self._stats is None:
+            return 0
+        x, y, xx, xy = self._stats
+        variance = xx - x * x
+        slope = (xy - x * y) / variance if variance > 0 else 0
+        slope = max(slope, 0)
+        fixed = max(y - slope * x, 0)
+        return fixed + slope * samples
+
+    def due(self, index, delta=False, now=None):
+        """Tell if the read is due, index is the number of samples already
+        read and delta if only the new samples are transferred.
+        """
+        if self._start is None:
+            return True
+        now = time.monotonic() if now is None else now
+        if now - self._last_read >= self.max_staleness:
+            return True
+        expected = self.expected(now)
+        new = expected - index
+        if new <= 0:
+            return False
+        if expected >= self._repetitions:
+            return True
+        transferred = new if delta else expected
+        return new * self._period >= self.cost(transferred)
 
+    def record(self, round_trip, samples, index, now=None):
+        """Record a read which took round_trip seconds, transferred samples
+        and left index samples read. The start is moved later if fewer
+        samples than expected arrived, e.g. the trigger started late.
+        """
+        now = time.monotonic() if now is None else now
+        self._last_read = now
+        point = (samples, round_trip, samples * samples,
+                 samples * round_trip)
+        if self._stats is None:
+            self._stats = point
+        else:
+            a = self.ALPHA
+            self._stats = tuple((1 - a) * old + a * new
+                                for old, new in zip(self._stats, point))
+        if self._start is not None and index < self.expected(now):
+            self._start = now - index * self._period